@@ -5,7 +5,7 @@ from random import choice
 from string import digits, ascii_lowercase
 
 from djing.lib import LogicError
-from ip_pool.models import NetworkModel
+from ip_pool.models import NetworkModel, find_network
 from gw_app.models import NASModel
 from . import models
 from django.conf import settings
@@ -167,6 +167,27 @@ class MarkersForm(forms.ModelForm):
         return instance
 
 
+class FinReportForm(forms.Form):
+    date_from = forms.DateField(label=_('Date from'), required=False,
+                                widget=forms.DateInput(attrs={'type': 'date'}))
+    date_to = forms.DateField(label=_('Date to'), required=False,
+                              widget=forms.DateInput(attrs={'type': 'date'}))
+    trade_point = forms.CharField(label=_('Trade point'), max_length=20, required=False)
+    by_month = forms.BooleanField(label=_('By months'), required=False)
+    by_trade_point = forms.BooleanField(label=_('By trade points'), required=False)
+
+    def report_params(self) -> dict:
+        """
+        :return: kwargs for AllTimePayLog.objects.by_days
+        """
+        if not self.is_valid():
+            return {}
+        params = self.cleaned_data.copy()
+        if not params.get('trade_point'):
+            params['trade_point'] = None
+        return params
+
+
 class AmountMoneyForm(forms.Form):
     amount = forms.FloatField(max_value=5000, label=_('Amount of money'))
     comment = forms.CharField(max_length=128, label=_('Comment'), required=False)
@@ -183,19 +204,21 @@ class AddIpForm(forms.ModelForm):
             if instance:
                 net = NetworkModel.objects.filter(groups=instance.group).first()
                 if net is not None:
-                    ips = (ip.ip_address for ip in
-                           models.Abon.objects.filter(
-                               group__in=net.groups.all(),
-                               nas=instance.nas
-                           ).order_by('ip_address').only(
-                               'ip_address').iterator())
-                    free_ip = net.get_free_ip(ips)
-                    self.initial['ip_address'] = free_ip
+                    # address is not reserved, form is built on each view
+                    self.initial['ip_address'] = net.offer_ip(nas_id=instance.nas_id)
             else:
                 raise LogicError(_('Subnet has not attached to current group'))
 
     networks = forms.ModelChoiceField(label=_('Networks'), queryset=NetworkModel.objects.none(), empty_label=None)
 
+    def clean_ip_address(self):
+        ip = self.cleaned_data.get('ip_address')
+        if ip and find_network(ip) is None:
+            raise forms.ValidationError(_('Ip address %(ip)s is not in any network'), params={
+                'ip': ip
+            }, code='invalid')
+        return ip
+
     class Meta:
         model = models.Abon
         fields = 'ip_address',
@@ -0,0 +1,66 @@
+# Generated by Django 2.1 on 2026-10-19 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_counters(apps, _):
+    Abon = apps.get_model('abonapp', 'Abon')
+    Group = apps.get_model('group_app', 'Group')
+    NASModel = apps.get_model('gw_app', 'NASModel')
+    GroupAbonCounters = apps.get_model('abonapp', 'GroupAbonCounters')
+    NasAbonCounters = apps.get_model('abonapp', 'NasAbonCounters')
+    aggregates = {
+        'total': models.Count('pk'),
+        'active': models.Count('pk', filter=models.Q(is_active=True)),
+        'with_tariff': models.Count('current_tariff'),
+        'debtors': models.Count('pk', filter=models.Q(ballance__lt=0))
+    }
+    for counters_model, key_field, key_model in (
+            (GroupAbonCounters, 'group_id', Group),
+            (NasAbonCounters, 'nas_id', NASModel)):
+        counts = {r.pop(key_field): r for r in Abon.objects.filter(is_admin=False).exclude(
+            **{key_field: None}).order_by().values(key_field).annotate(**aggregates)}
+        counters_model.objects.bulk_create(
+            counters_model(pk=key_id, **counts.get(key_id, {}))
+            for key_id in key_model.objects.values_list('pk', flat=True)
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('group_app', '0003_auto_20180808_1236'),
+        ('gw_app', '0003_nasmodel_enabled'),
+        ('abonapp', '0008_auto_20181115_1206'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GroupAbonCounters',
+            fields=[
+                ('total', models.IntegerField(default=0, verbose_name='Number of subscribers')),
+                ('active', models.IntegerField(default=0, verbose_name='Active subscribers')),
+                ('with_tariff', models.IntegerField(default=0, verbose_name='Subscribers with service')),
+                ('debtors', models.IntegerField(default=0, verbose_name='Debtors')),
+                ('group', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='abon_counters', serialize=False, to='group_app.Group')),
+            ],
+            options={
+                'db_table': 'abon_counters_group',
+            },
+        ),
+        migrations.CreateModel(
+            name='NasAbonCounters',
+            fields=[
+                ('total', models.IntegerField(default=0, verbose_name='Number of subscribers')),
+                ('active', models.IntegerField(default=0, verbose_name='Active subscribers')),
+                ('with_tariff', models.IntegerField(default=0, verbose_name='Subscribers with service')),
+                ('debtors', models.IntegerField(default=0, verbose_name='Debtors')),
+                ('nas', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='abon_counters', serialize=False, to='gw_app.NASModel')),
+            ],
+            options={
+                'db_table': 'abon_counters_nas',
+            },
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,73 @@
+# Generated by Django 2.1 on 2026-10-19 12:00
+
+from datetime import datetime
+
+from django.db import migrations, models
+from django.db.models.functions import TruncDay, TruncMonth
+
+
+def fill_pay_stats(apps, _):
+    AllTimePayLog = apps.get_model('abonapp', 'AllTimePayLog')
+    PayDayStat = apps.get_model('abonapp', 'PayDayStat')
+    PayMonthStat = apps.get_model('abonapp', 'PayMonthStat')
+    for stat_model, trunc in ((PayDayStat, TruncDay), (PayMonthStat, TruncMonth)):
+        stat_model.objects.bulk_create(
+            stat_model(
+                date=r['period'].date() if isinstance(r['period'], datetime) else r['period'],
+                trade_point=r['trade_point'] or '',
+                pay_sum=r['pay_sum'],
+                pay_count=r['pay_count']
+            ) for r in AllTimePayLog.objects.order_by().annotate(
+                period=trunc('date_add')
+            ).values('period', 'trade_point').annotate(
+                pay_sum=models.Sum('summ'),
+                pay_count=models.Count('pk')
+            ).iterator()
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('abonapp', '0009_abon_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PayDayStat',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('trade_point', models.CharField(blank=True, default='', max_length=20, verbose_name='Trade point')),
+                ('pay_sum', models.FloatField(default=0.0, verbose_name='Sum')),
+                ('pay_count', models.IntegerField(default=0, verbose_name='Count of payments')),
+                ('date', models.DateField(verbose_name='Date')),
+            ],
+            options={
+                'db_table': 'all_time_pay_day',
+                'ordering': ('-date',),
+            },
+        ),
+        migrations.CreateModel(
+            name='PayMonthStat',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('trade_point', models.CharField(blank=True, default='', max_length=20, verbose_name='Trade point')),
+                ('pay_sum', models.FloatField(default=0.0, verbose_name='Sum')),
+                ('pay_count', models.IntegerField(default=0, verbose_name='Count of payments')),
+                ('date', models.DateField(verbose_name='Date')),
+            ],
+            options={
+                'db_table': 'all_time_pay_month',
+                'ordering': ('-date',),
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='paydaystat',
+            unique_together={('date', 'trade_point')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='paymonthstat',
+            unique_together={('date', 'trade_point')},
+        ),
+        migrations.RunPython(fill_pay_stats, migrations.RunPython.noop),
+    ]
@@ -1,19 +1,25 @@
-from datetime import datetime
+import logging
+from datetime import datetime, timedelta
+from hashlib import md5
+from time import monotonic
 from typing import Optional
 
 from accounts_app.models import UserProfile, MyUserManager, BaseAccount
 from bitfield import BitField
 from django.conf import settings
 from django.core import validators
+from django.core.cache import cache
 from django.core.validators import RegexValidator
-from django.db import models, connection, transaction
+from django.db import models, transaction, IntegrityError, DatabaseError
+from django.db.models.functions import TruncDay, TruncMonth
 from django.db.models.signals import post_delete, pre_delete, post_init, \
-    pre_save
+    pre_save, post_save
 from django.dispatch import receiver
 from django.shortcuts import resolve_url
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _, gettext
 from djing.lib import LogicError
+from djing.lib.ip_index import IpAccountIndex
 from group_app.models import Group
 from gw_app.nas_managers import SubnetQueue, NasFailedResult, NasNetworkError
 from ip_pool.models import NetworkModel
@@ -457,23 +463,34 @@ class InvoiceForPayment(models.Model):
 
 class AllTimePayLogManager(models.Manager):
     @staticmethod
-    def by_days():
-        cur = connection.cursor()
-        cur.execute(
-            'SELECT SUM(summ) AS alsum, '
-            'DATE_FORMAT(date_add, "%Y-%m-%d") AS pay_date '
-            'FROM  all_time_pay_log '
-            'GROUP BY DATE_FORMAT(date_add, "%Y-%m-%d")'
-        )
-        while True:
-            r = cur.fetchone()
-            if r is None:
-                break
-            summ, dat = r
-            yield {
-                'summ': summ,
-                'pay_date': datetime.strptime(dat, '%Y-%m-%d')
-            }
+    def by_days(date_from=None, date_to=None, trade_point=None,
+                by_month=False, by_trade_point=False):
+        """
+        Sums of payments from PayDayStat or PayMonthStat,
+        so it does not depend on size of log.
+        :param date_from: first date of report, inclusive
+        :param date_to: last date of report, inclusive
+        :param trade_point: only payments of this trade point
+        :param by_month: sums by months instead of days
+        :param by_trade_point: separate sum for each trade point
+        :return: values with pay_date, summ, count, and trade_point
+                 when by_trade_point
+        """
+        stat_model = PayMonthStat if by_month else PayDayStat
+        stats = stat_model.objects.all()
+        if date_from is not None:
+            stats = stats.filter(date__gte=date_from.replace(day=1) if by_month else date_from)
+        if date_to is not None:
+            stats = stats.filter(date__lte=date_to)
+        if trade_point is not None:
+            stats = stats.filter(trade_point=trade_point)
+        group_by = {'pay_date': models.F('date')}
+        if by_trade_point:
+            group_by['tp'] = models.F('trade_point')
+        return stats.values(**group_by).annotate(
+            summ=models.Sum('pay_sum'),
+            count=models.Sum('pay_count')
+        ).order_by(*(('-pay_date', 'tp') if by_trade_point else ('-pay_date',)))
 
 
 # Log for pay system "AllTime"
@@ -511,6 +528,40 @@ class AllTimePayLog(models.Model):
         ordering = ('-date_add',)
 
 
+class PayStatBase(models.Model):
+    trade_point = models.CharField(_('Trade point'), max_length=20, default='', blank=True)
+    pay_sum = models.FloatField(_('Sum'), default=0.0)
+    pay_count = models.IntegerField(_('Count of payments'), default=0)
+
+    class Meta:
+        abstract = True
+
+
+class PayDayStat(PayStatBase):
+    """
+    Sum of payments from AllTimePayLog for day and trade point,
+    it is updated when payment is added or removed
+    """
+    date = models.DateField(_('Date'))
+
+    class Meta:
+        db_table = 'all_time_pay_day'
+        unique_together = ('date', 'trade_point')
+        ordering = ('-date',)
+
+
+class PayMonthStat(PayStatBase):
+    """
+    The same as PayDayStat for month, date is first day of month
+    """
+    date = models.DateField(_('Date'))
+
+    class Meta:
+        db_table = 'all_time_pay_month'
+        unique_together = ('date', 'trade_point')
+        ordering = ('-date',)
+
+
 # log for all terminals
 class AllPayLog(models.Model):
     pay_id = models.CharField(max_length=64, primary_key=True)
@@ -608,11 +659,84 @@ class PeriodicPayForId(models.Model):
         ordering = ('last_pay',)
 
 
+class AbonCountersBase(models.Model):
+    total = models.IntegerField(_('Number of subscribers'), default=0)
+    active = models.IntegerField(_('Active subscribers'), default=0)
+    with_tariff = models.IntegerField(_('Subscribers with service'), default=0)
+    debtors = models.IntegerField(_('Debtors'), default=0)
+
+    class Meta:
+        abstract = True
+
+
+class GroupAbonCounters(AbonCountersBase):
+    group = models.OneToOneField(
+        Group, on_delete=models.CASCADE,
+        primary_key=True, related_name='abon_counters'
+    )
+
+    def __str__(self):
+        return "%s: %d" % (self.group_id, self.total)
+
+    class Meta:
+        db_table = 'abon_counters_group'
+
+
+class NasAbonCounters(AbonCountersBase):
+    nas = models.OneToOneField(
+        'gw_app.NASModel', on_delete=models.CASCADE,
+        primary_key=True, related_name='abon_counters'
+    )
+
+    def __str__(self):
+        return "%s: %d" % (self.nas_id, self.total)
+
+    class Meta:
+        db_table = 'abon_counters_nas'
+
+
+# Index of subscriber ip addresses, keeps in each process.
+# Changes from current process applies via signals, changes
+# from other processes will be visible after IP_INDEX_TTL seconds.
+IP_INDEX_TTL = getattr(settings, 'IP_INDEX_TTL', 300)
+_ip_index = None
+_ip_index_built = 0.0
+
+
+def get_ip_index() -> IpAccountIndex:
+    """
+    Lookup table from subscriber ip address to subscriber id
+    :return: instance of djing.lib.ip_index.IpAccountIndex
+    """
+    global _ip_index, _ip_index_built
+    now = monotonic()
+    if _ip_index is None or now - _ip_index_built > IP_INDEX_TTL:
+        pairs = Abon.objects.exclude(ip_address=None).values_list(
+            'ip_address', 'pk', 'nas_id'
+        ).iterator()
+        if _ip_index is None:
+            _ip_index = IpAccountIndex(pairs)
+        else:
+            _ip_index.rebuild(pairs)
+        _ip_index_built = now
+    return _ip_index
+
+
+@receiver(post_save, sender=Abon)
+def abon_post_save_ip_index(sender, instance, update_fields=None, **kwargs):
+    if _ip_index is None:
+        return
+    if update_fields is None or 'ip_address' in update_fields or 'nas' in update_fields:
+        _ip_index.set_account_ip(instance.pk, instance.ip_address, instance.nas_id)
+
+
 @receiver(post_delete, sender=Abon)
 def abon_del_signal(sender, **kwargs):
     abon = kwargs.get("instance")
     if abon is None:
         raise ValueError('Instance does not passed to a signal')
+    if _ip_index is not None:
+        _ip_index.remove_account(abon.pk)
     try:
         abon.nas_remove_self()
     except (NasFailedResult, NasNetworkError, LogicError):
@@ -649,3 +773,334 @@ def abontariff_pre_delete(sender, **kwargs):
         return True
     except Abon.DoesNotExist:
         print('Error: abontariff_pre_delete - user not found')
+
+
+# Counters of subscribers in groups and on nas are changed by signals
+# for each saved subscriber. Changes made by QuerySet.update(), or by
+# deleting of services, are fixed by recount_abon_counters(),
+# it is called from periodic.py.
+ABON_COUNTERS_FIELDS = ('group_id', 'nas_id', 'is_active', 'current_tariff_id', 'ballance')
+
+
+def abon_counters_aggregates() -> dict:
+    return {
+        'total': models.Count('pk'),
+        'active': models.Count('pk', filter=models.Q(is_active=True)),
+        'with_tariff': models.Count('current_tariff'),
+        'debtors': models.Count('pk', filter=models.Q(ballance__lt=0))
+    }
+
+
+def recount_abon_counters(group_ids=None, nas_ids=None) -> None:
+    """
+    Count subscribers again by aggregate query.
+    :param group_ids: ids of groups, None means all groups
+    :param nas_ids: ids of nas, None means all nas
+    """
+    from gw_app.models import NASModel
+    for counters_model, key_field, ids, key_queryset in (
+            (GroupAbonCounters, 'group_id', group_ids, Group.objects),
+            (NasAbonCounters, 'nas_id', nas_ids, NASModel.objects)):
+        if ids is None:
+            ids = key_queryset.values_list('pk', flat=True)
+            abons = Abon.objects.exclude(**{key_field: None})
+        else:
+            ids = tuple(ids)
+            abons = Abon.objects.filter(**{'%s__in' % key_field: ids})
+        counts = {r.pop(key_field): r for r in abons.order_by().values(
+            key_field).annotate(**abon_counters_aggregates())}
+        empty = dict.fromkeys(abon_counters_aggregates(), 0)
+        for key_id in ids:
+            counters_model.objects.update_or_create(
+                pk=key_id, defaults=counts.get(key_id, empty)
+            )
+
+
+def _abon_counters_state(abon: Abon) -> Optional[tuple]:
+    if abon.pk is None:
+        # not saved subscriber is not counted yet
+        return ()
+    if any(f in abon.get_deferred_fields() for f in ABON_COUNTERS_FIELDS):
+        return None
+    return (
+        abon.group_id, abon.nas_id, int(abon.is_active),
+        int(abon.current_tariff_id is not None), int(abon.ballance < 0)
+    )
+
+
+def _apply_abon_counters(old: tuple, new: tuple) -> None:
+    deltas = {}
+    for state, sign in ((old, -1), (new, 1)):
+        if not state:
+            continue
+        flags = (1,) + state[2:]
+        for counters_model, key_id in ((GroupAbonCounters, state[0]), (NasAbonCounters, state[1])):
+            if key_id is None:
+                continue
+            d = deltas.setdefault((counters_model, key_id), [0, 0, 0, 0])
+            for i, f in enumerate(flags):
+                d[i] += sign * f
+    for (counters_model, key_id), d in deltas.items():
+        if not any(d):
+            continue
+        updated = counters_model.objects.filter(pk=key_id).update(**{
+            name: models.F(name) + delta
+            for name, delta in zip(('total', 'active', 'with_tariff', 'debtors'), d)
+            if delta
+        })
+        if not updated:
+            # counters row does not exist yet
+            if counters_model is GroupAbonCounters:
+                recount_abon_counters(group_ids=(key_id,), nas_ids=())
+            else:
+                recount_abon_counters(group_ids=(), nas_ids=(key_id,))
+
+
+def add_ballance_atomic(abon_id: int, amount: float, comment: str, author=None) -> Optional[float]:
+    """
+    Add money to subscriber by one UPDATE with F expression, without
+    reading and saving of Abon, so concurrent payments are not lost.
+    Row of subscriber stays locked until end of transaction.
+    :return: new balance, or None if subscriber is not found
+    """
+    abons = Abon.objects.filter(pk=abon_id)
+    if not abons.update(ballance=models.F('ballance') + amount):
+        return
+    invalidate_pay_info(abon_id)
+    group_id, nas_id, ballance = abons.values_list('group_id', 'nas_id', 'ballance').get()
+    AbonLog.objects.create(
+        abon_id=abon_id,
+        amount=amount,
+        author=author if isinstance(author, UserProfile) else None,
+        comment=comment
+    )
+    # signals are not sent by update(), so debtors are counted here
+    was_debtor, is_debtor = ballance - amount < 0, ballance < 0
+    if was_debtor != is_debtor:
+        delta = 1 if is_debtor else -1
+        for counters_model, key_id in ((GroupAbonCounters, group_id), (NasAbonCounters, nas_id)):
+            if key_id is not None:
+                counters_model.objects.filter(pk=key_id).update(debtors=models.F('debtors') + delta)
+    return ballance
+
+
+# Info of subscriber for pay terminals, they ask it before each payment.
+# It is removed from cache when subscriber is changed.
+PAY_INFO_CACHE_TIMEOUT = getattr(settings, 'PAY_INFO_CACHE_TIMEOUT', 60)
+_PAY_INFO_KEY = 'abon_pay_info_%d'
+_PAY_INFO_USERNAME_KEY = 'abon_pay_info_u_%s'
+
+
+def get_pay_info(username: Optional[str] = None, pk: Optional[int] = None) -> tuple:
+    """
+    Read-through cache of (pk, username, fio, ballance) of subscriber.
+    Username is mapped to pk in cache, so info is invalidated by pk only.
+    :raises Abon.DoesNotExist: if subscriber is not found
+    """
+    if pk is None:
+        # keys of cache must not contain spaces and control symbols
+        username_key = _PAY_INFO_USERNAME_KEY % md5(str(username).encode()).hexdigest()
+        pk = cache.get(username_key)
+        if pk is not None:
+            info = cache.get(_PAY_INFO_KEY % pk)
+            # username could be changed after it was cached
+            if info is not None and info[1] == username:
+                return info
+        info = Abon.objects.filter(username=username).values_list(
+            'pk', 'username', 'fio', 'ballance'
+        ).get()
+        cache.set_many({
+            username_key: info[0],
+            _PAY_INFO_KEY % info[0]: info
+        }, PAY_INFO_CACHE_TIMEOUT)
+        return info
+    pk = int(pk)
+    info = cache.get(_PAY_INFO_KEY % pk)
+    if info is None:
+        info = Abon.objects.filter(pk=pk).values_list(
+            'pk', 'username', 'fio', 'ballance'
+        ).get()
+        cache.set(_PAY_INFO_KEY % pk, info, PAY_INFO_CACHE_TIMEOUT)
+    return info
+
+
+def invalidate_pay_info(abon_id: int) -> None:
+    """
+    Remove info from cache now, and after commit, so concurrent
+    request does not put old balance back to cache before commit
+    """
+    key = _PAY_INFO_KEY % abon_id
+    cache.delete(key)
+    transaction.on_commit(lambda: cache.delete(key))
+
+
+@receiver(post_init, sender=Abon)
+def abon_post_init_counters(sender, instance, **kwargs):
+    instance._counters_state = _abon_counters_state(instance)
+
+
+@receiver(post_save, sender=Abon)
+def abon_post_save_counters(sender, instance, created, update_fields=None, **kwargs):
+    if update_fields is not None and not any(
+            f in ABON_COUNTERS_FIELDS or '%s_id' % f in ABON_COUNTERS_FIELDS
+            for f in update_fields):
+        return
+    old = () if created else getattr(instance, '_counters_state', None)
+    new = _abon_counters_state(instance)
+    if old is None or new is None:
+        # previous state is unknown
+        recount_abon_counters(
+            group_ids=(instance.group_id,) if instance.group_id else (),
+            nas_ids=(instance.nas_id,) if instance.nas_id else ()
+        )
+    elif old != new:
+        _apply_abon_counters(old, new)
+    instance._counters_state = new
+
+
+@receiver(post_delete, sender=Abon)
+def abon_post_delete_counters(sender, instance, **kwargs):
+    old = getattr(instance, '_counters_state', None)
+    if old is None:
+        old = _abon_counters_state(instance)
+    if old:
+        _apply_abon_counters(old, ())
+
+
+def _pay_stat_key(pay: AllTimePayLog):
+    date_add = pay.date_add
+    if timezone.is_aware(date_add):
+        date_add = timezone.localtime(date_add)
+    trade_point = pay.trade_point
+    return date_add.date(), '' if trade_point is None else str(trade_point)
+
+
+def _add_pay_stat(pay_date, trade_point: str, summ: float, count: int) -> None:
+    for stat_model, date in ((PayDayStat, pay_date), (PayMonthStat, pay_date.replace(day=1))):
+        stats = stat_model.objects.filter(date=date, trade_point=trade_point)
+        deltas = {
+            'pay_sum': models.F('pay_sum') + summ,
+            'pay_count': models.F('pay_count') + count
+        }
+        if stats.update(**deltas):
+            if count < 0:
+                # all payments of day are removed or moved
+                stats.filter(pay_count__lte=0).delete()
+            continue
+        try:
+            with transaction.atomic():
+                stat_model.objects.create(date=date, trade_point=trade_point, pay_sum=summ, pay_count=count)
+        except IntegrityError:
+            # created by concurrent payment
+            stats.update(**deltas)
+
+
+def _add_pay_stat_on_commit(pay_date, trade_point: str, summ: float, count: int) -> None:
+    """
+    Stats are changed after commit of payment, so payments do not
+    wait each other on locks of stat rows. Lost changes are fixed
+    by recount_pay_stats in periodic.py.
+    """
+    def add():
+        try:
+            _add_pay_stat(pay_date, trade_point, summ, count)
+        except DatabaseError:
+            logging.exception('Pay stats are not changed')
+    transaction.on_commit(add)
+
+
+def recount_pay_stats(date_from=None, date_to=None) -> None:
+    """
+    Make PayDayStat and PayMonthStat again from log.
+    Dates are rounded to whole months, so both tables are filled.
+    """
+    pays = AllTimePayLog.objects.order_by()
+    days = PayDayStat.objects.all()
+    months = PayMonthStat.objects.all()
+    if date_from is not None:
+        date_from = date_from.replace(day=1)
+        pays = pays.filter(date_add__date__gte=date_from)
+        days = days.filter(date__gte=date_from)
+        months = months.filter(date__gte=date_from)
+    if date_to is not None:
+        # last day of month
+        date_to = (date_to.replace(day=1) + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+        pays = pays.filter(date_add__date__lte=date_to)
+        days = days.filter(date__lte=date_to)
+        months = months.filter(date__lte=date_to)
+    with transaction.atomic():
+        days.delete()
+        months.delete()
+        for stat_model, trunc in ((PayDayStat, TruncDay), (PayMonthStat, TruncMonth)):
+            stat_model.objects.bulk_create(
+                stat_model(
+                    date=r['period'].date() if isinstance(r['period'], datetime) else r['period'],
+                    trade_point=r['trade_point'] or '',
+                    pay_sum=r['pay_sum'],
+                    pay_count=r['pay_count']
+                ) for r in pays.annotate(period=trunc('date_add')).values(
+                    'period', 'trade_point'
+                ).annotate(
+                    pay_sum=models.Sum('summ'),
+                    pay_count=models.Count('pk')
+                ).iterator()
+            )
+
+
+PAY_STAT_FIELDS = ('date_add', 'summ', 'trade_point')
+
+
+def _pay_stat_state(pay: AllTimePayLog):
+    """
+    :return: date, trade point and sum of payment in stats,
+             or None if payment is not saved or fields are deferred
+    """
+    if any(f not in pay.__dict__ for f in PAY_STAT_FIELDS) or pay.date_add is None:
+        return
+    pay_date, trade_point = _pay_stat_key(pay)
+    return pay_date, trade_point, pay.summ
+
+
+@receiver(post_init, sender=AllTimePayLog)
+def all_time_pay_log_post_init(sender, instance, **kwargs):
+    instance._pay_stat_state = _pay_stat_state(instance)
+
+
+@receiver(post_save, sender=AllTimePayLog)
+def all_time_pay_log_post_save(sender, instance, created, raw=False, update_fields=None, **kwargs):
+    if raw:
+        return
+    if update_fields is not None and not any(f in PAY_STAT_FIELDS for f in update_fields):
+        return
+    new = _pay_stat_state(instance)
+    if new is None:
+        # some fields are deferred
+        new = _pay_stat_state(sender.objects.get(pk=instance.pk))
+    if created:
+        _add_pay_stat_on_commit(new[0], new[1], new[2], 1)
+    else:
+        old = getattr(instance, '_pay_stat_state', None)
+        if old is None:
+            # previous state is unknown
+            transaction.on_commit(lambda: recount_pay_stats(new[0], new[0]))
+        elif old != new:
+            _add_pay_stat_on_commit(old[0], old[1], -old[2], -1)
+            _add_pay_stat_on_commit(new[0], new[1], new[2], 1)
+    instance._pay_stat_state = new
+
+
+@receiver(post_delete, sender=AllTimePayLog)
+def all_time_pay_log_post_delete(sender, instance, **kwargs):
+    pay_date, trade_point = _pay_stat_key(instance)
+    _add_pay_stat_on_commit(pay_date, trade_point, -instance.summ, -1)
+
+
+@receiver(post_save, sender=Abon)
+def abon_post_save_pay_info(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None or any(f in ('username', 'fio', 'ballance') for f in update_fields):
+        invalidate_pay_info(instance.pk)
+
+
+@receiver(post_delete, sender=Abon)
+def abon_post_delete_pay_info(sender, instance, **kwargs):
+    invalidate_pay_info(instance.pk)
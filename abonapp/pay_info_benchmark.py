@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Latency of subscriber info request (ACT=1) of pay terminal,
+with cold cache, as it was without cache, and with warm cache.
+Run: python3 -m abonapp.pay_info_benchmark <username> [count of requests]
+"""
+import os
+import sys
+from hashlib import md5
+from time import perf_counter
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "djing.settings")
+django.setup()
+from django.conf import settings
+from django.db import connection, reset_queries
+from django.test import RequestFactory
+from abonapp.models import get_pay_info, invalidate_pay_info
+from abonapp.pay_systems import allpay
+
+
+def _request(username: str):
+    serv_id = getattr(settings, 'PAY_SERV_ID')
+    pay_id = '00000000-0000-0000-0000-000000000000'
+    sign = md5('_'.join(('1', username, serv_id, pay_id, getattr(settings, 'PAY_SECRET'))).encode()).hexdigest()
+    return RequestFactory().get('/', {
+        'ACT': 1,
+        'PAY_ACCOUNT': username,
+        'SERVICE_ID': serv_id,
+        'PAY_ID': pay_id,
+        'SIGN': sign
+    })
+
+
+def _percentile(times: list, p: int) -> float:
+    times = sorted(times)
+    return times[min(len(times) - 1, len(times) * p // 100)] * 1000
+
+
+def bench(username: str, count: int, warm: bool):
+    request = _request(username)
+    abon_id = get_pay_info(username=username)[0]
+    times = []
+    queries = 0
+    connection.force_debug_cursor = True
+    for _ in range(count):
+        if not warm:
+            invalidate_pay_info(abon_id)
+        reset_queries()
+        t = perf_counter()
+        allpay(request)
+        times.append(perf_counter() - t)
+        queries += len(connection.queries)
+    connection.force_debug_cursor = False
+    print('%-10s p50: %7.3f ms, p99: %7.3f ms, queries per request: %.1f' % (
+        'warm cache' if warm else 'cold cache',
+        _percentile(times, 50), _percentile(times, 99), queries / count))
+
+
+def main(username: str, count: int):
+    bench(username, count, warm=False)
+    bench(username, count, warm=True)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    main(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 1000)
@@ -1,12 +1,43 @@
 from hashlib import md5
+from typing import Optional
 from django.utils import timezone
 from djing.lib import safe_int, safe_float
-from .models import Abon, AllTimePayLog
-from django.db import DatabaseError
+from .models import Abon, AllTimePayLog, add_ballance_atomic, get_pay_info
+from django.db import DatabaseError, IntegrityError, transaction
 from django.conf import settings
 from xmlview.decorators import xml_view
 
 
+def make_payment(pay_id: str, abon_id: int, amount: float, comment: str,
+                 trade_point=None, receipt_num=0) -> Optional[AllTimePayLog]:
+    """
+    Idempotent payment. Insert of unique pay_id is the guard from
+    double payment, when terminal retries or sends it concurrently:
+    the second insert waits for the first transaction and fails,
+    and its change of balance is rolled back.
+    Balance is changed by atomic update before insert, so row of
+    subscriber is locked first and concurrent payments do not deadlock.
+    :param abon_id: id of subscriber
+    :return: new payment, or None if pay_id is already paid
+    :raises IntegrityError: when insert fails not by duplicate pay_id
+    """
+    try:
+        with transaction.atomic():
+            if add_ballance_atomic(abon_id, amount, comment) is None:
+                raise Abon.DoesNotExist
+            return AllTimePayLog.objects.create(
+                pay_id=pay_id,
+                summ=amount,
+                abon_id=abon_id,
+                trade_point=trade_point,
+                receipt_num=receipt_num
+            )
+    except IntegrityError:
+        if AllTimePayLog.objects.filter(pay_id=pay_id).exists():
+            return
+        raise
+
+
 @xml_view(root_node='pay-response')
 def allpay(request):
     def bad_ret(err_id, err_description=None):
@@ -40,11 +71,9 @@ def allpay(request):
             return bad_ret(-101)
 
         if act == 1:
-            abon = Abon.objects.get(username=pay_account)
-            fio = abon.fio
-            ballance = float(abon.ballance)
+            abon_id, username, fio, ballance = get_pay_info(username=pay_account)
             return {
-                'balance': ballance,
+                'balance': float(ballance),
                 'name': fio,
                 'account': pay_account,
                 'service_id': getattr(settings, 'PAY_SERV_ID'),
@@ -56,21 +85,15 @@ def allpay(request):
         elif act == 4:
             trade_point = safe_int(request.GET.get('TRADE_POINT'))
             receipt_num = safe_int(request.GET.get('RECEIPT_NUM'))
-            abon = Abon.objects.get(username=pay_account)
-            pays = AllTimePayLog.objects.filter(pay_id=pay_id)
-            if pays.count() > 0:
-                return bad_ret(-100)
-
-            abon.add_ballance(None, pay_amount, comment='AllPay %.2f' % pay_amount)
-            abon.save(update_fields=('ballance',))
-
-            AllTimePayLog.objects.create(
-                pay_id=pay_id,
-                summ=pay_amount,
-                abon=abon,
+            abon_id = Abon.objects.filter(username=pay_account).values_list('pk', flat=True).get()
+            pay = make_payment(
+                pay_id, abon_id, pay_amount,
+                comment='AllPay %.2f' % pay_amount,
                 trade_point=trade_point,
                 receipt_num=receipt_num
             )
+            if pay is None:
+                return bad_ret(-100)
             return {
                 'pay_id': pay_id,
                 'service_id': serv_id,
@@ -0,0 +1,70 @@
+from itertools import chain
+from typing import Iterable, Optional, Tuple
+
+from celery import shared_task
+from django.conf import settings
+
+from abonapp.models import Abon, AdditionalTelephone, AllTimePayLog
+from djing.lib.export import export_file_path, export_to_file, \
+    iter_by_pk, new_export_token, remove_old_exports
+
+
+# Exports with more rows than this are made by celery into file,
+# that user downloads when it is ready
+EXPORT_BACKGROUND_ROWS = getattr(settings, 'EXPORT_BACKGROUND_ROWS', 50000)
+
+ExportType = Tuple[Optional[list], Iterable]
+
+
+def subscribers_export(gid: int, fields: Iterable[str]) -> ExportType:
+    from abonapp.forms import ExportUsersForm
+    choices = ExportUsersForm.FIELDS_CHOICES
+    # order of columns must be the same as order of header
+    fields = tuple(name for name, label in choices if name in fields)
+    header = [str(label) for name, label in choices if name in fields]
+    return header, iter_by_pk(Abon.objects.filter(group__id=gid), *fields)
+
+
+def phonebook_export(gid: int) -> ExportType:
+    return None, chain(
+        iter_by_pk(Abon.objects.filter(group__id=gid), 'telephone', 'fio'),
+        iter_by_pk(AdditionalTelephone.objects.filter(abon__group__id=gid), 'telephone', 'owner_name')
+    )
+
+
+def fin_report_export(**params) -> ExportType:
+    """
+    :param params: kwargs for AllTimePayLog.objects.by_days
+    Rows are sums by days or months, so there are not many of them.
+    """
+    date_format = '%Y-%m' if params.get('by_month') else '%Y-%m-%d'
+    by_trade_point = params.get('by_trade_point')
+    return None, (
+        (row['summ'], row['pay_date'].strftime(date_format), row['tp']) if by_trade_point else
+        (row['summ'], row['pay_date'].strftime(date_format))
+        for row in AllTimePayLog.objects.by_days(**params).iterator()
+    )
+
+
+EXPORT_SOURCES = {
+    'subscribers': subscribers_export,
+    'phonebook': phonebook_export,
+    'fin_report': fin_report_export
+}
+
+
+@shared_task
+def export_job(user_id: int, token: str, source: str, fmt: str, params: dict):
+    header, rows = EXPORT_SOURCES[source](**params)
+    export_to_file(export_file_path(user_id, token, fmt), rows, fmt, header)
+
+
+def start_export(user_id: int, source: str, fmt: str, params: dict) -> str:
+    """
+    Run export in celery
+    :return: token of export file, for abonapp:export_download
+    """
+    remove_old_exports(user_id)
+    token = new_export_token()
+    export_job.delay(user_id, token, source, fmt, params)
+    return token
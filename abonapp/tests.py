@@ -1,21 +1,38 @@
+import csv
+import json
 from abc import ABCMeta
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import TemporaryDirectory
+from unittest import mock, skipIf
 from hashlib import md5
-from datetime import date
+from io import BytesIO
+from zipfile import ZipFile
+from datetime import date, datetime
+from ipaddress import ip_address
 
 from accounts_app.models import UserProfile
 from django.shortcuts import resolve_url
-from django.test import TestCase, RequestFactory
+from django.core.cache import cache
+from django.db import connection, IntegrityError
+from django.test import TestCase, TransactionTestCase, RequestFactory, override_settings
 from django.conf import settings
 from django.utils import timezone
 from django.utils.html import escape
 from django.utils.translation import gettext_lazy as _
 from xmltodict import parse
 
-from abonapp.models import Abon, AbonStreet, PassportInfo
-from abonapp.pay_systems import allpay
+from abonapp.models import Abon, AbonStreet, PassportInfo, get_ip_index, \
+    GroupAbonCounters, recount_abon_counters, AbonLog, AllTimePayLog, \
+    PayDayStat, recount_pay_stats, get_pay_info
+from abonapp.pay_systems import allpay, make_payment
 from group_app.models import Group
 from tariff_app.models import Tariff
 from ip_pool.models import NetworkModel
+from djing.lib import calc_hash
+from djing.lib.ip_index import IpAccountIndex
+from djing.lib.keyset_paginator import KeysetPaginator
+from djing.lib.export import export_file_path, export_to_file, iter_by_pk, new_export_token
+from abonapp.tasks import subscribers_export
 
 rf = RequestFactory()
 
@@ -505,6 +522,26 @@ class ClientLeasesTestCase(MyBaseTestCase, TestCase):
         ip_addr = updated_abon.ip_addresses.all().first()
         self.assertEqual('192.168.0.3', ip_addr.ip)
 
+    def test_attach_ips(self):
+        print('test_attach_ips')
+        url = resolve_url('abonapp:attach_ips', gid=self.group.pk)
+        self._client_get_check_login(url)
+        other = Abon.objects.create_user(
+            telephone='+79781234568',
+            username='other',
+            password='passw1'
+        )
+        other.group = self.group
+        other.save(update_fields=('group',))
+        r = self.client.post(url, data={'network': self.network.pk})
+        self.assertRedirects(r, resolve_url('abonapp:group_list'))
+        self.assertSetEqual(set(Abon.objects.filter(group=self.group).values_list('ip_address', flat=True)), {
+            '192.168.0.3', '192.168.0.4'
+        })
+        # reserved addresses are kept in db, and are not given twice
+        cache.clear()
+        self.assertEqual([str(ip) for ip in self.network.allocate_ips(5)], ['192.168.0.5', '192.168.0.6'])
+
     def test_add_static_ipv6_lease(self):
         print('test_add_static_ipv6_lease')
         url = resolve_url('abonapp:lease_add', gid=self.group.pk, uname=self.abon.username)
@@ -559,3 +596,372 @@ class ClientLeasesTestCase(MyBaseTestCase, TestCase):
         updated_abon = Abon.objects.get(username=self.abon.username)
         ip_addr = updated_abon.ip_addresses.all().first()
         self.assertEqual('fde8:86a9:f132:1::7', ip_addr.ip)
+
+
+class IpIndexTestCase(MyBaseTestCase, TestCase):
+    def test_index_follows_ip_changes(self):
+        print('test_index_follows_ip_changes')
+        ip_index = get_ip_index()
+        self.assertIsNone(ip_index.get('10.0.0.2'))
+        self.abon.attach_ip_addr('10.0.0.2')
+        self.assertEqual(ip_index.get('10.0.0.2'), self.abon.pk)
+        self.abon.attach_ip_addr('10.0.0.3')
+        self.assertIsNone(ip_index.get('10.0.0.2'))
+        self.assertEqual(ip_index.get('10.0.0.3'), self.abon.pk)
+        self.assertEqual(
+            tuple(ip_index.attribute((int(ip_address('10.0.0.3')), 1))),
+            (self.abon.pk, 0)
+        )
+        self.abon.free_ip_addr()
+        self.assertNotIn('10.0.0.3', ip_index)
+
+    def test_same_ip_on_different_nas(self):
+        print('test_same_ip_on_different_nas')
+        ip_index = IpAccountIndex([('10.0.0.2', 1, 1), ('10.0.0.2', 2, 2)])
+        self.assertEqual(ip_index.get_all('10.0.0.2'), [1, 2])
+        self.assertEqual(ip_index.get('10.0.0.2', nas_id=2), 2)
+        ip_index.set_account_ip(1, '10.0.0.3', 1)
+        self.assertEqual(ip_index.get_all('10.0.0.2'), [2])
+        ip_index.set_account_ip(3, '10.0.0.2', 1)
+        self.assertEqual(ip_index.get('10.0.0.2', nas_id=2), 2)
+        self.assertEqual(ip_index.get('10.0.0.2', nas_id=1), 3)
+
+
+class AbonCountersTestCase(MyBaseTestCase, TestCase):
+    def counters(self, group):
+        c = GroupAbonCounters.objects.get(pk=group.pk)
+        return c.total, c.active, c.with_tariff, c.debtors
+
+    def test_counters_follow_changes(self):
+        print('test_counters_follow_changes')
+        self.assertEqual(self.counters(self.group), (1, 1, 0, 0))
+        self.abon.ballance = -10
+        self.abon.save(update_fields=('ballance',))
+        self.assertEqual(self.counters(self.group), (1, 1, 0, 1))
+
+        abon2 = Abon.objects.create_user(
+            telephone='+79781234568',
+            username='abon2',
+            password='passw2'
+        )
+        abon2.group = self.group
+        abon2.is_active = False
+        abon2.save()
+        self.assertEqual(self.counters(self.group), (2, 1, 0, 1))
+
+        grp2 = Group.objects.create(title='Grp2')
+        abon2.group = grp2
+        abon2.save(update_fields=('group',))
+        self.assertEqual(self.counters(self.group), (1, 1, 0, 1))
+        self.assertEqual(self.counters(grp2), (1, 0, 0, 0))
+        abon2.delete()
+        self.assertEqual(self.counters(grp2), (0, 0, 0, 0))
+
+        # signals do not see update(), recount fixes counters
+        Abon.objects.filter(pk=self.abon.pk).update(ballance=5)
+        recount_abon_counters()
+        self.assertEqual(self.counters(self.group), (1, 1, 0, 0))
+
+
+class KeysetPaginationTestCase(MyBaseTestCase, TestCase):
+    def setUp(self):
+        super(KeysetPaginationTestCase, self).setUp()
+        # same date in all rows, order is kept only by pk
+        date = timezone.now()
+        AbonLog.objects.bulk_create(
+            AbonLog(abon=self.abon, amount=i, comment='log %d' % i) for i in range(23)
+        )
+        AbonLog.objects.update(date=date)
+        self.expected = list(AbonLog.objects.order_by('-date', 'pk').values_list('pk', flat=True))
+
+    def test_walk_by_cursors(self):
+        print('test_walk_by_cursors')
+        paginator = KeysetPaginator(AbonLog.objects.all(), 5)
+        self.assertEqual(paginator.num_pages, 5)
+        page = paginator.page(1)
+        pages = [[l.pk for l in page]]
+        while page.has_next():
+            page = paginator.page(page.next_page_number(), page.next_cursor)
+            pages.append([l.pk for l in page])
+        self.assertEqual(sum(pages, []), self.expected)
+        self.assertEqual(page.number, 5)
+
+        # back from last page
+        while page.has_previous():
+            page = paginator.page(page.previous_page_number(), page.previous_cursor)
+            self.assertEqual([l.pk for l in page], pages[page.number - 1])
+
+    def test_last_page_and_stale_cursor(self):
+        print('test_last_page_and_stale_cursor')
+        paginator = KeysetPaginator(AbonLog.objects.all(), 5)
+        page = paginator.page(paginator.num_pages)
+        self.assertEqual([l.pk for l in page], self.expected[20:])
+        self.assertFalse(page.has_next())
+        # cursor of other page is ignored, page is fetched by offset
+        page = paginator.page(2, page.previous_cursor)
+        self.assertEqual([l.pk for l in page], self.expected[5:10])
+
+    def test_nullable_ordering(self):
+        print('test_nullable_ordering')
+        # rows with NULL in key are not lost, they are fetched by offset
+        AbonLog.objects.filter(pk__in=self.expected[::2]).update(author=self.adminuser)
+        qs = AbonLog.objects.order_by('-author__username')
+        expected = list(qs.order_by('-author__username', 'pk').values_list('pk', flat=True))
+        paginator = KeysetPaginator(qs, 5)
+        self.assertFalse(paginator.seekable)
+        page = paginator.page(1)
+        pages = [l.pk for l in page]
+        while page.has_next():
+            self.assertIsNone(page.next_cursor)
+            page = paginator.page(page.next_page_number(), page.next_cursor)
+            pages.extend(l.pk for l in page)
+        self.assertEqual(pages, expected)
+        self.assertTrue(KeysetPaginator(AbonLog.objects.all(), 5).seekable)
+
+    def test_log_view(self):
+        print('test_log_view')
+        r = self._client_get_check_login(resolve_url('abonapp:log'))
+        page = r.context['page_obj']
+        self.assertEqual(len(page.object_list), min(23, page.paginator.per_page))
+        r = self.client.get(resolve_url('abonapp:log'), {'page': 'last'})
+        self.assertEqual(r.status_code, 200)
+        self.assertFalse(r.context['page_obj'].has_next())
+
+
+class ExportTestCase(MyBaseTestCase, TestCase):
+    def setUp(self):
+        super(ExportTestCase, self).setUp()
+        # files of exports are not left in repository
+        export_dir = TemporaryDirectory()
+        self.addCleanup(export_dir.cleanup)
+        patcher = mock.patch('djing.lib.export.EXPORT_DIR', export_dir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_iter_by_pk(self):
+        print('test_iter_by_pk')
+        for i in range(4):
+            Abon.objects.create_user(
+                telephone='+7978123450%d' % i,
+                username='abon%d' % i,
+                password='passw1'
+            )
+        expected = list(Abon.objects.order_by('pk').values_list('username'))
+        self.assertEqual(len(expected), 5)
+        for chunk_size in (1, 2, 5, 10):
+            self.assertEqual(list(iter_by_pk(Abon.objects.all(), 'username', chunk_size=chunk_size)), expected)
+
+    def test_stream_csv(self):
+        print('test_stream_csv')
+        url = resolve_url('abonapp:abon_export', self.group.pk)
+        self.client.force_login(self.adminuser)
+        r = self.client.post('%s?f=csv' % url, data={'fields': ('telephone', 'username')})
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(r.streaming)
+        rows = list(csv.reader(b''.join(r.streaming_content).decode().splitlines()))
+        self.assertEqual(len(rows), 2)
+        # columns go in order of form choices
+        self.assertEqual(rows[1], ['abon', '+79781234567'])
+
+    def test_stream_xlsx(self):
+        print('test_stream_xlsx')
+        url = resolve_url('abonapp:phonebook', self.group.pk)
+        self.client.force_login(self.adminuser)
+        r = self.client.get(url, {'f': 'xlsx'})
+        self.assertEqual(r.status_code, 200)
+        zf = ZipFile(BytesIO(b''.join(r.streaming_content)))
+        sheet = zf.read('xl/worksheets/sheet1.xml').decode()
+        self.assertIn('+79781234567', sheet)
+
+    def test_download_background_export(self):
+        print('test_download_background_export')
+        token = new_export_token()
+        url = resolve_url('abonapp:export_download', token, 'csv')
+        self.client.force_login(self.adminuser)
+        r = self.client.get(url)
+        self.assertEqual(r.status_code, 200)
+        self.assertTemplateUsed(r, 'abonapp/export_wait.html')
+
+        header, rows = subscribers_export(self.group.pk, ('username',))
+        path = export_file_path(self.adminuser.pk, token, 'csv')
+        export_to_file(path, rows, 'csv', header)
+        r = self.client.get(url)
+        self.assertEqual(b''.join(r.streaming_content).decode().splitlines()[1], '"abon"')
+        r.close()
+
+
+# stats are changed on commit of payment
+class PayStatTestCase(MyBaseTestCase, TransactionTestCase):
+    def report(self, **kwargs):
+        return [
+            (r['pay_date'], r.get('tp'), round(r['summ'], 2), r['count'])
+            for r in AllTimePayLog.objects.by_days(**kwargs)
+        ]
+
+    def test_stats_follow_pays(self):
+        print('test_stats_follow_pays')
+        today = timezone.now().date()
+        for pay_id, summ, tp in (('p1', 10.5, 'tp1'), ('p2', 2, 'tp2'), ('p3', 3, 'tp1')):
+            AllTimePayLog.objects.create(pay_id=pay_id, summ=summ, abon=self.abon, trade_point=tp)
+        self.assertEqual(self.report(), [(today, None, 15.5, 3)])
+        self.assertEqual(self.report(by_trade_point=True), [
+            (today, 'tp1', 13.5, 2), (today, 'tp2', 2.0, 1)
+        ])
+        self.assertEqual(self.report(trade_point='tp2'), [(today, None, 2.0, 1)])
+        self.assertEqual(self.report(by_month=True), [(today.replace(day=1), None, 15.5, 3)])
+        self.assertEqual(self.report(date_to=date(2000, 1, 1)), [])
+
+        AllTimePayLog.objects.get(pay_id='p1').delete()
+        self.assertEqual(self.report(), [(today, None, 5.0, 2)])
+
+        PayDayStat.objects.all().delete()
+        recount_pay_stats()
+        self.assertEqual(self.report(by_trade_point=True), [
+            (today, 'tp1', 3.0, 1), (today, 'tp2', 2.0, 1)
+        ])
+
+    def test_stats_follow_changed_pays(self):
+        print('test_stats_follow_changed_pays')
+        today = timezone.now().date()
+        old_day = date(2018, 3, 15)
+        pay = AllTimePayLog.objects.create(pay_id='p1', summ=10, abon=self.abon, trade_point='tp1')
+        pay.summ = 7
+        pay.save(update_fields=('summ',))
+        self.assertEqual(self.report(), [(today, None, 7.0, 1)])
+
+        pay.date_add = datetime.combine(old_day, datetime.min.time())
+        pay.trade_point = 'tp2'
+        pay.save()
+        self.assertEqual(self.report(by_trade_point=True), [(old_day, 'tp2', 7.0, 1)])
+
+        # fields are deferred, previous state is unknown
+        pay = AllTimePayLog.objects.only('pay_id').get(pay_id='p1')
+        pay.summ = 3
+        pay.save(update_fields=('summ',))
+        self.assertEqual(self.report(), [(old_day, None, 3.0, 1)])
+        self.assertEqual(self.report(by_month=True), [(old_day.replace(day=1), None, 3.0, 1)])
+
+    def test_recount_whole_months(self):
+        print('test_recount_whole_months')
+        pay = AllTimePayLog.objects.create(pay_id='p1', summ=10, abon=self.abon)
+        pay.date_add = datetime(2018, 3, 25, 12)
+        pay.save()
+        PayDayStat.objects.all().delete()
+        # date_to is rounded up to the end of its month
+        recount_pay_stats(date(2018, 3, 10), date(2018, 3, 10))
+        self.assertEqual(self.report(), [(date(2018, 3, 25), None, 10.0, 1)])
+        self.assertEqual(self.report(by_month=True), [(date(2018, 3, 1), None, 10.0, 1)])
+
+
+@override_settings(API_AUTH_SECRET='test_secret', API_AUTH_SUBNET='127.0.0.1')
+class PaymentTestCase(MyBaseTestCase, TestCase):
+    def ballance(self):
+        return Abon.objects.get(pk=self.abon.pk).ballance
+
+    def test_payment_is_idempotent(self):
+        print('test_payment_is_idempotent')
+        self.assertIsNotNone(make_payment('pay1', self.abon.pk, 12.5, comment='Test'))
+        self.assertIsNone(make_payment('pay1', self.abon.pk, 12.5, comment='Test'))
+        self.assertEqual(self.ballance(), 12.5)
+        self.assertEqual(AbonLog.objects.filter(abon=self.abon).count(), 1)
+
+        # debtor counter follows atomic update
+        make_payment('pay2', self.abon.pk, -20, comment='Test')
+        self.assertEqual(GroupAbonCounters.objects.get(pk=self.group.pk).debtors, 1)
+
+    def test_reconcile(self):
+        print('test_reconcile')
+        make_payment('pay1', self.abon.pk, 10, comment='Test')
+        body = json.dumps([
+            {'pay_id': 'pay1', 'account': 'abon', 'amount': 11},
+            {'pay_id': 'pay2', 'account': 'abon', 'amount': 5, 'trade_point': 7},
+            {'pay_id': 'pay3', 'account': 'nobody', 'amount': 5},
+            {'account': 'abon'},
+            {'pay_id': 'pay4', 'account': 'abon'},
+            {'pay_id': 'pay5', 'account': 'abon', 'amount': 'abc'},
+            {'pay_id': 'pay6', 'account': 'abon', 'amount': -5},
+            {'pay_id': 'pay7', 'account': 'abon', 'amount': '2.5'}
+        ])
+        sign = calc_hash('_'.join((calc_hash(body), 'test_secret')))
+        url = resolve_url('abonapp:pay_reconcile')
+        r = self.client.post('%s?sign=%s' % (url, sign), data=body,
+                             content_type='application/json')
+        self.assertEqual(r.status_code, 200)
+        res = r.json()
+        self.assertEqual(res['created'], ['pay2', 'pay7'])
+        self.assertEqual(res['exists_count'], 1)
+        self.assertEqual(res['mismatch'][0]['pay_id'], 'pay1')
+        # not found account, missing pay_id and 3 bad amounts
+        self.assertEqual(len(res['errors']), 5)
+        self.assertEqual(self.ballance(), 17.5)
+
+    def test_payment_integrity_error(self):
+        print('test_payment_integrity_error')
+        # error is not about duplicate pay_id, so it is not hidden
+        with mock.patch.object(AllTimePayLog.objects, 'create', side_effect=IntegrityError('Bad value')):
+            with self.assertRaises(IntegrityError):
+                make_payment('pay1', self.abon.pk, 12.5, comment='Test')
+        self.assertEqual(self.ballance(), 0)
+
+
+class PayInfoCacheTestCase(MyBaseTestCase, TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    def test_pay_info_cache(self):
+        print('test_pay_info_cache')
+        info = get_pay_info(username='abon')
+        self.assertEqual(info[0], self.abon.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_pay_info(username='abon'), info)
+            self.assertEqual(get_pay_info(pk=self.abon.pk), info)
+        with self.assertRaises(Abon.DoesNotExist):
+            get_pay_info(username='nobody')
+
+    def test_pay_info_invalidation(self):
+        print('test_pay_info_invalidation')
+        get_pay_info(username='abon')
+        make_payment('pay1', self.abon.pk, 12.5, comment='Test')
+        self.assertEqual(get_pay_info(username='abon')[3], 12.5)
+        abon = Abon.objects.get(pk=self.abon.pk)
+        abon.fio = 'New fio'
+        abon.save(update_fields=('fio',))
+        self.assertEqual(get_pay_info(pk=self.abon.pk)[2], 'New fio')
+
+
+@skipIf(connection.vendor == 'sqlite', 'sqlite does not allow concurrent writes')
+class PaymentConcurrencyTestCase(TransactionTestCase):
+    threads = 8
+    pays = 50
+
+    def setUp(self):
+        self.abon = Abon.objects.create_user(
+            telephone='+79781234567',
+            username='abon',
+            password='passw1'
+        )
+
+    def _pay_all(self, thread_num: int) -> int:
+        created = 0
+        try:
+            # each thread goes in own order, so it races with others for each pay_id
+            for i in range(self.pays):
+                n = (i + thread_num * 7) % self.pays
+                if make_payment('pay%d' % n, self.abon.pk, n + 1, comment='Stress'):
+                    created += 1
+        finally:
+            connection.close()
+        return created
+
+    def test_concurrent_retries(self):
+        print('test_concurrent_retries')
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            created = sum(executor.map(self._pay_all, range(self.threads)))
+        self.assertEqual(created, self.pays)
+        self.assertEqual(AllTimePayLog.objects.count(), self.pays)
+        self.assertEqual(AbonLog.objects.filter(abon=self.abon).count(), self.pays)
+        self.assertEqual(
+            Abon.objects.get(pk=self.abon.pk).ballance,
+            sum(range(1, self.pays + 1))
+        )
@@ -45,12 +45,14 @@ group_patterns = [
     path('street/<int:sid>/delete/', views.street_del, name='street_del'),
     path('active_networks/', views.active_nets, name='active_nets'),
     path('attach_nas/', views.attach_nas, name='attach_nas'),
+    path('attach_ips/', views.attach_ips, name='attach_ips'),
     re_path('^(?P<uname>\w{1,127})/', include(subscriber_patterns))
 ]
 
 urlpatterns = [
     path('', views.GroupListView.as_view(), name='group_list'),
     path('fin_report/', views.fin_report, name='fin_report'),
+    path('export/<str:token>/<str:fmt>/', views.export_download, name='export_download'),
     path('<int:gid>/', include(group_patterns)),
     path('log/', views.LogListView.as_view(), name='log'),
     path('pay/', views.terminal_pay, name='terminal_pay'),
@@ -61,5 +63,6 @@ urlpatterns = [
     path('api/abons/', views.abons),
     path('api/abon_filter/', views.search_abon),
     path('api/dhcp_lever/', views.DhcpLever.as_view()),
-    path('api/duplicate_pay/', views.DublicatePay.as_view())
+    path('api/duplicate_pay/', views.DublicatePay.as_view()),
+    path('api/pay_reconcile/', views.PayReconcile.as_view(), name='pay_reconcile')
 ]
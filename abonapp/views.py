@@ -1,4 +1,7 @@
+import json
+import os
 from datetime import datetime
+from math import isfinite
 from typing import Dict, Optional
 
 from agent.commands.dhcp import dhcp_commit, dhcp_expiry, dhcp_release
@@ -12,19 +15,21 @@ from django.contrib.auth.mixins import LoginRequiredMixin, \
 from django.core.exceptions import PermissionDenied, ValidationError
 from django.db import IntegrityError, ProgrammingError, transaction, \
     DatabaseError
-from django.db.models import Count, Q
+from django.db.models import Q
 from django.http import HttpResponse, HttpResponseBadRequest, \
-    HttpResponseRedirect
+    HttpResponseRedirect, FileResponse, Http404
 from django.shortcuts import render, redirect, get_object_or_404, resolve_url
 from django.urls import reverse_lazy
 from django.utils import timezone
 from django.utils.decorators import method_decorator
+from django.views.decorators.csrf import csrf_exempt
 from django.utils.translation import gettext_lazy as _
 from django.views.generic import ListView, UpdateView, CreateView, DeleteView
 from djing import lib
 from djing import ping
 from djing.global_base_views import OrderedFilteredList, SecureApiView
 from djing.lib.decorators import json_view, only_admins
+from djing.lib.export import FORMATS as EXPORT_FORMATS, export_response, export_file_path
 from djing.lib.mixins import OnlyAdminsMixin, LoginAdminPermissionMixin, LoginAdminMixin
 from group_app.models import Group
 from guardian.decorators import \
@@ -33,16 +38,21 @@ from guardian.shortcuts import get_objects_for_user, assign_perm
 from gw_app.models import NASModel
 from gw_app.nas_managers import NasFailedResult, NasNetworkError
 from ip_pool.models import NetworkModel
+from searchapp.models import SearchEntry, KIND_ABON, load_found
 from tariff_app.models import Tariff
 from taskapp.models import Task
 from xmlview.decorators import xml_view
 from . import forms
 from . import models
+from .pay_systems import make_payment
+from .tasks import EXPORT_BACKGROUND_ROWS, EXPORT_SOURCES, start_export, \
+    phonebook_export, fin_report_export
 
 
 class PeoplesListView(LoginRequiredMixin, OnlyAdminsMixin,
                       OrderedFilteredList):
     template_name = 'abonapp/peoples.html'
+    keyset_pagination = True
 
     def get_queryset(self):
         street_id = lib.safe_int(self.request.GET.get('street'))
@@ -83,7 +93,7 @@ class PeoplesListView(LoginRequiredMixin, OnlyAdminsMixin,
 class GroupListView(LoginRequiredMixin, OnlyAdminsMixin, OrderedFilteredList):
     context_object_name = 'groups'
     template_name = 'abonapp/group_list.html'
-    queryset = Group.objects.annotate(usercount=Count('abon'))
+    queryset = Group.objects.select_related('abon_counters')
 
     def get_queryset(self):
         queryset = super(GroupListView, self).get_queryset()
@@ -254,6 +264,7 @@ class PayHistoryListView(LoginAdminPermissionMixin, OrderedFilteredList):
     permission_required = 'group_app.view_group'
     context_object_name = 'pay_history'
     template_name = 'abonapp/payHistory.html'
+    keyset_pagination = True
 
     def get_permission_object(self):
         if hasattr(self, 'abon'):
@@ -380,7 +391,6 @@ class AbonHomeUpdateView(LoginAdminMixin, PermissionRequiredMixin, UpdateView):
         return super(AbonHomeUpdateView, self).get_context_data(**context)
 
 
-@transaction.atomic
 def terminal_pay(request):
     from .pay_systems import allpay
     ret_text = allpay(request)
@@ -501,13 +511,14 @@ def unsubscribe_service(request, gid: int, uname, abon_tariff_id: int):
     return redirect('abonapp:abon_services', gid=gid, uname=uname)
 
 
-class LogListView(LoginAdminPermissionMixin, ListView):
+class LogListView(LoginAdminPermissionMixin, OrderedFilteredList):
     permission_required = 'abonapp.view_abonlog'
-    paginate_by = getattr(settings, 'PAGINATION_ITEMS_PER_PAGE', 10)
     http_method_names = ('get',)
     context_object_name = 'logs'
     template_name = 'abonapp/log.html'
     model = models.AbonLog
+    keyset_pagination = True
+    approximate_count = True
 
 
 class DebtorsListView(LoginAdminPermissionMixin, ListView):
@@ -1035,32 +1046,29 @@ def tel_del(request, gid: int, uname):
     return redirect('abonapp:abon_home', gid, uname)
 
 
+def _export_response(request, source: str, fmt: str, params: dict, count: int, filename: str):
+    """
+    Small export is streamed to client, big one is made by celery
+    and user is redirected to page where it will be downloaded
+    """
+    if count > EXPORT_BACKGROUND_ROWS:
+        token = start_export(request.user.pk, source, fmt, params)
+        return redirect('abonapp:export_download', token=token, fmt=fmt)
+    header, rows = EXPORT_SOURCES[source](**params)
+    return export_response(rows, fmt, filename, header)
+
+
 @login_required
 @only_admins
 @permission_required('group_app.view_group', (Group, 'pk', 'gid'))
 def phonebook(request, gid):
+    gid = int(gid)
     res_format = request.GET.get('f')
-    t1 = models.Abon.objects.filter(
-        group__id=int(gid)
-    ).only('telephone', 'fio').values_list(
-        'telephone', 'fio'
-    )
-    t2 = models.AdditionalTelephone.objects.filter(
-        abon__group__id=gid
-    ).only(
-        'telephone', 'owner_name'
-    ).values_list(
-        'telephone', 'owner_name'
-    )
-    telephones = tuple(t1) + tuple(t2)
-    if res_format == 'csv':
-        import csv
-        response = HttpResponse(content_type='text/csv')
-        response['Content-Disposition'] = 'attachment; filename="phones.csv"'
-        writer = csv.writer(response, quoting=csv.QUOTE_NONNUMERIC)
-        for row in telephones:
-            writer.writerow(row)
-        return response
+    if res_format in EXPORT_FORMATS:
+        count = models.Abon.objects.filter(group__id=gid).count() + \
+            models.AdditionalTelephone.objects.filter(abon__group__id=gid).count()
+        return _export_response(request, 'phonebook', res_format, {'gid': gid}, count, 'phones')
+    header, telephones = phonebook_export(gid)
     return render(request, 'abonapp/modal_phonebook.html', {
         'tels': telephones,
         'gid': gid
@@ -1078,20 +1086,13 @@ def abon_export(request, gid):
         if frm.is_valid():
             cleaned_data = frm.clean()
             fields = cleaned_data.get('fields')
-            subscribers = models.Abon.objects.filter(group__id=gid).only(
-                *fields).values_list(*fields)
-            if res_format == 'csv':
-                import csv
-                response = HttpResponse(content_type='text/csv')
-                response[
-                    'Content-Disposition'] = 'attachment; filename="users.csv"'
-                writer = csv.writer(response, quoting=csv.QUOTE_NONNUMERIC)
-                display_values = (f[1] for f in frm.fields['fields'].choices if
-                                  f[0] in fields)
-                writer.writerow(display_values)
-                for row in subscribers:
-                    writer.writerow(row)
-                return response
+            if res_format in EXPORT_FORMATS:
+                gid = int(gid)
+                count = models.Abon.objects.filter(group__id=gid).count()
+                return _export_response(request, 'subscribers', res_format, {
+                    'gid': gid,
+                    'fields': fields
+                }, count, 'users')
             else:
                 messages.info(request,
                               _('Unexpected format %(export_format)s') % {
@@ -1108,22 +1109,37 @@ def abon_export(request, gid):
     })
 
 
+@login_required
+@only_admins
+def export_download(request, token: str, fmt: str):
+    try:
+        path = export_file_path(request.user.pk, token, fmt)
+    except ValueError:
+        raise Http404
+    if os.path.isfile(path):
+        response = FileResponse(open(path, 'rb'), content_type=EXPORT_FORMATS[fmt])
+        response['Content-Disposition'] = 'attachment; filename="export.%s"' % fmt
+        return response
+    if os.path.isfile('%s.error' % path):
+        messages.error(request, _('Export failed'))
+        return redirect('abonapp:group_list')
+    return render(request, 'abonapp/export_wait.html')
+
+
 @login_required
 @only_admins
 def fin_report(request):
-    q = models.AllTimePayLog.objects.by_days()
     res_format = request.GET.get('f')
-    if res_format == 'csv':
-        import csv
-        response = HttpResponse(content_type='text/csv')
-        response['Content-Disposition'] = 'attachment; filename="report.csv"'
-        writer = csv.writer(response, quoting=csv.QUOTE_NONNUMERIC)
-        for row in q:
-            writer.writerow(
-                (row['summ'], row['pay_date'].strftime('%Y-%m-%d')))
-        return response
+    frm = forms.FinReportForm(request.GET or None)
+    params = frm.report_params()
+    if res_format in EXPORT_FORMATS:
+        header, rows = fin_report_export(**params)
+        return export_response(rows, res_format, 'report', header)
     return render(request, 'abonapp/fin_report.html', {
-        'logs': q
+        'logs': models.AllTimePayLog.objects.by_days(**params),
+        'form': frm,
+        'by_month': params.get('by_month'),
+        'by_trade_point': params.get('by_trade_point')
     })
 
 
@@ -1252,6 +1268,38 @@ def attach_nas(request, gid):
     })
 
 
+@login_required
+@only_admins
+@permission_required('abonapp.change_abon')
+def attach_ips(request, gid):
+    """Give free ip from network to subscribers of group that have not ip"""
+    networks = NetworkModel.objects.filter(groups__id=gid)
+    if request.method == 'POST':
+        net = get_object_or_404(networks, pk=lib.safe_int(request.POST.get('network')))
+        abons = models.Abon.objects.filter(group__id=gid, ip_address=None)
+        attached = 0
+        need = 0
+        for nas_id in set(abons.values_list('nas_id', flat=True)):
+            nas_abons = list(abons.filter(nas_id=nas_id).only('pk', 'ip_address'))
+            need += len(nas_abons)
+            for abon, ip in zip(nas_abons, net.allocate_ips(len(nas_abons), nas_id)):
+                abon.attach_ip_addr(str(ip))
+                attached += 1
+        if need == 0:
+            messages.warning(request, _('Users not found'))
+        else:
+            messages.success(request, _('Ip addresses attached to %(count)d subscribers') % {
+                'count': attached
+            })
+            if attached < need:
+                messages.warning(request, _('Network has not enough free ip addresses'))
+            return redirect('abonapp:group_list')
+    return render(request, 'abonapp/modal_attach_ips.html', {
+        'gid': gid,
+        'networks': networks.iterator()
+    })
+
+
 # API's
 @login_required
 @only_admins
@@ -1285,7 +1333,8 @@ def search_abon(request):
     word = request.GET.get('s')
     if not word:
         return None
-    results = models.Abon.objects.filter(fio__icontains=word)[:8]
+    found = SearchEntry.objects.search(word, KIND_ABON)[:8]
+    results = load_found(found, KIND_ABON)
     return list(
         {'id': usr.pk, 'text': "%s: %s" % (usr.username, usr.fio)} for usr in
         results)
@@ -1386,11 +1435,9 @@ class DublicatePay(SecureApiView):
 
     def _fetch_user_info(self, data: dict):
         pay_account = data.get('PAY_ACCOUNT')
-        abon = models.Abon.objects.get(pk=pay_account)
-        fio = abon.fio
-        ballance = float(abon.ballance)
+        abon_id, username, fio, ballance = models.get_pay_info(pk=lib.safe_int(pay_account))
         return {
-            'balance': ballance,
+            'balance': float(ballance),
             'name': fio,
             'account': pay_account,
             'service_id': getattr(settings, 'PAY_SERV_ID'),
@@ -1406,22 +1453,15 @@ class DublicatePay(SecureApiView):
         pay_account = data.get('PAY_ACCOUNT')
         pay_id = data.get('PAY_ID')
         pay_amount = lib.safe_float(data.get('PAY_AMOUNT'))
-        abon = models.Abon.objects.get(pk=pay_account)
-        pays = models.AllTimePayLog.objects.filter(pay_id=pay_id)
-        if pays.count() > 0:
-            return self._bad_ret(-100)
-
-        abon.add_ballance(None, pay_amount,
-                          comment='KonikaForward %.2f' % pay_amount)
-        abon.save(update_fields=('ballance',))
-
-        models.AllTimePayLog.objects.create(
-            pay_id=pay_id,
-            summ=pay_amount,
-            abon=abon,
+        abon_id = models.Abon.objects.filter(pk=pay_account).values_list('pk', flat=True).get()
+        pay = make_payment(
+            pay_id, abon_id, pay_amount,
+            comment='KonikaForward %.2f' % pay_amount,
             trade_point=trade_point,
             receipt_num=receipt_num
         )
+        if pay is None:
+            return self._bad_ret(-100)
         return {
             'pay_id': pay_id,
             'service_id': data.get('SERVICE_ID'),
@@ -1444,3 +1484,92 @@ class DublicatePay(SecureApiView):
                 'time_stamp': pay.date_add.strftime("%d.%m.%Y %H:%M")
             }
         }
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+def _pay_amount(value) -> Optional[float]:
+    """
+    :return: amount of payment, or None if it is not a positive number
+    """
+    if isinstance(value, bool):
+        return
+    try:
+        amount = float(value)
+    except (TypeError, ValueError):
+        return
+    if isfinite(amount) and amount > 0:
+        return amount
+
+
+class PayReconcile(SecureApiView):
+    #
+    # Reconciliation upload from pay system. Body is json list of
+    # payments {"pay_id", "account", "amount", "trade_point", "receipt_num"},
+    # where account is username of subscriber. Payments that are missing
+    # here are made, the same as they came from terminal.
+    #
+    http_method_names = ('post',)
+    chunk_size = 500
+
+    @method_decorator(json_view)
+    def post(self, request):
+        try:
+            pays = json.loads(request.body.decode('utf-8'))
+        except (UnicodeDecodeError, ValueError) as e:
+            return {'text': 'Bad json: %s' % e}
+        if not isinstance(pays, list):
+            return {'text': 'Payments must be a list'}
+
+        created = []
+        exists_count = 0
+        mismatch = []
+        errors = []
+        for i in range(0, len(pays), self.chunk_size):
+            chunk = []
+            for pay in pays[i:i + self.chunk_size]:
+                if not isinstance(pay, dict) or not pay.get('pay_id') or not pay.get('account') \
+                        or len(str(pay['pay_id'])) > 36:
+                    errors.append('Bad payment %s' % pay)
+                    continue
+                amount = _pay_amount(pay.get('amount'))
+                if amount is None:
+                    errors.append('Bad amount of payment %s' % pay['pay_id'])
+                    continue
+                chunk.append((pay, amount))
+            known = dict(models.AllTimePayLog.objects.filter(
+                pay_id__in=tuple(str(p['pay_id']) for p, amount in chunk)
+            ).values_list('pay_id', 'summ'))
+            abon_ids = dict(models.Abon.objects.filter(
+                username__in=tuple(str(p['account']) for p, amount in chunk)
+            ).values_list('username', 'pk'))
+            for pay, amount in chunk:
+                pay_id = str(pay['pay_id'])
+                if pay_id in known:
+                    exists_count += 1
+                    if round(known[pay_id], 2) != round(amount, 2):
+                        mismatch.append({
+                            'pay_id': pay_id,
+                            'amount': amount,
+                            'our_amount': known[pay_id]
+                        })
+                    continue
+                abon_id = abon_ids.get(str(pay['account']))
+                if abon_id is None:
+                    errors.append('Account of payment %s not found' % pay_id)
+                    continue
+                if make_payment(
+                        pay_id, abon_id, amount,
+                        comment='Reconcile %.2f' % amount,
+                        trade_point=None if pay.get('trade_point') is None else str(pay['trade_point']),
+                        receipt_num=lib.safe_int(pay.get('receipt_num'))):
+                    created.append(pay_id)
+                else:
+                    # paid by terminal just now
+                    exists_count += 1
+        return {
+            'text': 'Payments reconciled',
+            'created': created,
+            'exists_count': exists_count,
+            'mismatch': mismatch,
+            'errors': errors
+        }
@@ -1,13 +1,18 @@
 #!/usr/bin/env python3
+import os
 from urllib import request
+from urllib.error import HTTPError
 from hashlib import sha256
 
 API_AUTH_SECRET = 'your api key'
 FILE_LINK = 'http://localhost:8000/dev/nagios/hosts/'
+CONF_FILE = 'nagios_objects.cfg'
+ETAG_FILE = '%s.etag' % CONF_FILE
 
 """
     Example script that downloads config
     file from web via api hash.
+    Config is not downloaded again if it has not changed.
 """
 
 
@@ -19,7 +24,29 @@ def calc_hash(data):
     return sha256(result_data).hexdigest()
 
 
+def read_etag():
+    if os.path.isfile(ETAG_FILE) and os.path.isfile(CONF_FILE):
+        with open(ETAG_FILE) as f:
+            return f.read().strip()
+
+
 if __name__ == '__main__':
     sign = calc_hash(API_AUTH_SECRET)
-    request.urlretrieve("%s?sign=%s" % (FILE_LINK, sign), 'nagios_objects.cfg')
-
+    req = request.Request("%s?sign=%s" % (FILE_LINK, sign))
+    etag = read_etag()
+    if etag:
+        req.add_header('If-None-Match', etag)
+    try:
+        with request.urlopen(req) as r:
+            with open(CONF_FILE, 'wb') as f:
+                f.write(r.read())
+            new_etag = r.headers.get('ETag')
+        if new_etag:
+            with open(ETAG_FILE, 'w') as f:
+                f.write(new_etag)
+        elif os.path.isfile(ETAG_FILE):
+            os.remove(ETAG_FILE)
+    except HTTPError as e:
+        if e.code != 304:
+            raise
+        print('Config has not changed')
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 import sys
 import re
+import json
 from hashlib import sha256
 from typing import Iterable, Union, AnyStr
 
@@ -53,15 +54,53 @@ def send_request(mac, stat, sign_hash):
         print('Status:', r.status_code, r.text)
 
 
+def send_batch_request(events: Iterable):
+    """
+    Send many events by one request.
+    :param events: iterable of (mac, status) pairs
+    """
+    body = json.dumps(tuple(events)).encode('utf-8')
+    sign_hash = calc_hash('_'.join((calc_hash(body), API_AUTH_SECRET)))
+    r = requests.post(
+        "%(domain)s/dev/on_device_event/batch/" % {'domain': SERVER_DOMAIN},
+        params={'sign': sign_hash},
+        data=body,
+        headers={'Content-Type': 'application/json'}
+    )
+    if r.status_code == 200:
+        print(r.json())
+    else:
+        print('Status:', r.status_code, r.text)
+
+
+def read_events(lines: Iterable[str]):
+    for line_num, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            mac, stat = line.split()
+            yield validate(MAC_ADDR_REGEX, mac), validate_status(stat)
+        except ValueError:
+            # one bad line must not break the whole batch
+            print('Skipped bad line %d: %r' % (line_num, line), file=sys.stderr)
+
+
 if __name__ == '__main__':
-    if len(sys.argv) < 3:
+    if len(sys.argv) < 2 or (len(sys.argv) < 3 and sys.argv[1] != '--batch'):
         print('You forget parameters, example of usage:\n'
-              '$ python3 ./monitoring_agent.py a2:c3:12:46:1f:92 DOWN|UP|UNREACHABLE')
+              '$ python3 ./monitoring_agent.py a2:c3:12:46:1f:92 DOWN|UP|UNREACHABLE\n'
+              'or many events from stdin, one "mac status" pair per line:\n'
+              '$ python3 ./monitoring_agent.py --batch < events.txt')
         exit(0)
 
     if API_AUTH_SECRET == 'your api key':
         raise NotImplementedError('You must specified secret api key')
 
+    if sys.argv[1] == '--batch':
+        send_batch_request(read_events(sys.stdin))
+        exit(0)
+
     dev_mac = validate(MAC_ADDR_REGEX, sys.argv[1])
     status = validate_status(sys.argv[2])
 
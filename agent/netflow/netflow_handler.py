@@ -27,6 +27,7 @@ if __name__ == '__main__':
 
     sys.path.append('../../')
     local_settings = import_module('djing.local_settings')
+    IpAccountIndex = import_module('djing.lib.ip_index').IpAccountIndex
     usedb = local_settings.DATABASES.get(USING_DB)
 
     db = MySQLdb.connect(
@@ -38,21 +39,14 @@ if __name__ == '__main__':
     )
     cursor = db.cursor()
 
-    sql = (
-        'SELECT INET_ATON(emps.ip) as uip, acc.id FROM abonent '
-        'LEFT JOIN base_accounts AS acc ON (acc.id = abonent.baseaccount_ptr_id) '
-        'LEFT JOIN abonent_ip_addresses AS ips ON (acc.id = ips.abon_id) '
-        'LEFT JOIN ip_pool_employed_ip AS emps ON (ips.ipleasemodel_id = emps.id) '
-        'WHERE INET_ATON(emps.ip) != 0;'
+    # Only one table is needed, ip addresses are stored in subscriber row
+    cursor.execute(
+        'SELECT ip_address, baseaccount_ptr_id, nas_id FROM abonent '
+        'WHERE ip_address IS NOT NULL'
     )
-    ln = cursor.execute(sql)
+    ip_index = IpAccountIndex(cursor.fetchall())
     with open(tmp_ipuser_file, 'w') as f:
-        f.write("count: %d\n" % ln)
-        while True:
-            row = cursor.fetchone()
-            if row is None:
-                break
-            f.write("%d-%d\n" % row)
+        ip_index.dump(f)
     db.close()
 
     os.system(
@@ -0,0 +1,154 @@
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, sleep
+from typing import Iterable, List, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+from django.utils import timezone
+from telepot import Bot
+from telepot.exception import TelegramError
+from urllib3.exceptions import ProtocolError
+
+from .models import MessageQueue, MessageHistory, TelegramBot, TELEGRAM_TAG
+
+# Telegram allows about 30 messages per second for bot,
+# and about one message per second for one chat
+TELEGRAM_RATE_LIMIT = getattr(settings, 'TELEGRAM_RATE_LIMIT', 30)
+TELEGRAM_MAX_MESSAGE_LEN = 4096
+DELIVERY_STATS_CACHE_KEY = 'chatbot_delivery_stats'
+
+# Incoming messages are saved to db in bulk by delivery worker
+_history_buffer = deque()
+
+
+def log_message(user, text: str) -> None:
+    _history_buffer.append(MessageHistory(user=user, message=text[:255]))
+
+
+def flush_message_history() -> int:
+    history = []
+    while _history_buffer:
+        history.append(_history_buffer.popleft())
+    if history:
+        MessageHistory.objects.bulk_create(history)
+    return len(history)
+
+
+def join_texts(texts: Iterable[str], max_len=TELEGRAM_MAX_MESSAGE_LEN) -> List[str]:
+    """
+    Join many messages for one chat to few, because
+    telegram does not allow many messages to one chat per second
+    """
+    res = []
+    for text in texts:
+        text = text[:max_len]
+        if res and len(res[-1]) + len(text) + 2 <= max_len:
+            res[-1] = '%s\n\n%s' % (res[-1], text)
+        else:
+            res.append(text)
+    return res
+
+
+class TelegramDeliveryWorker(object):
+    """
+    Sends messages from MessageQueue with tag TELEGRAM_TAG to telegram.
+    Messages are claimed by batches (MessageQueueManager.claim),
+    so many workers can run together, and are deleted from queue
+    only after they have been sent.
+    """
+
+    def __init__(self, token: str, batch_size=TELEGRAM_RATE_LIMIT, threads=8, interval=1.0):
+        self.bot = Bot(token)
+        self.batch_size = batch_size
+        self.threads = threads
+        self.interval = interval
+        self.sent = 0
+        self.failed = 0
+        self.last_latency = 0.0
+
+    def _send(self, chat: Tuple[int, List[str]]) -> bool:
+        """
+        :return: False if message must be sent again later
+        """
+        chat_id, texts = chat
+        try:
+            for text in join_texts(texts):
+                self.bot.sendMessage(chat_id, text)
+        except TelegramError as e:
+            # Telegram refused message, for example bot is blocked by user
+            logging.error('Telegram error: %s' % e)
+            self.failed += len(texts)
+        except (ProtocolError, OSError) as e:
+            logging.error('Telegram connection error: %s' % e)
+            return False
+        else:
+            self.sent += len(texts)
+        return True
+
+    def deliver_batch(self) -> int:
+        """
+        Send one batch of messages. Messages are claimed in short
+        transaction and sent without it, so no rows are locked
+        during network requests.
+        :return: count of messages that has been processed
+        """
+        msgs = MessageQueue.objects.claim(TELEGRAM_TAG, self.batch_size)
+        if not msgs:
+            return 0
+        done_ids = []
+        try:
+            chat_ids = dict(TelegramBot.objects.filter(
+                user_id__in={m.target_employee_id for m in msgs}
+            ).values_list('user_id', 'chat_id'))
+
+            by_chat = {}
+            for m in msgs:
+                chat_id = chat_ids.get(m.target_employee_id)
+                if chat_id is None:
+                    # recipient unsubscribed, message can not be delivered
+                    done_ids.append(m.pk)
+                    continue
+                by_chat.setdefault(chat_id, []).append(m)
+
+            chats = tuple(by_chat.items())
+            with ThreadPoolExecutor(max_workers=self.threads) as executor:
+                results = executor.map(self._send, (
+                    (chat_id, [m.message for m in chat_msgs]) for chat_id, chat_msgs in chats
+                ))
+                now = timezone.now()
+                for (chat_id, chat_msgs), ok in zip(chats, results):
+                    if not ok:
+                        continue
+                    for m in chat_msgs:
+                        done_ids.append(m.pk)
+                        if m.date_create:
+                            self.last_latency = (now - m.date_create).total_seconds()
+        finally:
+            MessageQueue.objects.filter(pk__in=done_ids).delete()
+            done = set(done_ids)
+            MessageQueue.objects.release([m.pk for m in msgs if m.pk not in done])
+        return len(done_ids)
+
+    def stats(self) -> dict:
+        return {
+            'sent': self.sent,
+            'failed': self.failed,
+            'last_latency': self.last_latency
+        }
+
+    def run_forever(self) -> None:
+        while True:
+            started = monotonic()
+            # worker lives long, db connection may be closed by server
+            close_old_connections()
+            try:
+                self.deliver_batch()
+                flush_message_history()
+                cache.set(DELIVERY_STATS_CACHE_KEY, self.stats(), None)
+            except Exception:
+                logging.exception('Telegram delivery error')
+            # batch is not more than rate limit of telegram per second
+            sleep(max(self.interval - (monotonic() - started), 0))
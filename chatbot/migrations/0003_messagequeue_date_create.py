@@ -0,0 +1,22 @@
+# Generated by Django 2.1 on 2026-10-19 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0002_auto_20180808_1236'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messagequeue',
+            name='date_create',
+            field=models.DateTimeField(auto_now_add=True, null=True, verbose_name='Time of create'),
+        ),
+        migrations.AlterIndexTogether(
+            name='messagequeue',
+            index_together={('tag', 'status')},
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.1 on 2026-10-19 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0003_messagequeue_date_create'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messagequeue',
+            name='date_claim',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Time of claim'),
+        ),
+        migrations.AlterField(
+            model_name='messagequeue',
+            name='status',
+            field=models.CharField(choices=[('n', 'New'), ('r', 'Read'), ('s', 'Sending')], default='n', max_length=1, verbose_name='Status of message'),
+        ),
+    ]
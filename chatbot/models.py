@@ -1,5 +1,9 @@
+from datetime import timedelta
+from typing import Dict
+
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
-from django.db import models
+from django.db import models, connection, transaction
 from django.conf import settings
 
 AUTH_USER_MODEL = getattr(settings, 'AUTH_USER_MODEL')
@@ -38,6 +42,14 @@ class MessageHistory(models.Model):
         ordering = ('-date_sent',)
 
 
+# Tag of messages that waits for delivery to Telegram
+TELEGRAM_TAG = 'telegr'
+
+# Claimed message that is not sent in this time, in seconds,
+# is claimed again, because its worker is died
+MESSAGE_CLAIM_TIMEOUT = getattr(settings, 'MESSAGE_CLAIM_TIMEOUT', 300)
+
+
 class MessageQueueManager(models.Manager):
     def pop(self, user, tag='none'):
         msgs = self.filter(target_employee=user, status='n', tag=tag)[:1].only('message').values('id', 'message')
@@ -49,17 +61,62 @@ class MessageQueueManager(models.Manager):
         msg = self.create(target_employee=user, message=msg, tag=tag)
         return msg
 
+    def claim(self, tag: str, limit: int, timeout=MESSAGE_CLAIM_TIMEOUT) -> list:
+        """
+        Mark batch of new messages with tag as being sent, in short
+        transaction, so rows are not locked while they are sent.
+        Messages of worker that died while sending are claimed
+        again after timeout seconds.
+        :return: list of MessageQueue
+        """
+        now = timezone.now()
+        # SKIP LOCKED is not supported by MariaDB and MySQL < 8,
+        # there concurrent workers wait for each other here
+        skip_locked = connection.features.has_select_for_update_skip_locked
+        with transaction.atomic():
+            ids = list(self.select_for_update(skip_locked=skip_locked).filter(
+                models.Q(status='n') |
+                models.Q(status='s', date_claim__lt=now - timedelta(seconds=timeout)),
+                tag=tag
+            ).order_by('id').values_list('id', flat=True)[:limit])
+            if not ids:
+                return []
+            self.filter(pk__in=ids).update(status='s', date_claim=now)
+        return list(self.filter(pk__in=ids).order_by('id').only(
+            'id', 'message', 'target_employee_id', 'date_create'
+        ))
+
+    def release(self, ids) -> int:
+        """Return claimed messages to queue, to be sent again"""
+        return self.filter(pk__in=ids, status='s').update(status='n', date_claim=None)
+
+    def stats(self, tag: str) -> Dict:
+        """
+        Queue depth and age of oldest message in seconds
+        """
+        r = self.filter(status__in=('n', 's'), tag=tag).aggregate(
+            depth=models.Count('id'), oldest=models.Min('date_create')
+        )
+        oldest = r['oldest']
+        return {
+            'depth': r['depth'],
+            'oldest_age': (timezone.now() - oldest).total_seconds() if oldest else 0
+        }
+
 
 class MessageQueue(models.Model):
     target_employee = models.ForeignKey(AUTH_USER_MODEL, on_delete=models.CASCADE, verbose_name=_('Target employee'))
     message = models.CharField(_('Message'), max_length=255)
     STATUSES = (
         ('n', 'New'),
-        ('r', 'Read')
+        ('r', 'Read'),
+        ('s', 'Sending')
     )
     status = models.CharField(_('Status of message'), max_length=1, choices=STATUSES, default='n')
     # tag: each application puts its own to separate messages between these applications
     tag = models.CharField(_('App tag'), max_length=6, default='none')
+    date_create = models.DateTimeField(_('Time of create'), auto_now_add=True, null=True)
+    date_claim = models.DateTimeField(_('Time of claim'), null=True, blank=True)
 
     objects = MessageQueueManager()
 
@@ -71,3 +128,4 @@ class MessageQueue(models.Model):
         verbose_name = _('Message queue')
         verbose_name_plural = _('Message queue')
         ordering = ('target_employee__username',)
+        index_together = (('tag', 'status'),)
@@ -1,13 +1,11 @@
 # -*- coding: utf-8 -*-
-from telepot import helper, glance, Bot
-from telepot.exception import TelegramError
+from telepot import helper, glance
 import os
 import socket
 import collections
 from django.utils.translation import ugettext as _
-from urllib3.exceptions import ProtocolError
-from .models import TelegramBot, ChatException, MessageQueue
-from chatbot.models import MessageHistory
+from .models import TelegramBot, ChatException, MessageQueue, TELEGRAM_TAG
+from .delivery import log_message
 from accounts_app.models import UserProfile
 from django.conf import settings
 
@@ -43,10 +41,7 @@ class DjingTelebot(helper.ChatHandler):
         if self._current_user is None:
             self._question(None, self.question_name)
             return False
-        MessageHistory.objects.create(
-            user=self._current_user,
-            message=msg
-        )
+        log_message(self._current_user, msg)
         return True
 
     # Начинаем диалог
@@ -132,18 +127,12 @@ class DjingTelebot(helper.ChatHandler):
         self._sent_reply(_("You're '%s', right?") % self._current_user.get_full_name())
 
 
-# Just sending text to specified account
+# Just sending text to specified account,
+# message to telegram is sent by TelegramDeliveryWorker
 def send_notify(msg_text, account, tag='none'):
-    try:
-        MessageQueue.objects.push(msg=msg_text, user=account, tag=tag)
-        if token is None:
-            raise ChatException(_('Telegram bot token not found'))
-        tb = TelegramBot.objects.get(user=account)
-        tbot = Bot(token)
-        tbot.sendMessage(tb.chat_id, msg_text)
-    except TelegramBot.DoesNotExist:
+    MessageQueue.objects.push(msg=msg_text, user=account, tag=tag)
+    if token is None:
+        raise ChatException(_('Telegram bot token not found'))
+    if not TelegramBot.objects.filter(user=account).exists():
         raise ChatException(_("Recipient '%s' does not subscribed on notifications") % account.get_full_name())
-    except ProtocolError as e:
-        raise ChatException('ProtocolError: %s' % e)
-    except TelegramError as e:
-        raise ChatException('Telegram error: %s' % e)
+    MessageQueue.objects.push(msg=msg_text, user=account, tag=TELEGRAM_TAG)
@@ -0,0 +1,128 @@
+from datetime import timedelta
+from unittest import mock
+
+from django.db import connection, connections, DEFAULT_DB_ALIAS
+from django.test import TestCase
+from django.utils import timezone
+
+from accounts_app.models import UserProfile
+from chatbot.delivery import TelegramDeliveryWorker
+from chatbot.models import MessageQueue, TelegramBot, TELEGRAM_TAG
+
+
+class MessageQueueClaimTest(TestCase):
+    def setUp(self):
+        self.user = UserProfile.objects.create_user(
+            telephone='+79781234567', username='user', password='ps'
+        )
+        self.msgs = [MessageQueue.objects.push(
+            'Message %d' % i, self.user, TELEGRAM_TAG
+        ) for i in range(5)]
+
+    def test_claim_marks_messages(self):
+        claimed = MessageQueue.objects.claim(TELEGRAM_TAG, 3)
+        self.assertListEqual([m.pk for m in claimed], [m.pk for m in self.msgs[:3]])
+        self.assertEqual(MessageQueue.objects.filter(status='s').count(), 3)
+        # claimed messages are not given to another worker
+        claimed = MessageQueue.objects.claim(TELEGRAM_TAG, 10)
+        self.assertListEqual([m.pk for m in claimed], [m.pk for m in self.msgs[3:]])
+        self.assertListEqual(MessageQueue.objects.claim(TELEGRAM_TAG, 10), [])
+
+    def test_claim_other_tag(self):
+        self.assertListEqual(MessageQueue.objects.claim('none', 10), [])
+
+    def test_claim_without_skip_locked(self):
+        # MariaDB and MySQL < 8
+        with mock.patch.object(connection.features, 'has_select_for_update_skip_locked', False):
+            claimed = MessageQueue.objects.claim(TELEGRAM_TAG, 2)
+        self.assertEqual(len(claimed), 2)
+
+    def test_claim_expired(self):
+        MessageQueue.objects.claim(TELEGRAM_TAG, 10)
+        self.assertListEqual(MessageQueue.objects.claim(TELEGRAM_TAG, 10), [])
+        # worker died while sending
+        MessageQueue.objects.filter(pk=self.msgs[0].pk).update(
+            date_claim=timezone.now() - timedelta(seconds=600)
+        )
+        claimed = MessageQueue.objects.claim(TELEGRAM_TAG, 10, timeout=300)
+        self.assertListEqual([m.pk for m in claimed], [self.msgs[0].pk])
+
+    def test_release(self):
+        claimed = MessageQueue.objects.claim(TELEGRAM_TAG, 10)
+        MessageQueue.objects.release([m.pk for m in claimed[:2]])
+        self.assertEqual(MessageQueue.objects.filter(status='n').count(), 2)
+        self.assertEqual(MessageQueue.objects.stats(TELEGRAM_TAG)['depth'], 5)
+
+
+@mock.patch('chatbot.delivery.Bot')
+class TelegramDeliveryWorkerTest(TestCase):
+    def setUp(self):
+        self.user = UserProfile.objects.create_user(
+            telephone='+79781234567', username='user', password='ps'
+        )
+        TelegramBot.objects.create(user=self.user, chat_id=123)
+        self.other = UserProfile.objects.create_user(
+            telephone='+79781234568', username='other', password='ps'
+        )
+        MessageQueue.objects.push('First', self.user, TELEGRAM_TAG)
+        MessageQueue.objects.push('Second', self.user, TELEGRAM_TAG)
+        # not subscribed to telegram
+        MessageQueue.objects.push('Third', self.other, TELEGRAM_TAG)
+
+    def test_deliver_batch(self, bot):
+        worker = TelegramDeliveryWorker('token')
+        self.assertEqual(worker.deliver_batch(), 3)
+        # messages to one chat are joined
+        worker.bot.sendMessage.assert_called_once_with(123, 'First\n\nSecond')
+        self.assertFalse(MessageQueue.objects.filter(tag=TELEGRAM_TAG).exists())
+        self.assertEqual(worker.sent, 2)
+
+    def test_deliver_batch_connection_error(self, bot):
+        worker = TelegramDeliveryWorker('token')
+        worker.bot.sendMessage.side_effect = OSError('Network is unreachable')
+        self.assertEqual(worker.deliver_batch(), 1)
+        # not sent messages are returned to queue
+        self.assertSetEqual(set(MessageQueue.objects.values_list('message', 'status')), {
+            ('First', 'n'), ('Second', 'n')
+        })
+
+    def test_messages_not_locked_while_sending(self, bot):
+        worker = TelegramDeliveryWorker('token')
+        # messages are sent from other threads, so connection of
+        # this thread is checked. Test case itself runs in transaction.
+        conn = connections[DEFAULT_DB_ALIAS]
+        savepoints = list(conn.savepoint_ids)
+
+        def send(chat_id, text):
+            self.assertListEqual(conn.savepoint_ids, savepoints)
+
+        worker.bot.sendMessage.side_effect = send
+        worker.deliver_batch()
+        worker.bot.sendMessage.assert_called_once()
+
+    # test case runs in transaction, its connection must not be closed
+    @mock.patch('chatbot.delivery.close_old_connections')
+    def test_run_forever(self, close_old_connections, bot):
+        worker = TelegramDeliveryWorker('token')
+        with mock.patch('chatbot.delivery.sleep', side_effect=[None, KeyboardInterrupt]) as sleep:
+            with self.assertRaises(KeyboardInterrupt):
+                worker.run_forever()
+        self.assertEqual(sleep.call_count, 2)
+        self.assertEqual(close_old_connections.call_count, 2)
+        worker.bot.sendMessage.assert_called_once_with(123, 'First\n\nSecond')
+        self.assertFalse(MessageQueue.objects.exists())
+        self.assertDictEqual(worker.stats(), {
+            'sent': 2, 'failed': 0, 'last_latency': worker.last_latency
+        })
+
+    @mock.patch('chatbot.delivery.close_old_connections')
+    def test_run_forever_survives_error(self, close_old_connections, bot):
+        worker = TelegramDeliveryWorker('token')
+        with mock.patch.object(worker, 'deliver_batch', side_effect=[RuntimeError('fail'), 0]) as deliver:
+            with mock.patch('chatbot.delivery.flush_message_history') as flush:
+                with mock.patch('chatbot.delivery.sleep', side_effect=[None, KeyboardInterrupt]):
+                    with self.assertRaises(KeyboardInterrupt):
+                        worker.run_forever()
+        # loop goes on after error
+        self.assertEqual(deliver.call_count, 2)
+        flush.assert_called_once_with()
@@ -0,0 +1,8 @@
+from django.urls import path
+from . import views
+
+app_name = 'chatbot'
+
+urlpatterns = [
+    path('api/delivery_stats/', views.DeliveryStatsView.as_view(), name='delivery_stats'),
+]
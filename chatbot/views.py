@@ -1,3 +1,18 @@
-from django.shortcuts import render
+from django.core.cache import cache
+from django.utils.decorators import method_decorator
 
-# Create your views here.
+from djing.global_base_views import SecureApiView
+from djing.lib.decorators import json_view
+from .delivery import DELIVERY_STATS_CACHE_KEY
+from .models import MessageQueue, TELEGRAM_TAG
+
+
+class DeliveryStatsView(SecureApiView):
+    """Depth and latency of telegram delivery queue, for monitoring"""
+    http_method_names = ('get',)
+
+    @method_decorator(json_view)
+    def get(self, request, *args, **kwargs):
+        stats = MessageQueue.objects.stats(TELEGRAM_TAG)
+        stats.update(cache.get(DELIVERY_STATS_CACHE_KEY) or {})
+        return stats
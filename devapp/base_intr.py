@@ -5,12 +5,17 @@ from easysnmp import Session
 
 from django.utils.translation import gettext
 
+from djing.lib import safe_int
+
 ListOrError = Union[
     Iterable,
     Union[Exception, Iterable]
 ]
 
 
+_SNMP_NO_VALUE = ('NOSUCHOBJECT', 'NOSUCHINSTANCE', 'ENDOFMIBVIEW')
+
+
 class DeviceImplementationError(NotImplementedError):
     pass
 
@@ -137,6 +142,23 @@ class SNMPBaseWorker(object, metaclass=ABCMeta):
             snmpnum = v.oid.split('.')[-1:]
             yield v.value, snmpnum[0] if len(snmpnum) > 0 else None
 
+    def get_table(self, oid: str, index_len=1, max_repetitions=64) -> Dict[tuple, str]:
+        """
+        Walk one column of snmp table by GETBULK requests.
+        :param oid: oid of table column
+        :param index_len: how many last numbers of oid is a row index
+        :param max_repetitions: how many values device sends in one response
+        :return: dict of row index tuple -> value
+        """
+        self.start_ses()
+        res = {}
+        for v in self.ses.bulkwalk(oid, max_repetitions=max_repetitions):
+            if v.snmp_type in _SNMP_NO_VALUE:
+                continue
+            full_oid = '%s.%s' % (v.oid, v.oid_index) if v.oid_index else v.oid
+            res[tuple(safe_int(i) for i in full_oid.split('.')[-index_len:])] = v.value
+        return res
+
     def get_item(self, oid):
         self.start_ses()
         v = self.ses.get(oid).value
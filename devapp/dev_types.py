@@ -1,33 +1,51 @@
 import re
-from typing import AnyStr, Iterable, Optional, Dict
+from functools import lru_cache
+from typing import AnyStr, Iterable, Optional, Dict, Tuple
 from datetime import timedelta
 from easysnmp import EasySNMPTimeoutError
 from transliterate import translit
+from django.conf import settings
+from django.core.cache import cache
 from django.utils.translation import gettext_lazy as _, gettext
 
 from djing.lib import RuTimedelta, safe_int
-from djing.lib.tln.tln import ValidationError as TlnValidationError, register_onu_ZTE_F660
+from djing.lib.tln.tln import (
+    ValidationError as TlnValidationError, register_onu_ZTE_F660, register_onus_ZTE_F660
+)
+from djing.lib.tln.aio import olts_unregistered_onus
 from .base_intr import (
     DevBase, SNMPBaseWorker, BasePort, DeviceImplementationError,
     ListOrError, DeviceConfigurationError
 )
 
 
-def _norm_name(name: str, replreg=None):
-    if replreg is None:
-        return re.sub(pattern='\W{1,255}', repl='', string=name, flags=re.IGNORECASE)
+_norm_name_regexp = re.compile(r'\W{1,255}', flags=re.IGNORECASE)
+
+
+def _norm_name(name: str, replreg=_norm_name_regexp):
     return replreg.sub('', name)
 
 
+@lru_cache(maxsize=8192)
+def _host_name(pk: int, comment: str) -> str:
+    return _norm_name("%d%s" % (pk, translit(comment, language_code='ru', reversed=True)))
+
+
+def mon_host_name(device) -> str:
+    """
+    Host name of device for monitoring config. Transliteration is expensive,
+    so it is cached by device id and comment
+    """
+    return _host_name(device.pk, device.comment)
+
+
 def plain_ip_device_mon_template(device) -> Optional[AnyStr]:
     if not device:
         raise ValueError
 
-    parent_host_name = _norm_name("%d%s" % (
-        device.parent_dev.pk, translit(device.parent_dev.comment, language_code='ru', reversed=True)
-    )) if device.parent_dev else None
+    parent_host_name = mon_host_name(device.parent_dev) if device.parent_dev else None
 
-    host_name = _norm_name("%d%s" % (device.pk, translit(device.comment, language_code='ru', reversed=True)))
+    host_name = mon_host_name(device)
     mac_addr = device.mac_addr
     r = (
         "define host{",
@@ -268,7 +286,7 @@ class OnuDevice(DevBase, SNMPBaseWorker):
         device = self.db_instance
         if not device:
             return
-        host_name = _norm_name("%d%s" % (device.pk, translit(device.comment, language_code='ru', reversed=True)))
+        host_name = mon_host_name(device)
         snmp_item = device.snmp_extra
         mac = device.mac_addr
         if device.ip_address:
@@ -344,6 +362,12 @@ class EltexSwitch(DLinkDevice):
         return plain_ip_device_mon_template(device)
 
 
+# Inventory of ZTE OLT is cached per device, it is dropped
+# when ONU is attached to or detached from OLT
+ZTE_INVENTORY_CACHE_KEY = 'devapp_zte_inventory_%d'
+ZTE_INVENTORY_CACHE_TIMEOUT = getattr(settings, 'ZTE_INVENTORY_CACHE_TIMEOUT', 300)
+
+
 def conv_signal(lvl: int) -> float:
     if lvl == 65535: return 0.0
     r = 0
@@ -357,50 +381,76 @@ def conv_signal(lvl: int) -> float:
 class Olt_ZTE_C320(OLTDevice):
     description = _('OLT ZTE C320')
 
+    def get_inventory(self, refresh=False) -> Dict:
+        """
+        All fibers and registered ONUs of OLT. Each snmp column is walked once
+        for whole OLT and columns are joined by index. Result is cached
+        for ZTE_INVENTORY_CACHE_TIMEOUT seconds.
+        :param refresh: do not use cached value
+        :return: dict with keys 'fibers' and 'onus'
+        """
+        cache_key = ZTE_INVENTORY_CACHE_KEY % self.db_instance.pk
+        if not refresh:
+            inventory = cache.get(cache_key)
+            if inventory is not None:
+                return inventory
+
+        fiber_names = self.get_table('.1.3.6.1.4.1.3902.1012.3.13.1.1.1')
+        fiber_onu_nums = self.get_table('.1.3.6.1.4.1.3902.1012.3.13.1.1.13')
+
+        # ONU tables are indexed by fiber_num.onu_num
+        onu_types = self.get_table('.1.3.6.1.4.1.3902.1012.3.28.1.1.1', 2)
+        onu_ports = self.get_table('.1.3.6.1.4.1.3902.1012.3.28.1.1.2', 2)
+        onu_sns = self.get_table('.1.3.6.1.4.1.3902.1012.3.28.1.1.5', 2)
+        onu_prefixs = self.get_table('.1.3.6.1.4.1.3902.1012.3.50.11.2.1.1', 2)
+        # signal table has one more number in index: fiber_num.onu_num.1
+        onu_signals = {idx[:2]: v for idx, v in self.get_table(
+            '.1.3.6.1.4.1.3902.1012.3.50.12.1.1.10', 3
+        ).items()}
+
+        inventory = {
+            'fibers': [{
+                'fb_id': fiber_id,
+                'fb_name': fiber_name,
+                'fb_onu_num': safe_int(fiber_onu_nums.get((fiber_id,)))
+            } for (fiber_id,), fiber_name in fiber_names.items()],
+            'onus': [{
+                'fiber': idx[0],
+                'onu_type': onu_type,
+                'onu_port': onu_ports.get(idx),
+                'onu_signal': conv_signal(safe_int(onu_signals.get(idx))),
+                # Real sn in last 4 octets
+                'onu_sn': onu_prefixs.get(idx, '') + ''.join('%.2X' % ord(i) for i in onu_sns.get(idx, '')[-4:]),
+                'snmp_extra': "%d.%d" % idx,
+            } for idx, onu_type in onu_types.items()]
+        }
+        cache.set(cache_key, inventory, ZTE_INVENTORY_CACHE_TIMEOUT)
+        return inventory
+
     def get_fibers(self):
-        fibers = ({
-            'fb_id': fiber_id,
-            'fb_name': fiber_name,
-            'fb_onu_num': safe_int(self.get_item('.1.3.6.1.4.1.3902.1012.3.13.1.1.13.%d' % int(fiber_id)))
-        } for fiber_name, fiber_id in self.get_list_keyval('.1.3.6.1.4.1.3902.1012.3.13.1.1.1'))
-        return fibers
+        return self.get_inventory()['fibers']
 
-    def get_ports_on_fiber(self, fiber_num: int) -> Iterable:
+    def get_fiber(self, fiber_num: int) -> Optional[Dict]:
+        for fiber in self.get_fibers():
+            if fiber['fb_id'] == fiber_num:
+                return fiber
 
-        onu_types = self.get_list_keyval('.1.3.6.1.4.1.3902.1012.3.28.1.1.1.%d' % fiber_num)
-        onu_ports = self.get_list('.1.3.6.1.4.1.3902.1012.3.28.1.1.2.%d' % fiber_num)
-        onu_signals = self.get_list('.1.3.6.1.4.1.3902.1012.3.50.12.1.1.10.%d' % fiber_num)
-
-        # Real sn in last 3 octets
-        onu_sns = self.get_list('.1.3.6.1.4.1.3902.1012.3.28.1.1.5.%d' % fiber_num)
-        onu_prefixs = self.get_list('.1.3.6.1.4.1.3902.1012.3.50.11.2.1.1.%d' % fiber_num)
-        onu_list = ({
-            'onu_type': onu_type_num[0],
-            'onu_port': onu_port,
-            'onu_signal': conv_signal(safe_int(onu_signal)),
-            'onu_sn': onu_prefix + ''.join('%.2X' % ord(i) for i in onu_sn[-4:]),  # Real sn in last 4 octets,
-            'snmp_extra': "%d.%d" % (fiber_num, safe_int(onu_type_num[1])),
-        } for onu_type_num, onu_port, onu_signal, onu_sn, onu_prefix in zip(
-            onu_types, onu_ports, onu_signals, onu_sns, onu_prefixs
-        ))
-
-        return onu_list
+    def get_ports_on_fiber(self, fiber_num: int) -> Iterable:
+        return [onu for onu in self.get_inventory()['onus'] if onu['fiber'] == fiber_num]
 
     def get_units_unregistered(self, fiber_num: int) -> Iterable:
-        sn_num_list = self.get_list_keyval('.1.3.6.1.4.1.3902.1012.3.13.3.1.2.%d' % fiber_num)
-        firmware_ver = self.get_list('.1.3.6.1.4.1.3902.1012.3.13.3.1.11.%d' % fiber_num)
-        loid_passws = self.get_list('.1.3.6.1.4.1.3902.1012.3.13.3.1.9.%d' % fiber_num)
-        loids = self.get_list('.1.3.6.1.4.1.3902.1012.3.13.3.1.8.%d' % fiber_num)
+        sns = self.get_table('.1.3.6.1.4.1.3902.1012.3.13.3.1.2.%d' % fiber_num)
+        firmware_vers = self.get_table('.1.3.6.1.4.1.3902.1012.3.13.3.1.11.%d' % fiber_num)
+        loid_passws = self.get_table('.1.3.6.1.4.1.3902.1012.3.13.3.1.9.%d' % fiber_num)
+        loids = self.get_table('.1.3.6.1.4.1.3902.1012.3.13.3.1.8.%d' % fiber_num)
 
-        return ({
+        return [{
             'mac': ':'.join('%x' % ord(i) for i in sn[-6:]),
-            'firmware_ver': frm_ver,
-            'loid_passw': loid_passw,
-            'loid': loid,
+            'firmware_ver': firmware_vers.get(idx),
+            'loid_passw': loid_passws.get(idx),
+            'loid': loids.get(idx),
             'sn': sn
-        } for frm_ver, loid_passw, loid, (sn, num) in zip(
-            firmware_ver, loid_passws, loids, sn_num_list
-        ))
+        } for idx, sn in sns.items()]
 
     def uptime(self):
         up_timestamp = safe_int(self.get_item('.1.3.6.1.2.1.1.3.0'))
@@ -416,6 +466,40 @@ class Olt_ZTE_C320(OLTDevice):
     def get_template_name(self):
         return 'olt_ztec320.html'
 
+    @staticmethod
+    def get_olts_unregistered(olts: Iterable) -> Dict:
+        """
+        Unregistered onu of many OLTs, all OLTs are read by telnet at the same time.
+        :param olts: OLT devices from db, their extra_data has telnet parameters
+        :return: dict of device -> list of onu, or device -> exception
+        """
+        results = {}
+        jobs = {}
+        for olt in olts:
+            try:
+                login_passwd, prompt, _vid = ZteOnuDevice._telnet_params(olt.extra_data)
+            except DeviceConfigurationError as e:
+                results[olt] = e
+                continue
+            jobs[olt.ip_address] = (olt, login_passwd, prompt)
+        if not jobs:
+            return results
+        by_host = olts_unregistered_onus(
+            (host, login_passwd, prompt) for host, (olt, login_passwd, prompt) in jobs.items()
+        )
+        for host, onus in by_host.items():
+            olt = jobs[host][0]
+            if isinstance(onus, Exception):
+                results[olt] = onus
+                continue
+            results[olt] = [{
+                'onu_name': onu['onu_name'].decode(),
+                'onu_sn': onu['onu_sn'].decode(),
+                'onu_state': onu['onu_state'].decode(),
+                'fiber_num': int(onu['fiber_num'])
+            } for onu in onus]
+        return results
+
 
 class ZteOnuDevice(OnuDevice):
     description = _('ZTE PON ONU')
@@ -472,7 +556,7 @@ class ZteOnuDevice(OnuDevice):
         device = self.db_instance
         if not device:
             return
-        host_name = _norm_name("%d%s" % (device.pk, translit(device.comment, language_code='ru', reversed=True)))
+        host_name = mon_host_name(device)
         snmp_item = device.snmp_extra
         mac = device.mac_addr
         if device.ip_address:
@@ -492,9 +576,41 @@ class ZteOnuDevice(OnuDevice):
         )
         return '\n'.join(i for i in r if i)
 
-    def register_device(self, extra_data: Dict):
+    @staticmethod
+    def _telnet_params(extra_data: Dict) -> Tuple[Tuple[bytes, bytes], bytes, int]:
         if not extra_data:
             raise DeviceConfigurationError(_('You have not info in extra_data field, please fill it in JSON'))
+        telnet = extra_data.get('telnet')
+        if telnet is None:
+            raise DeviceConfigurationError('For ZTE configuration needed "telnet" section in extra_data')
+        login = telnet.get('login')
+        password = telnet.get('password')
+        prompt = telnet.get('prompt')
+        default_vid = extra_data.get('default_vid')
+        if login is None or password is None or prompt is None:
+            raise DeviceConfigurationError('For ZTE configuration needed login, password and'
+                                           ' prompt for telnet access in extra_data')
+        if default_vid is None:
+            raise DeviceConfigurationError('Please specify default vlan id "default_vid" for configuration onu')
+        return (login.encode(), password.encode()), prompt.encode(), int(default_vid)
+
+    @staticmethod
+    def _sn_mac(device) -> Tuple[bytes, bytes]:
+        mac = str(device.mac_addr).encode()
+
+        # Format serial number from mac address
+        # because saved mac address was make from serial number
+        sn = (b'%.2X' % int(x, base=16) for x in mac.split(b':')[-4:])
+        return b"ZTEG%s" % b''.join(sn), mac
+
+    @staticmethod
+    def _snmp_extra(rack_num: int, fiber_num: int, onu_port_num: int) -> str:
+        bin_snmp_fiber_number = "10000{0:08b}{1:08b}00000000".format(rack_num, fiber_num)
+        snmp_fiber_num = int(bin_snmp_fiber_number, base=2)
+        return "%d.%d" % (snmp_fiber_num, onu_port_num)
+
+    def register_device(self, extra_data: Dict):
+        login_passwd, prompt, default_vid = self._telnet_params(extra_data)
         device = self.db_instance
         ip = None
         if device.ip_address:
@@ -502,33 +618,46 @@ class ZteOnuDevice(OnuDevice):
         elif device.parent_dev:
             ip = device.parent_dev.ip_address
         if ip:
-            mac = str(device.mac_addr).encode()
-
-            # Format serial number from mac address
-            # because saved mac address was make from serial number
-            sn = (b'%.2X' % int(x, base=16) for x in mac.split(b':')[-4:])
-            sn = b"ZTEG%s" % b''.join(sn)
-
-            telnet = extra_data.get('telnet')
-            if telnet is None:
-                raise DeviceConfigurationError('For ZTE configuration needed "telnet" section in extra_data')
-            login = telnet.get('login')
-            password = telnet.get('password')
-            prompt = telnet.get('prompt')
-            default_vid = extra_data.get('default_vid')
-            if login is None or password is None or prompt is None:
-                raise DeviceConfigurationError('For ZTE configuration needed login, password and'
-                                               ' prompt for telnet access in extra_data')
-            if default_vid is None:
-                raise DeviceConfigurationError('Please specify default vlan id "default_vid" for configuration onu')
+            sn, mac = self._sn_mac(device)
             stack_num, rack_num, fiber_num, new_onu_port_num = register_onu_ZTE_F660(
-                olt_ip=ip, onu_sn=sn, login_passwd=(login.encode(), password.encode()),
-                onu_mac=mac, prompt_title=prompt.encode(), vlan_id=int(default_vid)
+                olt_ip=ip, onu_sn=sn, login_passwd=login_passwd,
+                onu_mac=mac, prompt_title=prompt, vlan_id=default_vid
             )
-            bin_snmp_fiber_number = "10000{0:08b}{1:08b}00000000".format(rack_num, fiber_num)
-            snmp_fiber_num = int(bin_snmp_fiber_number, base=2)
-            device.snmp_extra = "%d.%d" % (snmp_fiber_num, new_onu_port_num)
+            device.snmp_extra = self._snmp_extra(rack_num, fiber_num, new_onu_port_num)
+            device.save(update_fields=('snmp_extra',))
+
+    @classmethod
+    def register_devices(cls, olt, devices: Iterable) -> Dict:
+        """
+        Register many onu of one OLT in one telnet session.
+        :param olt: OLT device from db, its extra_data has telnet parameters
+        :param devices: onu devices from db
+        :return: dict of device -> exception for not registered onu
+        """
+        login_passwd, prompt, default_vid = cls._telnet_params(olt.extra_data)
+        by_sn = {}
+        for device in devices:
+            sn, mac = cls._sn_mac(device)
+            by_sn[sn] = (device, mac)
+        if not by_sn:
+            return {}
+        results = register_onus_ZTE_F660(
+            olt_ip=olt.ip_address, onus=((sn, mac) for sn, (device, mac) in by_sn.items()),
+            login_passwd=login_passwd, prompt_title=prompt, vlan_id=default_vid
+        )
+        errors = {}
+        for sn, res in results.items():
+            device = by_sn[sn][0]
+            if isinstance(res, Exception):
+                errors[device] = res
+                # onu is on OLT already, though its configuration failed
+                res = getattr(res, 'onu_position', None)
+                if res is None:
+                    continue
+            stack_num, rack_num, fiber_num, new_onu_port_num = res
+            device.snmp_extra = cls._snmp_extra(rack_num, fiber_num, new_onu_port_num)
             device.save(update_fields=('snmp_extra',))
+        return errors
 
     def get_fiber_str(self):
         dev = self.db_instance
@@ -1,7 +1,13 @@
-from typing import Optional, AnyStr
+from time import monotonic
+from typing import Optional, AnyStr, Iterable, Dict, List, Generator
+from uuid import uuid4
 
 from jsonfield import JSONField
+from django.conf import settings
+from django.core.cache import cache
 from django.db import models
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.shortcuts import resolve_url
 from django.utils.translation import gettext_lazy as _
 
@@ -115,3 +121,160 @@ class Port(models.Model):
         verbose_name = _('Port')
         verbose_name_plural = _('Ports')
         ordering = ('num',)
+
+
+class DeviceTopology(object):
+    """
+    In memory tree of devices built from Device.parent_dev
+    """
+
+    def __init__(self, pairs: Iterable):
+        """
+        :param pairs: iterable of (device_id, parent_device_id)
+        """
+        self.parents = dict(pairs)
+        self._children = None
+
+    @property
+    def children(self) -> Dict[int, List[int]]:
+        if self._children is None:
+            children = {}
+            for dev_id, parent_id in self.parents.items():
+                if parent_id is not None:
+                    children.setdefault(parent_id, []).append(dev_id)
+            self._children = children
+        return self._children
+
+    def ancestors(self, dev_id: int) -> Generator:
+        seen = {dev_id}
+        parent_id = self.parents.get(dev_id)
+        while parent_id is not None and parent_id not in seen:
+            yield parent_id
+            seen.add(parent_id)
+            parent_id = self.parents.get(parent_id)
+
+    def descendants(self, dev_id: int) -> List[int]:
+        children = self.children
+        res = []
+        seen = {dev_id}
+        stack = [dev_id]
+        while stack:
+            for child_id in children.get(stack.pop(), ()):
+                if child_id not in seen:
+                    seen.add(child_id)
+                    res.append(child_id)
+                    stack.append(child_id)
+        return res
+
+    def find_roots(self, failed_ids: Iterable[int]) -> Dict[int, List[int]]:
+        """
+        Group failed devices under topmost failed device.
+        Device is a root when its parent is not failed.
+        :param failed_ids: ids of failed devices
+        :return: {root_id: [failed device ids under root, with root]}
+        """
+        failed = set(failed_ids)
+        root_of = {}
+        for dev_id in failed:
+            chain = []
+            chain_set = set()
+            cur = dev_id
+            while cur not in root_of:
+                chain.append(cur)
+                chain_set.add(cur)
+                parent_id = self.parents.get(cur)
+                if parent_id is None or parent_id not in failed or parent_id in chain_set:
+                    root_of[cur] = cur
+                    break
+                cur = parent_id
+            root = root_of[cur]
+            for c in chain:
+                root_of[c] = root
+        groups = {}
+        for dev_id, root in root_of.items():
+            groups.setdefault(root, []).append(dev_id)
+        return groups
+
+
+# Devices tree is cached in each process, it is dropped
+# when parent of some device changed in current process
+# and rebuilt after DEVICE_TOPOLOGY_TTL seconds.
+DEVICE_TOPOLOGY_TTL = getattr(settings, 'DEVICE_TOPOLOGY_TTL', 300)
+_device_topology = None
+_device_topology_built = 0.0
+
+
+def get_device_topology() -> DeviceTopology:
+    global _device_topology, _device_topology_built
+    now = monotonic()
+    if _device_topology is None or now - _device_topology_built > DEVICE_TOPOLOGY_TTL:
+        _device_topology = DeviceTopology(
+            Device.objects.values_list('pk', 'parent_dev_id').iterator()
+        )
+        _device_topology_built = now
+    return _device_topology
+
+
+@receiver(post_save, sender=Device)
+def device_post_save_topology(sender, instance, created=False, update_fields=None, **kwargs):
+    global _device_topology
+    if created or update_fields is None or 'parent_dev' in update_fields:
+        _device_topology = None
+
+
+@receiver(post_delete, sender=Device)
+def device_post_delete_topology(sender, **kwargs):
+    global _device_topology
+    _device_topology = None
+
+
+# Generated config for monitoring system is cached and dropped
+# when devices changed. Set shared cache backend in settings.CACHES
+# if you have many web processes.
+NAGIOS_CONF_CACHE_KEY = 'devapp_nagios_objects_conf'
+NAGIOS_CONF_CACHE_TIMEOUT = getattr(settings, 'NAGIOS_CONF_CACHE_TIMEOUT', 3600)
+# Config is cached with version that was read before it was generated,
+# so config that was generated while devices changed is never used.
+NAGIOS_CONF_VERSION_KEY = 'devapp_nagios_objects_conf_version'
+
+
+def get_nagios_conf_version() -> str:
+    version = cache.get(NAGIOS_CONF_VERSION_KEY)
+    if version is None:
+        cache.add(NAGIOS_CONF_VERSION_KEY, uuid4().hex, None)
+        version = cache.get(NAGIOS_CONF_VERSION_KEY)
+    return version
+
+
+def drop_nagios_conf() -> None:
+    cache.set(NAGIOS_CONF_VERSION_KEY, uuid4().hex, None)
+    cache.delete(NAGIOS_CONF_CACHE_KEY)
+
+# Fields that used in monitoring config
+_MONITORING_FIELDS = frozenset((
+    'ip_address', 'mac_addr', 'comment', 'devtype', 'parent_dev',
+    'snmp_extra', 'man_passw'
+))
+
+
+@receiver(post_save, sender=Device)
+def device_post_save_monitoring_conf(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None or _MONITORING_FIELDS.intersection(update_fields):
+        drop_nagios_conf()
+
+
+@receiver(post_delete, sender=Device)
+def device_post_delete_monitoring_conf(sender, **kwargs):
+    drop_nagios_conf()
+
+
+@receiver(post_save, sender=Device)
+def device_post_save_olt_inventory(sender, instance, created=False, update_fields=None, **kwargs):
+    if instance.parent_dev_id and (created or update_fields is None or 'snmp_extra' in update_fields):
+        cache.delete(dev_types.ZTE_INVENTORY_CACHE_KEY % instance.parent_dev_id)
+
+
+@receiver(post_delete, sender=Device)
+def device_post_delete_olt_inventory(sender, instance, **kwargs):
+    if instance.parent_dev_id:
+        cache.delete(dev_types.ZTE_INVENTORY_CACHE_KEY % instance.parent_dev_id)
@@ -1,27 +1,79 @@
-from typing import Iterable
+from hashlib import sha256
+from typing import Iterable, Optional, Generator
 from subprocess import run
 from celery import shared_task
+from django.conf import settings
+from django.core.cache import cache
 from devapp.models import Device
 
 
-@shared_task
-def onu_register(device_ids: Iterable[int]):
-    with open('/etc/dhcp/macs.conf', 'w') as f:
-        for dev_id in device_ids:
-            dev = Device.objects.get(pk=dev_id)
-            if not dev.has_attachable_to_subscriber() or dev.mac_addr is None:
-                continue
-            group_code = dev.group.code
-            if not group_code:
-                continue
+DHCP_MACS_CONF = getattr(settings, 'DHCP_MACS_CONF', '/etc/dhcp/macs.conf')
+
+# Many device edits in this period lead to one
+# regeneration of config and one restart of dhcp server
+DHCP_REGENERATE_DELAY = getattr(settings, 'DHCP_REGENERATE_DELAY', 10)
+_ONU_REGISTER_SCHEDULED_KEY = 'devapp_onu_register_scheduled'
+
+
+def schedule_onu_register() -> None:
+    """
+    Schedule regeneration of dhcp config, if it is not scheduled yet.
+    Flag must be in shared cache (settings.CACHES) to work between processes.
+    """
+    if cache.add(_ONU_REGISTER_SCHEDULED_KEY, 1, DHCP_REGENERATE_DELAY * 2):
+        onu_register.apply_async(countdown=DHCP_REGENERATE_DELAY)
+
+
+def _macs_conf_lines(device_ids: Optional[Iterable[int]] = None) -> Generator:
+    devs = Device.objects.exclude(group=None).exclude(mac_addr=None)
+    if device_ids is not None:
+        devs = devs.filter(pk__in=tuple(device_ids))
+    devs = devs.select_related('group').only('devtype', 'mac_addr', 'group__code').order_by('pk')
+    dev_codes = {}
+    for dev in devs.iterator():
+        group_code = dev.group.code
+        if not group_code:
+            continue
+        if dev.devtype not in dev_codes:
             try:
                 mn = dev.get_manager_klass()
-                dev_code = mn.tech_code
-                f.write('subclass "%(group_code)s.%(dev_code)s" "%(mac)s";\n' % {
-                    'group_code': group_code,
-                    'mac': dev.mac_addr,
-                    'dev_code': dev_code
-                })
+                dev_codes[dev.devtype] = mn.tech_code if mn.has_attachable_to_subscriber else None
             except TypeError:
-                continue
+                dev_codes[dev.devtype] = None
+        dev_code = dev_codes[dev.devtype]
+        if dev_code is None:
+            continue
+        yield 'subclass "%(group_code)s.%(dev_code)s" "%(mac)s";\n' % {
+            'group_code': group_code,
+            'mac': dev.mac_addr,
+            'dev_code': dev_code
+        }
+
+
+def _file_hash(fname: str) -> Optional[str]:
+    try:
+        with open(fname, 'rb') as f:
+            h = sha256()
+            for chunk in iter(lambda: f.read(65536), b''):
+                h.update(chunk)
+            return h.hexdigest()
+    except FileNotFoundError:
+        return
+
+
+@shared_task
+def onu_register(device_ids: Optional[Iterable[int]] = None):
+    cache.delete(_ONU_REGISTER_SCHEDULED_KEY)
+    lines = list(_macs_conf_lines(device_ids))
+    h = sha256()
+    for line in lines:
+        h.update(line.encode())
+    if h.hexdigest() == _file_hash(DHCP_MACS_CONF):
+        # nothing changed, dhcp server restart is not needed
+        return
+    # file is written in place, so its owner and mode are kept and
+    # only write access to the file is needed, not to its directory.
+    # dhcp server reads it only on restart, after it is written.
+    with open(DHCP_MACS_CONF, 'w') as f:
+        f.writelines(lines)
     run(('/usr/bin/sudo', 'systemctl', 'restart', 'isc-dhcp-server.service'))
@@ -1,9 +1,24 @@
+import asyncio
+import json
+import os
+import re
+import socket
+import tempfile
 from hashlib import sha256
+from threading import Timer, Thread
+from time import time, sleep, monotonic
+from unittest import mock
+from django.core.cache import cache
 from django.shortcuts import resolve_url
-from django.test import TestCase, RequestFactory, override_settings
+from django.test import TestCase, SimpleTestCase, RequestFactory, override_settings
 
 from accounts_app.models import UserProfile
 from devapp.models import Device
+from devapp.tasks import onu_register, schedule_onu_register
+from devapp.views import suppress_alarms
+from djing.lib.api_auth import _check_replay
+from djing.lib.tln import register_onus_ZTE_F660, OnuZteRegisterError, TelnetApi
+from djing.lib.tln.aio import ConsoleStreamParser, olts_unregistered_onus
 from group_app.models import Group
 
 rf = RequestFactory()
@@ -52,3 +67,385 @@ class DevTest(TestCase):
             'sign': sign
         })
         self.assertEqual(r.status_code, 200)
+
+    @override_settings(API_AUTH_SECRET=API_SECRET, API_AUTH_SUBNET='127.0.0.1')
+    def test_monitoring_batch_event(self):
+        Device.objects.create(
+            ip_address='192.168.0.101',
+            mac_addr='78:81:f2:1f:d2:aa',
+            comment='Test device 2',
+            devtype='Dl',
+            man_passw='public'
+        )
+        body = json.dumps((
+            ('78:81:f2:1f:d2:a9', 'DOWN'),
+            ('78:81:f2:1f:d2:aa', 'UNREACHABLE'),
+            ('bad mac', 'UP')
+        ))
+        sign = calc_hash('_'.join((calc_hash(body), API_SECRET)))
+        url = resolve_url('devapp:on_device_event_batch')
+        r = self.client.post('%s?sign=%s' % (url, sign), data=body,
+                             content_type='application/json')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(len(r.json()['errors']), 1)
+        self.assertEqual(
+            Device.objects.get(mac_addr='78:81:f2:1f:d2:a9').status, 'dwn')
+        self.assertEqual(
+            Device.objects.get(mac_addr='78:81:f2:1f:d2:aa').status, 'unr')
+
+        # body changed, sign is wrong
+        r = self.client.post('%s?sign=%s' % (url, sign), data='[]',
+                             content_type='application/json')
+        self.assertEqual(r.status_code, 403)
+
+    def test_suppress_alarms(self):
+        parent = Device.objects.get(mac_addr='78:81:f2:1f:d2:a9')
+        children = tuple(Device.objects.create(
+            mac_addr='78:81:f2:1f:d2:%.2x' % n,
+            comment='Child %d' % n,
+            devtype='Dl',
+            parent_dev=parent
+        ) for n in range(16))
+        failed_ids = [parent.pk] + [c.pk for c in children]
+        roots = suppress_alarms(failed_ids)
+        self.assertEqual(roots, {
+            parent.pk: {'children': 16, 'subscribers': 0}
+        })
+
+        # parent is failed earlier, children are suppressed
+        Device.objects.filter(pk=parent.pk).update(status='dwn')
+        self.assertEqual(suppress_alarms(c.pk for c in children), {})
+
+    def _chain_with_up_device(self):
+        # failed grandparent -> device that is up -> child
+        grandparent = Device.objects.get(mac_addr='78:81:f2:1f:d2:a9')
+        Device.objects.filter(pk=grandparent.pk).update(status='dwn')
+        middle = Device.objects.create(mac_addr='78:81:f2:1f:d3:01', comment='Middle',
+                                       devtype='Dl', parent_dev=grandparent, status='up')
+        return Device.objects.create(mac_addr='78:81:f2:1f:d3:02', comment='Child', devtype='Dl',
+                                     parent_dev=middle, is_noticeable=True)
+
+    def test_suppress_alarms_through_up_device(self):
+        child = self._chain_with_up_device()
+        self.assertEqual(suppress_alarms((child.pk,)), {})
+
+    @override_settings(API_AUTH_SECRET=API_SECRET, API_AUTH_SUBNET='127.0.0.1')
+    def test_single_event_suppressed(self):
+        child = self._chain_with_up_device()
+        params = {'mac': child.mac_addr, 'status': 'DOWN'}
+        params['sign'] = calc_hash('_'.join(sorted(params.values()) + [API_SECRET]))
+        r = self.client.get('/dev/on_device_event/', params)
+        self.assertEqual(r.status_code, 200)
+        self.assertIn('suppressed', r.json()['text'])
+        self.assertEqual(Device.objects.get(pk=child.pk).status, 'dwn')
+
+    @override_settings(API_AUTH_SECRET=API_SECRET, API_AUTH_SUBNET='127.0.0.1')
+    def test_nagios_conf_etag(self):
+        sign = calc_hash(API_SECRET)
+        url = resolve_url('devapp:nagios_objects_conf')
+        # first request generates config and fills the cache
+        r = self.client.get(url, {'sign': sign})
+        self.assertEqual(r.status_code, 200)
+        content = r.content
+        etag = r['ETag']
+        r = self.client.get(url, {'sign': sign})
+        self.assertEqual(r.content, content)
+        self.assertEqual(r['ETag'], etag)
+        r = self.client.get(url, {'sign': sign}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(r.status_code, 304)
+
+        # device changed, cache dropped
+        dev = Device.objects.get(mac_addr='78:81:f2:1f:d2:a9')
+        dev.comment = 'Changed comment'
+        dev.save(update_fields=('comment',))
+        r = self.client.get(url, {'sign': sign}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(r.status_code, 200)
+        self.assertIn(b'Changedcomment', r.content)
+
+    @override_settings(API_AUTH_SECRET=API_SECRET, API_AUTH_SUBNET='127.0.0.1')
+    def test_nagios_conf_not_cached_when_changed(self):
+        def generate_while_changed():
+            Device.objects.get(mac_addr='78:81:f2:1f:d2:a9').save()
+            return 'stale config'
+
+        sign = calc_hash(API_SECRET)
+        url = resolve_url('devapp:nagios_objects_conf')
+        with mock.patch('devapp.views._nagios_conf', side_effect=generate_while_changed):
+            r = self.client.get(url, {'sign': sign})
+        self.assertEqual(r.content, b'stale config')
+        # config generated before the change is not taken from cache
+        r = self.client.get(url, {'sign': sign})
+        self.assertNotEqual(r.content, b'stale config')
+
+
+    @override_settings(API_AUTH_SECRET=API_SECRET, API_AUTH_SUBNET=('10.0.0.0/8', '127.0.0.1'))
+    def test_secure_api_replay(self):
+        url = resolve_url('devapp:nagios_get_all_hosts')
+        ts = str(int(time()))
+        sign = calc_hash('_'.join((ts, API_SECRET)))
+        r = self.client.get(url, {'ts': ts, 'sign': sign})
+        self.assertEqual(r.status_code, 200)
+        # the same signed request is accepted only once
+        r = self.client.get(url, {'ts': ts, 'sign': sign})
+        self.assertEqual(r.status_code, 403)
+        # outside of replay window
+        ts = str(int(time()) - 3600)
+        sign = calc_hash('_'.join((ts, API_SECRET)))
+        r = self.client.get(url, {'ts': ts, 'sign': sign})
+        self.assertEqual(r.status_code, 403)
+        # not allowed subnet
+        r = self.client.get(url, {'sign': calc_hash(API_SECRET)}, REMOTE_ADDR='192.168.0.1')
+        self.assertEqual(r.status_code, 403)
+        r = self.client.get(url, {'sign': calc_hash(API_SECRET)}, REMOTE_ADDR='10.1.2.3')
+        self.assertEqual(r.status_code, 200)
+        # sign with not ascii chars
+        r = self.client.get(url, {'sign': 'подпись'})
+        self.assertEqual(r.status_code, 403)
+
+
+class DhcpMacsConfTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        grp = Group.objects.create(title='Grp1', code='grp')
+        Device.objects.create(mac_addr='78:81:f2:1f:d2:b1', comment='Onu', devtype='On', group=grp)
+        fd, self.conf_name = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.conf_name)
+
+    @mock.patch('devapp.tasks.onu_register')
+    def test_regenerate_debounce(self, onu_register):
+        schedule_onu_register()
+        schedule_onu_register()
+        self.assertEqual(onu_register.apply_async.call_count, 1)
+
+    @mock.patch('devapp.tasks.run')
+    def test_write_if_changed(self, run):
+        inode = os.stat(self.conf_name).st_ino
+        with mock.patch('devapp.tasks.DHCP_MACS_CONF', self.conf_name):
+            onu_register()
+            self.assertEqual(run.call_count, 1)
+            # nothing changed, server is not restarted
+            onu_register()
+            self.assertEqual(run.call_count, 1)
+        with open(self.conf_name) as f:
+            lines = f.readlines()
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].startswith('subclass "grp.bdcom_onu" '))
+        # file is written in place
+        self.assertEqual(os.stat(self.conf_name).st_ino, inode)
+
+
+class ApiReplayTest(SimpleTestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.cache_dir.cleanup()
+
+    def shared_cache(self):
+        return override_settings(CACHES={'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': self.cache_dir.name
+        }})
+
+    @override_settings(API_AUTH_REQUIRE_TIMESTAMP=True)
+    def test_require_timestamp_without_shared_cache(self):
+        with override_settings(CACHES={'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'
+        }}):
+            with self.assertLogs(level='ERROR'):
+                self.assertFalse(_check_replay(str(int(time())), 'sign1'))
+
+    @override_settings(API_AUTH_REQUIRE_TIMESTAMP=True)
+    def test_replay_refused(self):
+        with self.shared_cache():
+            ts = str(int(time()))
+            self.assertTrue(_check_replay(ts, 'sign1'))
+            self.assertFalse(_check_replay(ts, 'sign1'))
+            self.assertFalse(_check_replay(None, 'sign2'))
+            self.assertFalse(_check_replay(str(int(time()) - 3600), 'sign3'))
+
+
+class TelnetReadLinesTest(SimpleTestCase):
+    def test_prompt_only_at_line_start(self):
+        olt_sock, test_sock = socket.socketpair()
+        tn = TelnetApi(b'ZTE#', timeout=2)
+        tn.sock = olt_sock
+        try:
+            test_sock.sendall(b'show run\r\n  name ZTE# mid')
+            # rest of line comes later, partial line must not be taken as prompt
+            Timer(0.2, test_sock.sendall, (b'dle\r\nZTE#',)).start()
+            self.assertEqual(list(tn.read_lines()), [b'show run', b'  name ZTE# middle'])
+        finally:
+            tn.sock = None
+            olt_sock.close()
+            test_sock.close()
+
+
+class ConsoleStreamParserTest(SimpleTestCase):
+    def test_pager_and_prompt(self):
+        prompt = re.compile(b'ZTE(\\([-\\w]+\\))?#')
+        p = ConsoleStreamParser()
+        # telnet negotiation is refused
+        p.feed(bytes((255, 253, 31)) + b'show run\r\n  onu 1 type ZTE-F660 sn ZTEG00000001\r\n --Mo')
+        self.assertEqual(p.take_reply(), bytes((255, 252, 31)))
+        p.feed(b're--')
+        self.assertEqual(p.take_reply(), b' ')
+        self.assertIsNone(p.match_prompt((prompt,)))
+        p.feed(b'\x08\x08  onu 2 type ZTE-F660 sn ZTEG00000002\r\nZTE(config)#')
+        self.assertEqual(p.match_prompt((prompt,)), 0)
+        self.assertEqual(p.pop_lines(), [
+            b'show run',
+            b'  onu 1 type ZTE-F660 sn ZTEG00000001',
+            b'  onu 2 type ZTE-F660 sn ZTEG00000002'
+        ])
+
+    def test_iac_split_between_chunks(self):
+        p = ConsoleStreamParser()
+        p.feed(b'Username:' + bytes((255,)))
+        p.feed(bytes((251, 1)))
+        self.assertEqual(p.take_reply(), bytes((255, 254, 1)))
+        self.assertEqual(p.last_line(), b'Username:')
+
+
+class FakeOltConsole(Thread):
+    """Telnet console of OLT, answers to 'show gpon onu uncfg' after delay"""
+
+    def __init__(self, uncfg_lines, delay):
+        super().__init__(daemon=True)
+        self.uncfg_lines = uncfg_lines
+        self.delay = delay
+        self.commands = []
+        self.srv = socket.socket()
+        self.srv.bind(('127.0.0.1', 0))
+        self.srv.listen(1)
+        self.port = self.srv.getsockname()[1]
+
+    def run(self):
+        conn, _addr = self.srv.accept()
+        with conn, conn.makefile('rb') as f:
+            conn.sendall(b'Username:')
+            f.readline()
+            conn.sendall(b'Password:')
+            f.readline()
+            conn.sendall(b'\r\nZTE#')
+            for cmd in f:
+                cmd = cmd.strip()
+                self.commands.append(cmd)
+                if cmd == b'exit':
+                    break
+                out = b''
+                if cmd == b'show gpon onu uncfg':
+                    sleep(self.delay)
+                    out = b''.join(ln + b'\r\n' for ln in self.uncfg_lines)
+                conn.sendall(cmd + b'\r\n' + out + b'ZTE#')
+        self.srv.close()
+
+
+class OltsUnregisteredOnusTest(SimpleTestCase):
+    def test_two_olts_concurrently(self):
+        olts = {
+            'olt1': FakeOltConsole((
+                b'OnuIndex                 Sn                  State',
+                b'---------------------------------------------------',
+                b'gpon-onu_1/2/1:1         ZTEGC0FFEE01        unknown',
+            ), delay=0.5),
+            'olt2': FakeOltConsole((
+                b'gpon-onu_1/2/3:1         ZTEGC0FFEE02        unknown',
+                b'gpon-onu_1/2/4:1         ZTEGC0FFEE03        unknown',
+            ), delay=0.5)
+        }
+        for olt in olts.values():
+            olt.start()
+        real_open_connection = asyncio.open_connection
+
+        def open_connection(host, port):
+            return real_open_connection('127.0.0.1', olts[host].port)
+
+        started = monotonic()
+        with mock.patch('djing.lib.tln.aio.asyncio.open_connection', open_connection):
+            res = olts_unregistered_onus((
+                (host, (b'admin', b'passw'), b'ZTE') for host in olts
+            ), timeout=5)
+        # consoles were waited at the same time, not one by one
+        self.assertLess(monotonic() - started, 0.9)
+        self.assertListEqual([onu['onu_sn'] for onu in res['olt1']], [b'ZTEGC0FFEE01'])
+        self.assertListEqual([(onu['fiber_num'], onu['onu_sn']) for onu in res['olt2']], [
+            (b'3', b'ZTEGC0FFEE02'), (b'4', b'ZTEGC0FFEE03')
+        ])
+        for olt in olts.values():
+            olt.join(2)
+            self.assertListEqual(olt.commands, [
+                b'terminal length 0', b'show gpon onu uncfg', b'exit'
+            ])
+
+    def test_one_olt_fails(self):
+        olt = FakeOltConsole((), delay=0)
+        olt.start()
+        real_open_connection = asyncio.open_connection
+
+        def open_connection(host, port):
+            if host == 'dead':
+                raise ConnectionRefusedError
+            return real_open_connection('127.0.0.1', olt.port)
+
+        with mock.patch('djing.lib.tln.aio.asyncio.open_connection', open_connection):
+            res = olts_unregistered_onus((
+                (host, (b'admin', b'passw'), b'ZTE') for host in ('dead', 'alive')
+            ), timeout=5)
+        olt.join(2)
+        self.assertIsInstance(res['dead'], ConnectionRefusedError)
+        self.assertListEqual(res['alive'], [])
+
+
+class FakeOltSession(object):
+    """Console of OLT that fails on second fiber"""
+    sock = True
+    config_level = [b'ZTE#']
+
+    def get_unregistered_onus(self):
+        return [
+            {'onu_sn': b'ZTEG00000001', 'stack_num': b'1', 'rack_num': b'1', 'fiber_num': b'1'},
+            {'onu_sn': b'ZTEG00000002', 'stack_num': b'1', 'rack_num': b'1', 'fiber_num': b'2'}
+        ]
+
+    def get_registered_onu_numbers(self, *fiber_addr):
+        return [1]
+
+    def enter_to_config_mode(self):
+        return True
+
+    def go_to_olt_interface(self, stack_num, rack_num, fiber_num):
+        return fiber_num == 1
+
+    def register_onu_on_olt_fiber(self, *args):
+        pass
+
+    def go_to_onu_interface(self, *args):
+        pass
+
+    def apply_conf_to_onu(self, *args):
+        pass
+
+    def level_exit(self):
+        pass
+
+    def close(self):
+        self.sock = None
+
+
+class RegisterOnusTest(SimpleTestCase):
+    @mock.patch('djing.lib.tln.tln.get_olt_session', return_value=FakeOltSession())
+    def test_partial_results_on_console_error(self, get_session):
+        results = register_onus_ZTE_F660(
+            olt_ip='192.168.0.1', onus=(
+                (b'ZTEG00000001', b'78:81:f2:1f:d2:01'),
+                (b'ZTEG00000002', b'78:81:f2:1f:d2:02')
+            ), login_passwd=(b'login', b'passw'), prompt_title=b'ZTE', vlan_id=1
+        )
+        self.assertEqual(results[b'ZTEG00000001'], (1, 1, 1, 2))
+        self.assertIsInstance(results[b'ZTEG00000002'], OnuZteRegisterError)
+        # broken session is not returned to pool
+        self.assertIsNone(get_session.return_value.sock)
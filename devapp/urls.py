@@ -11,6 +11,7 @@ urlpatterns = [
     path('fix_onu/', views.fix_onu, name='fix_onu'),
     path('<int:group_id>/', views.DevicesListView.as_view(), name='devs'),
     path('<int:group_id>/add/', views.DeviceCreateView.as_view(), name='add'),
+    path('<int:group_id>/olts_uncfg/', views.olts_uncfg, name='olts_uncfg'),
     path('<int:group_id>/<int:device_id>/', views.devview, name='view'),
     path('<int:group_id>/<int:device_id>/del/',
          views.DeviceDeleteView.as_view(), name='del'),
@@ -31,6 +32,8 @@ urlpatterns = [
          name='add_ports'),
     path('<int:group_id>/<int:device_id>/register_device/',
          views.register_device, name='dev_register'),
+    path('<int:group_id>/<int:device_id>/register_onus/',
+         views.register_olt_onus, name='dev_register_onus'),
     re_path('^(\d+)/(?P<device_id>\d+)/(?P<port_id>\d+)_(?P<status>[0-1]{1})$',
             views.toggle_port, name='port_toggle'),
     path('<int:group_id>/<int:device_id>/<int:port_id>/del/',
@@ -47,6 +50,8 @@ urlpatterns = [
 
     # Monitoring api
     path('on_device_event/', views.OnDeviceMonitoringEvent.as_view()),
+    path('on_device_event/batch/', views.OnDeviceMonitoringBatchEvent.as_view(),
+         name='on_device_event_batch'),
 
     # Nagios mon generate
     path('nagios/hosts/', views.nagios_objects_conf,
@@ -1,5 +1,8 @@
 import re
+import json
+from hashlib import md5
 from ipaddress import ip_address
+from typing import Iterable, Dict
 
 from abonapp.models import Abon
 from accounts_app.models import UserProfile
@@ -11,11 +14,15 @@ from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import PermissionRequiredMixin
 from django.core.exceptions import PermissionDenied
 from django.db import IntegrityError
-from django.db.models import Q, Count
-from django.http import HttpResponse, Http404
+from django.db.models import Q, Count, Case, When, Value, CharField
+from django.core.cache import cache
+from django.http import HttpResponse, Http404, HttpResponseNotModified
 from django.shortcuts import render, redirect, get_object_or_404, resolve_url
 from django.utils.decorators import method_decorator
+from django.utils.http import parse_etags, quote_etag
 from django.utils.translation import gettext_lazy as _, gettext
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 from django.views.generic import DetailView, DeleteView, UpdateView, CreateView
 from djing import global_base_views, MAC_ADDR_REGEX, ping, get_object_or_None
 from djing.lib import safe_int, ProcessLocked, DuplicateEntry
@@ -30,9 +37,13 @@ from group_app.models import Group
 from guardian.decorators import \
     permission_required_or_403 as permission_required
 from guardian.shortcuts import get_objects_for_user
+from netaddr import EUI
 from .forms import DeviceForm, PortForm, DeviceExtraDataForm
-from .models import Device, Port, DeviceDBException, DeviceMonitoringException
-from .tasks import onu_register
+from .models import Device, Port, DeviceDBException, \
+    DeviceMonitoringException, DeviceTopology, get_device_topology, \
+    NAGIOS_CONF_CACHE_KEY, NAGIOS_CONF_CACHE_TIMEOUT, get_nagios_conf_version
+from .dev_types import ZteOnuDevice, Olt_ZTE_C320
+from .tasks import schedule_onu_register
 
 
 class DevicesListView(LoginAdminPermissionMixin,
@@ -92,9 +103,7 @@ class DeviceDeleteView(LoginAdminPermissionMixin, DeleteView):
                 self.object.mac_addr or '-',
                 self.object.comment or '-'
             ))
-            onu_register.delay(
-                tuple(dev.pk for dev in Device.objects.exclude(group=None).only('pk').iterator())
-            )
+            schedule_onu_register()
         except (DeviceDBException, PermissionError) as e:
             messages.error(request, e)
         messages.success(request, _('Device successfully deleted'))
@@ -144,9 +153,7 @@ class DeviceUpdate(LoginAdminPermissionMixin, UpdateView):
         r = super().form_valid(form)
         # change device info in dhcpd.conf
         try:
-            onu_register.delay(
-                tuple(dev.pk for dev in Device.objects.exclude(group=None).only('pk').iterator())
-            )
+            schedule_onu_register()
             messages.success(self.request, _('Device info has been saved'))
         except PermissionError as e:
             messages.error(self.request, e)
@@ -209,9 +216,7 @@ class DeviceCreateView(LoginAdminMixin, PermissionRequiredMixin, CreateView):
                     self.object.mac_addr,
                     self.object.comment
                 ))
-            onu_register.delay(
-                tuple(dev.pk for dev in Device.objects.exclude(group=None).only('pk').iterator())
-            )
+            schedule_onu_register()
             messages.success(self.request, _('Device info has been saved'))
         except PermissionError as e:
             messages.error(self.request, e)
@@ -507,15 +512,41 @@ def zte_port_view_uncfg(request, group_id: str, device_id: str, fiber_id: str):
     fiber_id = safe_int(fiber_id)
     zte_olt_device = get_object_or_404(Device, id=device_id)
     manager = zte_olt_device.get_manager_object()
+    if request.GET.get('refresh'):
+        manager.get_inventory(refresh=True)
     onu_list = manager.get_units_unregistered(fiber_id)
     return render(request,
                   'devapp/custom_dev_page/olt_ztec320_units_uncfg.html', {
                       'onu_list': onu_list,
+                      'fiber': manager.get_fiber(fiber_id),
+                      'registered_onu_list': manager.get_ports_on_fiber(fiber_id),
                       'dev': zte_olt_device,
                       'grp': group_id
                   })
 
 
+@login_required
+@only_admins
+def olts_uncfg(request, group_id: int):
+    """Unregistered onu of all zte OLTs in group, OLTs are read concurrently"""
+    group = get_object_or_404(Group, pk=group_id)
+    olts = Device.objects.filter(group=group, devtype='Zt').exclude(
+        ip_address=None
+    ).only('pk', 'ip_address', 'comment', 'extra_data').order_by('comment')
+    results = Olt_ZTE_C320.get_olts_unregistered(olts)
+    olt_list = []
+    for olt in olts:
+        onus = results.get(olt)
+        if isinstance(onus, Exception):
+            olt_list.append((olt, (), str(onus) or type(onus).__name__))
+        else:
+            olt_list.append((olt, onus or (), None))
+    return render(request, 'devapp/olts_uncfg.html', {
+        'group': group,
+        'olt_list': olt_list
+    })
+
+
 @login_required
 @only_admins
 @permission_required('devapp.can_toggle_ports')
@@ -662,6 +693,79 @@ def fix_port_conflict(request, group_id, device_id, port_id):
     })
 
 
+# Monitoring status code -> (status in db, notification text)
+MONITORING_STATUSES = {
+    'UP': ('up', 'Device %(device_name)s is up'),
+    'DOWN': ('dwn', 'Device %(device_name)s is down'),
+    'UNREACHABLE': ('unr', 'Device %(device_name)s is unreachable')
+}
+MONITORING_STATUS_UNDEFINED = (
+    'und', 'Device %(device_name)s getting undefined status code'
+)
+
+
+# Statuses when device is not available
+FAILED_STATUSES = ('dwn', 'unr')
+
+
+def _monitoring_device_name(device: Device) -> str:
+    return "%s(%s) %s" % (
+        device.ip_address,
+        device.mac_addr,
+        device.comment
+    )
+
+
+def _failed_ancestors(failed_ids: Iterable[int], topology: DeviceTopology) -> set:
+    """
+    Ancestors of devices that was failed before, one query
+    """
+    failed_ids = set(failed_ids)
+    ancestor_ids = set()
+    for dev_id in failed_ids:
+        ancestor_ids.update(topology.ancestors(dev_id))
+    ancestor_ids -= failed_ids
+    if not ancestor_ids:
+        return set()
+    return set(Device.objects.filter(
+        pk__in=ancestor_ids, status__in=FAILED_STATUSES
+    ).values_list('pk', flat=True))
+
+
+def suppress_alarms(failed_ids: Iterable[int]) -> Dict[int, Dict[str, int]]:
+    """
+    Find topmost failed devices for burst of failed devices.
+    Devices under ancestor that was failed before is skipped,
+    notification about it has been sent already.
+    :param failed_ids: ids of failed devices from burst
+    :return: {root_id: {'children': count, 'subscribers': count}}
+    """
+    failed_ids = set(failed_ids)
+    if not failed_ids:
+        return {}
+    topology = get_device_topology()
+    already_failed = _failed_ancestors(failed_ids, topology)
+    all_failed = failed_ids | already_failed
+    roots = topology.find_roots(all_failed)
+    # root is suppressed by any failed ancestor, even when
+    # devices that are up are between them
+    subtrees = {
+        root_id: topology.descendants(root_id)
+        for root_id in roots if root_id not in already_failed and
+        not any(a in all_failed for a in topology.ancestors(root_id))
+    }
+    all_ids = set(subtrees).union(*subtrees.values())
+    subscribers = dict(Abon.objects.filter(device_id__in=all_ids).order_by()
+                       .values_list('device_id').annotate(cnt=Count('pk')))
+    return {
+        root_id: {
+            'children': len(descendants),
+            'subscribers': sum(subscribers.get(i, 0) for i in descendants) +
+                           subscribers.get(root_id, 0)
+        } for root_id, descendants in subtrees.items()
+    }
+
+
 class OnDeviceMonitoringEvent(global_base_views.SecureApiView):
     #
     # Api view for monitoring devices
@@ -685,18 +789,9 @@ class OnDeviceMonitoringEvent(global_base_views.SecureApiView):
             if device_down is None:
                 return {'text': 'Devices with mac %s does not exist' % dev_mac}
 
-            if dev_status == 'UP':
-                device_down.status = 'up'
-                notify_text = 'Device %(device_name)s is up'
-            elif dev_status == 'DOWN':
-                device_down.status = 'dwn'
-                notify_text = 'Device %(device_name)s is down'
-            elif dev_status == 'UNREACHABLE':
-                device_down.status = 'unr'
-                notify_text = 'Device %(device_name)s is unreachable'
-            else:
-                device_down.status = 'und'
-                notify_text = 'Device %(device_name)s getting undefined status code'
+            device_down.status, notify_text = MONITORING_STATUSES.get(
+                dev_status, MONITORING_STATUS_UNDEFINED
+            )
 
             device_down.save(update_fields=('status',))
 
@@ -706,15 +801,18 @@ class OnDeviceMonitoringEvent(global_base_views.SecureApiView):
                             device_down.ip_address or device_down.comment
                 }
 
+            if device_down.status in FAILED_STATUSES and _failed_ancestors(
+                    (device_down.pk,), get_device_topology()):
+                return {
+                    'text': 'Notification for %s is suppressed, parent device '
+                            'is failed' % (device_down.ip_address or device_down.comment)
+                }
+
             recipients = UserProfile.objects.get_profiles_by_group(
                 device_down.group.pk)
 
             multicast_email_notify.delay(msg_text=gettext(notify_text) % {
-                'device_name': "%s(%s) %s" % (
-                    device_down.ip_address,
-                    device_down.mac_addr,
-                    device_down.comment
-                )
+                'device_name': _monitoring_device_name(device_down)
             }, account_ids=(
                 recipient.pk for recipient in recipients.only('pk').iterator()
             ))
@@ -727,25 +825,134 @@ class OnDeviceMonitoringEvent(global_base_views.SecureApiView):
             }
 
 
+@method_decorator(csrf_exempt, name='dispatch')
+class OnDeviceMonitoringBatchEvent(global_base_views.SecureApiView):
+    #
+    # Api view for many monitoring events at once.
+    # Body is json list of [mac, status] pairs.
+    #
+    http_method_names = ('post',)
+
+    @method_decorator(json_view)
+    def post(self, request):
+        try:
+            events = json.loads(request.body.decode('utf-8'))
+        except (UnicodeDecodeError, ValueError) as e:
+            return {'text': 'Bad json: %s' % e}
+        if not isinstance(events, list):
+            return {'text': 'Events must be a list of [mac, status] pairs'}
+
+        # last event for each device is actual
+        statuses = {}
+        errors = []
+        for ev in events:
+            try:
+                dev_mac, dev_status = ev
+            except (TypeError, ValueError):
+                errors.append('Bad event %s' % ev)
+                continue
+            if not isinstance(dev_mac, str) or not re.match(MAC_ADDR_REGEX, dev_mac):
+                errors.append('mac address %s is not valid' % dev_mac)
+                continue
+            statuses[int(EUI(dev_mac))] = MONITORING_STATUSES.get(
+                dev_status, MONITORING_STATUS_UNDEFINED
+            )
+        if not statuses:
+            return {'text': 'Events does not passed', 'errors': errors}
+
+        devices = tuple(Device.objects.filter(
+            mac_addr__in=tuple(statuses.keys())
+        ).only('pk', 'mac_addr', 'ip_address', 'comment',
+               'group', 'is_noticeable'))
+        if not devices:
+            return {'text': 'Devices does not exist', 'errors': errors}
+
+        # Group device ids by new status, and save all by one query
+        ids_by_status = {}
+        for dev in devices:
+            db_status, notify_text = statuses[int(dev.mac_addr)]
+            ids_by_status.setdefault(db_status, []).append(dev.pk)
+        Device.objects.filter(pk__in=tuple(dev.pk for dev in devices)).update(
+            status=Case(*(When(pk__in=ids, then=Value(st))
+                          for st, ids in ids_by_status.items()),
+                        output_field=CharField())
+        )
+
+        # Failed devices are collapsed into topmost failed device
+        failed_ids = ids_by_status.get('dwn', []) + ids_by_status.get('unr', [])
+        roots = suppress_alarms(failed_ids)
+
+        # One notification for each group
+        texts_by_group = {}
+        for dev in devices:
+            if not dev.is_noticeable or dev.group_id is None:
+                continue
+            db_status, notify_text = statuses[int(dev.mac_addr)]
+            if db_status in FAILED_STATUSES:
+                if dev.pk not in roots:
+                    continue
+                text = ' '.join((
+                    gettext(notify_text),
+                    gettext('Affected %(children)d devices and '
+                            '%(subscribers)d subscribers') % roots[dev.pk]
+                ))
+            else:
+                text = gettext(notify_text)
+            texts_by_group.setdefault(dev.group_id, []).append(text % {
+                'device_name': _monitoring_device_name(dev)
+            })
+        for group_id, texts in texts_by_group.items():
+            recipients = UserProfile.objects.get_profiles_by_group(
+                group_id).only('pk').values_list('pk', flat=True)
+            multicast_email_notify.delay(
+                msg_text='<br/>\n'.join(texts),
+                account_ids=tuple(recipients)
+            )
+        return {
+            'text': 'updated %d devices, sent %d notifications' % (
+                len(devices), len(texts_by_group)
+            ),
+            'errors': errors
+        }
+
+
 @hash_auth_view
 def nagios_objects_conf(request):
-    def getconf(device_instance: Device):
-        try:
-            config = device_instance.generate_config_template()
-            if config is not None:
-                return config
-        except DeviceImplementationError:
-            pass
+    version = get_nagios_conf_version()
+    cached = cache.get(NAGIOS_CONF_CACHE_KEY)
+    if cached is not None and cached[0] == version:
+        version, etag, content = cached
+    else:
+        content = _nagios_conf()
+        etag = quote_etag(md5(content.encode('utf-8')).hexdigest())
+        cache.set(NAGIOS_CONF_CACHE_KEY, (version, etag, content), NAGIOS_CONF_CACHE_TIMEOUT)
+    if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+        return HttpResponseNotModified()
+    response = HttpResponse(content, content_type='text/plain')
+    response['ETag'] = etag
+    response['Content-Disposition'] = 'attachment; filename="objects.cfg"'
+    return response
+
 
+def _nagios_conf() -> str:
+    """
+    Config is cached as whole, so it is generated as whole too
+    """
     devices_queryset = Device.objects.exclude(
         Q(mac_addr=None) | Q(ip_address='127.0.0.1')) \
         .select_related('parent_dev') \
-        .only('ip_address', 'comment', 'parent_dev')
-    confs = map(getconf, devices_queryset)
-    confs = (c for c in confs if c is not None)
-    response = HttpResponse(''.join(confs), content_type='text/plain')
-    response['Content-Disposition'] = 'attachment; filename="objects.cfg"'
-    return response
+        .only('ip_address', 'comment', 'parent_dev', 'mac_addr', 'devtype',
+              'snmp_extra', 'man_passw', 'parent_dev__ip_address',
+              'parent_dev__comment')
+    chunks = []
+    for device in devices_queryset.iterator():
+        try:
+            config = device.generate_config_template()
+        except DeviceImplementationError:
+            continue
+        if config is not None:
+            chunks.append(config)
+    return ''.join(chunks)
 
 
 class DevicesGetListView(global_base_views.SecureApiView):
@@ -800,3 +1007,39 @@ def register_device(request, group_id: int, device_id: int):
         'status': status,
         'dat': text
     }
+
+
+@login_required
+@only_admins
+@permission_required('devapp.change_device')
+@require_POST
+@json_view
+def register_olt_onus(request, group_id: int, device_id: int):
+    """Register all not registered zte onu of OLT in one telnet session"""
+    olt = get_object_or_404(Device, pk=device_id, devtype='Zt')
+    onus = Device.objects.filter(parent_dev=olt, devtype='Zo').filter(
+        Q(snmp_extra=None) | Q(snmp_extra='')
+    )
+    status = 1
+    try:
+        errors = ZteOnuDevice.register_devices(olt, onus)
+        text = gettext('Registered %(registered)d of %(total)d units') % {
+            'registered': len(onus) - len(errors),
+            'total': len(onus)
+        }
+        if errors:
+            text = '%s. %s' % (text, ', '.join(
+                '%s: %s' % (dev.comment, err) for dev, err in errors.items()
+            ))
+        else:
+            status = 0
+    except ZteOltLoginFailed:
+        text = gettext('Wrong login or password for telnet access')
+    except (ConnectionRefusedError, ZteOltConsoleError, DeviceImplementationError) as e:
+        text = str(e)
+    except ProcessLocked:
+        text = gettext('Process locked by another process')
+    return {
+        'status': status,
+        'dat': text
+    }
@@ -1,15 +1,20 @@
 #!/usr/bin/env python3
-from typing import Dict, Optional, AnyStr
+from typing import Dict, Optional, AnyStr, Iterable, Tuple
 import re
+import json
 import signal
-from time import sleep
+import socket
+from collections import deque
+from queue import Queue, Empty
+from threading import Thread
+from time import monotonic
 from urllib.parse import urlencode
-from urllib.request import urlopen
-from urllib.error import HTTPError
+from urllib.request import urlopen, Request
+from urllib.error import HTTPError, URLError
 from hashlib import sha256
 
 from pid.decorator import pidfile
-from djing.lib.messaging.sms import SmsSubmit, SmsDeliver
+from djing.lib.messaging.sms import BulkSmsEncoder, SmsDeliver
 from asterisk import manager as ast_mngr
 
 
@@ -22,7 +27,31 @@ ASTERISK_MANAGER_AUTH = {
 API_AUTH_SECRET = 'your api secret'
 SERVER_DOMAIN = 'http://localhost:8000'
 
-outbox_messages = False
+# Billing pushes new outbox messages to this address,
+# must be the same as DIALING_OUTBOX_NOTIFY_ADDR in billing settings
+OUTBOX_NOTIFY_ADDR = ('127.0.0.1', 2775)
+
+# Dongles for sending sms
+DONGLE_DEVICES = ('sim_8318999',)
+
+# How many sms may wait for sending status on one dongle
+DONGLE_SMS_WINDOW = 2
+
+# Sms without status from dongle in this time is considered failed, in seconds
+DONGLE_SMS_TIMEOUT = 120
+
+# Statuses are sent to billing by batches of this size, or every interval seconds
+STATUS_BATCH_SIZE = 20
+STATUS_FLUSH_INTERVAL = 2
+
+# Messages that were missed by notification are fetched from billing
+OUTBOX_RESYNC_INTERVAL = 300
+
+sms_encoder = BulkSmsEncoder()
+
+# All events for dispatcher come through this queue,
+# so dispatcher state is changed only in main thread
+events = Queue()
 
 
 def calc_hash(data):
@@ -33,6 +62,10 @@ def calc_hash(data):
     return sha256(result_data).hexdigest()
 
 
+def body_sign(body: bytes) -> str:
+    return calc_hash('_'.join((calc_hash(body), API_AUTH_SECRET)))
+
+
 def secure_request(data: Dict) -> Optional[AnyStr]:
     vars_to_hash = [str(v) for v in data.values()]
     vars_to_hash.sort()
@@ -42,10 +75,25 @@ def secure_request(data: Dict) -> Optional[AnyStr]:
     try:
         with urlopen("%s/dialing/api/sms/?%s" % (SERVER_DOMAIN, urlencode(data))) as r:
             return r.read()
-    except ConnectionRefusedError:
-        print('ERROR: connection refused')
     except HTTPError as e:
         print('ERROR:', e)
+    except (ConnectionRefusedError, URLError) as e:
+        print('ERROR: connection refused', e)
+
+
+def secure_post(path: str, body: bytes) -> Optional[AnyStr]:
+    req = Request(
+        "%s%s?%s" % (SERVER_DOMAIN, path, urlencode({'sign': body_sign(body)})),
+        data=body,
+        headers={'Content-Type': 'application/json'}
+    )
+    try:
+        with urlopen(req) as r:
+            return r.read()
+    except HTTPError as e:
+        print('ERROR:', e)
+    except (ConnectionRefusedError, URLError) as e:
+        print('ERROR: connection refused', e)
 
 
 class SMS(object):
@@ -70,14 +118,39 @@ class ChunkedMsg(object):
         self.sms_count = sms_count
         self.ref = ref
         self.sms = sms
+        # seq -> text, parts may come in any order
+        self.parts = {}
+
+    def add(self, seq, text) -> bool:
+        """
+        :return: True if all parts of message have been received
+        """
+        self.parts[seq] = text
+        return len(self.parts) >= self.sms_count
+
+    def join(self) -> SMS:
+        self.sms.text = ''.join(self.parts[seq] for seq in sorted(self.parts))
+        return self.sms
+
+
+class OutMsg(object):
+    def __init__(self, msg_id: int, dst: str, text: str):
+        self.msg_id = msg_id
+        self.dst = dst
+        self.text = text
+        self.parts_left = 0
+        self.failed = False
+        self.deadline = 0.0
 
 
 class MyAstManager(ast_mngr.Manager):
-    sms_chunks = list()
+    # (ref, sender) -> ChunkedMsg
+    sms_chunks = dict()
 
     def new_chunked_sms(self, count, ref, sms):
         msg = ChunkedMsg(count, ref, sms)
-        self.sms_chunks.append(msg)
+        self.sms_chunks[(ref, sms.who)] = msg
+        return msg
 
     @staticmethod
     def save_sms(sms):
@@ -93,44 +166,169 @@ class MyAstManager(ast_mngr.Manager):
         if response is not None:
             print(response)
 
-    def send_sms(self, dev, recipient, utext):
+    def send_sms(self, dev, recipient, utext) -> Tuple[str, ...]:
+        """
+        Put sms to dongle queue
+        :return: dongle ids of queued parts of message
+        """
         if not validate_tel(recipient):
             print("Tel %s is not valid" % recipient)
-            return
-        sms = SmsSubmit(recipient, utext)
-        for pdu in sms.to_pdu():
+            return ()
+        ids = []
+        for pdu in sms_encoder.encode(recipient, utext):
             response = self.command('dongle pdu %s %s' % (dev, pdu.pdu))
             print(response.data)
-
-    def push_text(self, sms, ref, cnt):
+            sms_id = DONGLE_SMS_ID_REGEX.search(response.data)
+            if sms_id is None:
+                # dongle refused the part, all message is failed
+                return ()
+            ids.append(sms_id.group(1))
+        return tuple(ids)
+
+    def push_text(self, sms, ref, cnt, seq):
         if not isinstance(sms, SMS):
             raise TypeError
-        chunk = [c for c in self.sms_chunks if c.ref == ref]
-        chunk_len = len(chunk)
-        if chunk_len == 1:
-            chunk = chunk[0]
-            chunk.sms += sms
-            if chunk.sms_count == cnt:
-                self.save_sms(chunk.sms)
-                self.sms_chunks.remove(chunk)
-
-        elif chunk_len == 0:
-            self.new_chunked_sms(cnt, ref, sms)
-
-    def send_from_outbox(self):
-        messages = secure_request({'cmd': 'get_new'})
-        for msg in messages:
-            if self.send_sms(dev='sim_8318999', recipient=msg.dst, utext=msg.text):
-                msg_status = 'st'
-            else:
-                msg_status = 'fd'
-            result = secure_request({
-                'cmd': 'update_status',
-                'mid': msg.pk,
-                'status': msg_status
-            })
-            if result is not None:
-                print(result)
+        key = (ref, sms.who)
+        chunk = self.sms_chunks.get(key)
+        if chunk is None:
+            chunk = self.new_chunked_sms(cnt, ref, sms)
+        if chunk.add(seq, sms.text):
+            del self.sms_chunks[key]
+            self.save_sms(chunk.join())
+
+
+DONGLE_SMS_ID_REGEX = re.compile(r'id (0x[\da-fA-F]+)')
+
+
+class OutboxDispatcher(object):
+    """
+    Sends outbox messages through dongles.
+    Not more than DONGLE_SMS_WINDOW messages are waiting for
+    status from one dongle, next message is sent when status
+    for previous has come. Statuses are sent to billing by batches.
+    """
+
+    def __init__(self, mngr: MyAstManager, devices=DONGLE_DEVICES, window=DONGLE_SMS_WINDOW):
+        self.mngr = mngr
+        self.window = window
+        self.queue = deque()
+        # dongle -> {dongle sms id: OutMsg}
+        self.in_flight = dict((dev, {}) for dev in devices)
+        # ids of messages that are queued or sending now
+        self.known_ids = set()
+        self.statuses = []
+        self.last_flush = monotonic()
+
+    def add_messages(self, msgs: Iterable[Dict]):
+        for m in msgs:
+            msg_id = int(m.get('id', 0))
+            if msg_id == 0 or msg_id in self.known_ids:
+                continue
+            self.known_ids.add(msg_id)
+            self.queue.append(OutMsg(msg_id, m.get('dst'), m.get('text')))
+        self.pump()
+
+    def _free_dongle(self) -> Optional[str]:
+        dev, in_flight = min(self.in_flight.items(), key=lambda d: len(d[1]))
+        if len(in_flight) < self.window:
+            return dev
+
+    def pump(self):
+        while self.queue:
+            dev = self._free_dongle()
+            if dev is None:
+                return
+            msg = self.queue.popleft()
+            try:
+                sms_ids = self.mngr.send_sms(dev=dev, recipient=msg.dst, utext=msg.text)
+            except ast_mngr.ManagerException as e:
+                print('ERROR: send sms:', e)
+                sms_ids = ()
+            if not sms_ids:
+                self.done(msg, 'fd')
+                continue
+            msg.parts_left = len(sms_ids)
+            msg.deadline = monotonic() + DONGLE_SMS_TIMEOUT
+            for sms_id in sms_ids:
+                self.in_flight[dev][sms_id] = msg
+
+    def on_sms_status(self, dev: str, sms_id: str, is_sent: bool):
+        msg = self.in_flight.get(dev, {}).pop(sms_id, None)
+        if msg is None:
+            return
+        if not is_sent:
+            msg.failed = True
+        msg.parts_left -= 1
+        if msg.parts_left <= 0:
+            self.done(msg, 'fd' if msg.failed else 'st')
+        self.pump()
+
+    def check_timeouts(self):
+        now = monotonic()
+        for dev, in_flight in self.in_flight.items():
+            for sms_id, msg in tuple(in_flight.items()):
+                if msg.deadline < now:
+                    print('Status for sms %s on %s has not come' % (sms_id, dev))
+                    self.on_sms_status(dev, sms_id, False)
+
+    def done(self, msg: OutMsg, status: str):
+        # id stays known until billing gets status,
+        # so message is not sent again after resync
+        self.statuses.append((msg.msg_id, status))
+        if len(self.statuses) >= STATUS_BATCH_SIZE:
+            self.flush_statuses()
+
+    def flush_statuses(self):
+        self.last_flush = monotonic()
+        if not self.statuses:
+            return
+        body = json.dumps(self.statuses).encode('utf-8')
+        result = secure_post('/dialing/api/sms/statuses/', body)
+        if result is None:
+            # billing is not available, try again later
+            return
+        print(result)
+        self.known_ids.difference_update(msg_id for msg_id, status in self.statuses)
+        self.statuses.clear()
+
+    def tick(self):
+        self.check_timeouts()
+        if monotonic() - self.last_flush >= STATUS_FLUSH_INTERVAL:
+            self.flush_statuses()
+
+
+def fetch_outbox() -> list:
+    response = secure_request({'cmd': 'get_new'})
+    if response is None:
+        return []
+    try:
+        msgs = json.loads(response.decode('utf-8'))
+    except (UnicodeDecodeError, ValueError) as e:
+        print('ERROR: bad outbox response', e)
+        return []
+    return msgs if isinstance(msgs, list) else []
+
+
+def listen_outbox_notify(addr=OUTBOX_NOTIFY_ADDR):
+    """
+    Receive new outbox messages that billing pushes by udp.
+    Datagram is sign of body, new line, and json body.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(addr)
+    while True:
+        data = sock.recv(65535)
+        sign, _, body = data.partition(b'\n')
+        if sign.decode('utf-8', 'ignore') != body_sign(body):
+            print('ERROR: bad sign of outbox notification')
+            continue
+        try:
+            msgs = json.loads(body.decode('utf-8'))
+        except (UnicodeDecodeError, ValueError) as e:
+            print('ERROR: bad outbox notification', e)
+            continue
+        if isinstance(msgs, list):
+            events.put(('outbox', msgs))
 
 
 manager = MyAstManager()
@@ -147,10 +345,10 @@ def handle_shutdown(event, mngr):
 
 
 def signal_handler(signum, frame):
-    if signum != 10:
+    # old way to say about new outbox messages
+    if signum != signal.SIGUSR1:
         return
-    global outbox_messages
-    outbox_messages = True
+    events.put(('resync',))
 
 
 def handle_inbox_long_sms_message(event, mngr):
@@ -167,15 +365,24 @@ def handle_inbox_long_sms_message(event, mngr):
         )
         if chunks_count is not None:
             # more than 1 message
-            mngr.push_text(sms=sms, ref=data.get('ref'), cnt=chunks_count)
+            mngr.push_text(sms=sms, ref=data.get('ref'), cnt=chunks_count, seq=data.get('seq'))
         else:
             # one message
             mngr.save_sms(sms)
 
 
+def handle_sms_status(event, mngr):
+    events.put((
+        'status',
+        event.get_header('Device'),
+        event.get_header('ID'),
+        event.get_header('Status') == 'Sent'
+    ))
+
+
 @pidfile(pidname='dialing.py.pid', piddir='/run')
 def main():
-    global outbox_messages
+    dispatcher = OutboxDispatcher(manager)
     try:
         manager.connect(ASTERISK_MANAGER_AUTH['host'])
         manager.login(ASTERISK_MANAGER_AUTH['username'], ASTERISK_MANAGER_AUTH['password'])
@@ -183,18 +390,34 @@ def main():
         # register some callbacks
         manager.register_event('Shutdown', handle_shutdown)
         manager.register_event('DongleNewCMGR', handle_inbox_long_sms_message)  # PDU Here
+        manager.register_event('DongleSMSStatus', handle_sms_status)
 
         # get a status report
         response = manager.status()
         print(response)
 
         signal.signal(signal.SIGUSR1, handler=signal_handler)
-
-        while True:
-            if outbox_messages:
-                outbox_messages = False
-                manager.send_from_outbox()
-            sleep(5)
+        Thread(target=listen_outbox_notify, daemon=True).start()
+
+        # messages that were created while we were not working
+        dispatcher.add_messages(fetch_outbox())
+        last_resync = monotonic()
+
+        while manager.connected():
+            try:
+                ev = events.get(timeout=STATUS_FLUSH_INTERVAL)
+            except Empty:
+                ev = None
+            if ev is not None:
+                if ev[0] == 'outbox':
+                    dispatcher.add_messages(ev[1])
+                elif ev[0] == 'status':
+                    dispatcher.on_sms_status(*ev[1:])
+            if (ev is not None and ev[0] == 'resync') or \
+                    monotonic() - last_resync > OUTBOX_RESYNC_INTERVAL:
+                last_resync = monotonic()
+                dispatcher.add_messages(fetch_outbox())
+            dispatcher.tick()
 
     except ast_mngr.ManagerSocketException as e:
         print("Error connecting to the manager: ", e)
@@ -203,6 +426,7 @@ def main():
     except ast_mngr.ManagerException as e:
         print("Error: ", e)
     finally:
+        dispatcher.flush_statuses()
         manager.logoff()
 
 
@@ -1,7 +1,19 @@
-from django.db import models
+import json
+import logging
+import socket
+from typing import Iterable
+
+from django.db import models, transaction
 from datetime import datetime
+from django.db.models.signals import post_save
+from django.dispatch import receiver
 from django.utils.translation import gettext_lazy as _
 from django.conf import settings
+from djing.lib import calc_hash
+
+
+# Address where dialing.py waits for new outbox messages
+DIALING_OUTBOX_NOTIFY_ADDR = getattr(settings, 'DIALING_OUTBOX_NOTIFY_ADDR', ('127.0.0.1', 2775))
 
 
 class AsteriskCDR(models.Model):
@@ -107,3 +119,33 @@ class SMSOut(models.Model):
 
     def __str__(self):
         return self.text
+
+
+def outbox_message_data(msg: SMSOut) -> dict:
+    return {
+        'id': msg.pk,
+        'when': round(msg.when.timestamp()),
+        'dst': msg.dst,
+        'text': msg.text
+    }
+
+
+def notify_outbox(msgs: Iterable[SMSOut]) -> None:
+    """
+    Push new messages to dialing.py by udp datagram,
+    datagram is sign of body, new line, and json body.
+    If datagram is lost then dialing.py gets message later by get_new.
+    """
+    body = json.dumps([outbox_message_data(m) for m in msgs]).encode('utf-8')
+    sign = calc_hash('_'.join((calc_hash(body), getattr(settings, 'API_AUTH_SECRET'))))
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.sendto(sign.encode() + b'\n' + body, DIALING_OUTBOX_NOTIFY_ADDR)
+    except OSError as e:
+        logging.error('Outbox notify error: %s' % e)
+
+
+@receiver(post_save, sender=SMSOut)
+def sms_out_post_save(sender, instance, created, **kwargs):
+    if created and instance.status == 'nw':
+        transaction.on_commit(lambda: notify_outbox((instance,)))
@@ -1,3 +1,89 @@
-from django.test import TestCase
+import json
+from django.shortcuts import resolve_url
+from django.test import TestCase, SimpleTestCase, override_settings
 
-# Create your tests here.
+from djing.lib import calc_hash
+from djing.lib.messaging.sms import BulkSmsEncoder, SmsSubmit
+from .models import SMSOut
+
+API_SECRET = 'test_secret'
+
+
+@override_settings(API_AUTH_SECRET=API_SECRET, API_AUTH_SUBNET='127.0.0.1')
+class SmsApiTest(TestCase):
+    def setUp(self):
+        self.msg1 = SMSOut.objects.create(dst='+79781234567', text='Test 1')
+        self.msg2 = SMSOut.objects.create(dst='+79781234568', text='Test 2')
+
+    def test_get_new(self):
+        sign = calc_hash('_'.join(('get_new', API_SECRET)))
+        r = self.client.get('/dialing/api/sms/', {'cmd': 'get_new', 'sign': sign})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(
+            sorted(m['id'] for m in r.json()),
+            [self.msg1.pk, self.msg2.pk]
+        )
+
+    def test_statuses_batch(self):
+        body = json.dumps((
+            (self.msg1.pk, 'st'),
+            (self.msg2.pk, 'fd'),
+            (self.msg2.pk, 'bad')
+        ))
+        sign = calc_hash('_'.join((calc_hash(body), API_SECRET)))
+        url = resolve_url('dialapp:sms_statuses')
+        r = self.client.post('%s?sign=%s' % (url, sign), data=body,
+                             content_type='application/json')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json()['update_count'], 2)
+        self.assertEqual(len(r.json()['errors']), 1)
+        self.assertEqual(SMSOut.objects.get(pk=self.msg1.pk).status, 'st')
+        self.assertEqual(SMSOut.objects.get(pk=self.msg2.pk).status, 'fd')
+
+
+class BulkSmsEncoderTest(SimpleTestCase):
+    number = '+79781234567'
+
+    def assertSameAsSubmit(self, text, csca=None, request_status=False, ref=7):
+        encoder = BulkSmsEncoder(csca=csca, request_status=request_status, ref_start=ref)
+        submit = SmsSubmit(self.number, text)
+        submit.csca = csca
+        submit.request_status = request_status
+        # BulkSmsEncoder uses one number as message and concatenation reference
+        submit.ref = submit.rand_id = ref
+        expected = [(p.pdu, p.length, p.cnt, p.seq) for p in submit.to_pdu()]
+        pdus = [(p.pdu, p.length, p.cnt, p.seq) for p in encoder.encode(self.number, text)]
+        self.assertListEqual(pdus, expected)
+        return pdus
+
+    def test_gsm(self):
+        self.assertSameAsSubmit('Hello, world!')
+        self.assertSameAsSubmit('a' * 160)
+        # escaped chars take 2 septets
+        self.assertSameAsSubmit('Price: 100€ {see [terms]}')
+
+    def test_ucs2(self):
+        self.assertSameAsSubmit('Привет, мир!')
+        self.assertSameAsSubmit('ж' * 70)
+
+    def test_multipart_gsm(self):
+        self.assertEqual(len(self.assertSameAsSubmit('a' * 161)), 2)
+        self.assertEqual(len(self.assertSameAsSubmit('Test {braces} [x] ~ €' * 20)), 4)
+        # escaped char is not split between parts
+        self.assertEqual(len(self.assertSameAsSubmit('a' * 152 + '€' + 'b' * 20)), 2)
+
+    def test_multipart_ucs2(self):
+        self.assertEqual(len(self.assertSameAsSubmit('ж' * 71)), 2)
+        self.assertEqual(len(self.assertSameAsSubmit('Длинный текст ' * 40)), 9)
+
+    def test_smsc_and_status_report(self):
+        self.assertSameAsSubmit('Hello', csca='+79780000000', request_status=True)
+        self.assertSameAsSubmit('Длинный текст ' * 10, csca='89780000000', request_status=True)
+
+    def test_surrogate_pair_not_split(self):
+        # SmsSubmit does not encode chars out of BMP, so only result is checked
+        text = 'x' * 66 + '\U0001f600' * 10
+        pdus = BulkSmsEncoder().encode(self.number, text)
+        self.assertEqual(len(pdus), 2)
+        self.assertTrue(pdus[0].pdu.endswith('0078'))
+        self.assertTrue(pdus[1].pdu.endswith('D83DDE00' * 8))
@@ -11,5 +11,6 @@ urlpatterns = [
     path('reports/', views.VoiceMailReportsListView.as_view(), name='vmail_report'),
     path('sms/in/', views.InboxSMSListView.as_view(), name='inbox_sms'),
     path('sms/send/', views.send_sms, name='send_sms'),
-    path('api/sms/', views.SmsManager.as_view())
+    path('api/sms/', views.SmsManager.as_view()),
+    path('api/sms/statuses/', views.SmsStatusBatch.as_view(), name='sms_statuses')
 ]
@@ -1,5 +1,5 @@
 from datetime import datetime
-from subprocess import run
+import json
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 
@@ -7,26 +7,26 @@ from django.db import ProgrammingError
 from django.shortcuts import redirect, render
 from django.utils.translation import gettext_lazy as _
 from django.utils.decorators import method_decorator
-from django.views.generic import ListView
+from django.views.decorators.csrf import csrf_exempt
 from guardian.decorators import permission_required_or_403 as permission_required
 from django.db.models import Q
-from django.conf import settings
 
-from abonapp.models import Abon
-from djing.global_base_views import SecureApiView
+from searchapp.models import SearchEntry, KIND_ABON, load_found
+from djing.global_base_views import SecureApiView, OrderedFilteredList
 from djing import JSONType
 from djing.lib import safe_int
 from djing.lib.decorators import only_admins, json_view
-from .models import AsteriskCDR, SMSModel, SMSOut
+from .models import AsteriskCDR, SMSModel, SMSOut, outbox_message_data
 from .forms import SMSOutForm
 
 
 login_decs = login_required, only_admins
 
 
-class BaseListView(ListView):
+class BaseListView(OrderedFilteredList):
     http_method_names = 'get',
-    paginate_by = getattr(settings, 'PAGINATION_ITEMS_PER_PAGE', 10)
+    keyset_pagination = True
+    approximate_count = True
 
 
 @method_decorator(login_decs, name='dispatch')
@@ -34,6 +34,8 @@ class BaseListView(ListView):
 class LastCallsListView(BaseListView):
     template_name = 'index.html'
     context_object_name = 'logs'
+    # calldate is not unique
+    keyset_unique_field = 'uniqueid'
     queryset = AsteriskCDR.objects.exclude(userfield='request')
 
     def get(self, request, *args, **kwargs):
@@ -52,14 +54,15 @@ class LastCallsListView(BaseListView):
 @login_required
 @only_admins
 def to_abon(request, tel):
-    abon = Abon.objects.filter(Q(telephone__icontains=tel) | Q(additional_telephones__telephone__icontains=tel))
-    abon_count = abon.count()
+    # two entries are enough to know that number is not unique
+    abons = load_found(SearchEntry.objects.search(tel, KIND_ABON)[:2], KIND_ABON)
+    abon_count = len(abons)
     if abon_count > 1:
         messages.warning(request, _('Multiple users with the telephone number'))
     elif abon_count == 0:
         messages.error(request, _('User with the telephone number not found'))
         return redirect('dialapp:home')
-    abon = abon[0]
+    abon = abons[0]
     if abon.group:
         return redirect('abonapp:abon_home', gid=abon.group.pk, uname=abon.username)
     else:
@@ -70,6 +73,8 @@ def to_abon(request, tel):
 class VoiceMailRequestsListView(BaseListView):
     template_name = 'vmail.html'
     context_object_name = 'vmessages'
+    # calldate is not unique
+    keyset_unique_field = 'uniqueid'
     queryset = AsteriskCDR.objects.filter(userfield='request')
 
     def get_context_data(self, **kwargs):
@@ -91,6 +96,8 @@ class VoiceMailReportsListView(VoiceMailRequestsListView):
 class DialsFilterListView(BaseListView):
     context_object_name = 'logs'
     template_name = 'index.html'
+    # calldate is not unique
+    keyset_unique_field = 'uniqueid'
 
     def get_context_data(self, **kwargs):
         context = super(DialsFilterListView, self).get_context_data(**kwargs)
@@ -139,15 +146,9 @@ def send_sms(request):
     if request.method == 'POST':
         frm = SMSOutForm(request.POST)
         if frm.is_valid():
+            # dialing.py gets notification from post_save of SMSOut
             frm.save()
             messages.success(request, _('Message was enqueued for sending'))
-            pidfile_name = '/run/dialing.py.pid'
-            try:
-                with open(pidfile_name, 'r') as f:
-                    pid = int(f.read())
-                run(['/usr/bin/kill', '-SIGUSR1', str(pid)])
-            except FileNotFoundError:
-                print('Failed sending, %s not found' % pidfile_name)
             if path:
                 return redirect(path)
             else:
@@ -205,9 +206,46 @@ class SmsManager(SecureApiView):
     @staticmethod
     def get_new() -> JSONType:
         msgs = SMSOut.objects.filter(status='nw').defer('status')
-        res = [{
-            'when': round(m.timestamp),
-            'dst': m.dst,
-            'text': m.text
-        } for m in msgs]
-        return res
+        return [outbox_message_data(m) for m in msgs.iterator()]
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class SmsStatusBatch(SecureApiView):
+    #
+    # Api view for statuses of many sent sms at once.
+    # Body is json list of [message id, status] pairs.
+    #
+    http_method_names = ('post',)
+
+    @method_decorator(json_view)
+    def post(self, request):
+        try:
+            statuses = json.loads(request.body.decode('utf-8'))
+        except (UnicodeDecodeError, ValueError) as e:
+            return {'text': 'Bad json: %s' % e}
+        if not isinstance(statuses, list):
+            return {'text': 'Statuses must be a list of [id, status] pairs'}
+
+        allowed_statuses = dict(SMSOut.SMS_OUT_STATUS)
+        ids_by_status = {}
+        errors = []
+        for st in statuses:
+            try:
+                msg_id, status = st
+            except (TypeError, ValueError):
+                errors.append('Bad status %s' % st)
+                continue
+            msg_id = safe_int(msg_id)
+            if msg_id == 0 or status not in allowed_statuses:
+                errors.append('Bad status %s' % st)
+                continue
+            ids_by_status.setdefault(status, []).append(msg_id)
+
+        update_count = 0
+        for status, ids in ids_by_status.items():
+            update_count += SMSOut.objects.filter(pk__in=ids).update(status=status)
+        return {
+            'text': 'Statuses updated',
+            'update_count': update_count,
+            'errors': errors
+        }
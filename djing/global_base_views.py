@@ -1,4 +1,3 @@
-from ipaddress import ip_address, ip_network
 from json import dumps
 
 from django.utils.decorators import method_decorator
@@ -8,7 +7,9 @@ from django.utils.translation import gettext_lazy as _
 from django.conf import settings
 from django.views.generic import ListView
 from django.core.paginator import InvalidPage, EmptyPage
+from djing.lib.api_auth import is_allowed_ip
 from djing.lib.decorators import hash_auth_view
+from djing.lib.keyset_paginator import KeysetPaginator
 
 
 class RedirectWhenError(Exception):
@@ -50,18 +51,8 @@ class AllowedSubnetMixin(object):
         Check if user ip in allowed subnet.
         Return 403 denied otherwise.
         """
-        ip = ip_address(request.META.get('REMOTE_ADDR'))
-        api_auth_subnet = getattr(settings, 'API_AUTH_SUBNET')
-        if type(api_auth_subnet) is str:
-            if ip in ip_network(api_auth_subnet):
-                return super(AllowedSubnetMixin, self).dispatch(request, *args, **kwargs)
-        try:
-            for subnet in api_auth_subnet:
-                if ip in ip_network(subnet, strict=False):
-                    return super(AllowedSubnetMixin, self).dispatch(request, *args, **kwargs)
-        except TypeError:
-            if ip in ip_network(str(api_auth_subnet)):
-                return super(AllowedSubnetMixin, self).dispatch(request, *args, **kwargs)
+        if is_allowed_ip(request.META.get('REMOTE_ADDR')):
+            return super(AllowedSubnetMixin, self).dispatch(request, *args, **kwargs)
         return HttpResponseForbidden('Access Denied')
 
 
@@ -111,6 +102,7 @@ class BaseListWithFiltering(RedirectWhenErrorMixin, ListView):
     When queryset contains filter and pagination than data may be missing,
     and original code is raising 404 error. We want to redirect without pagination.
     """
+    cursor_kwarg = 'cursor'
 
     def paginate_queryset(self, queryset, page_size):
         paginator = self.get_paginator(
@@ -126,12 +118,16 @@ class BaseListWithFiltering(RedirectWhenErrorMixin, ListView):
             else:
                 raise Http404(_("Page is not 'last', nor can it be converted to an int."))
         try:
-            page = paginator.page(page_number)
+            if isinstance(paginator, KeysetPaginator):
+                page = paginator.page(page_number, self.request.GET.get(self.cursor_kwarg))
+            else:
+                page = paginator.page(page_number)
             return paginator, page, page.object_list, page.has_other_pages()
         except EmptyPage:
             # remove pagination from url
             url = self.request.GET.copy()
-            del url[self.page_kwarg]
+            url.pop(self.page_kwarg, None)
+            url.pop(self.cursor_kwarg, None)
             raise RedirectWhenError("%s?%s" % (self.request.path, url.urlencode()),
                                     _('Filter does not contains data, filter without pagination'))
         except InvalidPage as e:
@@ -142,4 +138,28 @@ class BaseListWithFiltering(RedirectWhenErrorMixin, ListView):
 
 
 class OrderedFilteredList(OrderingMixin, BaseListWithFiltering):
+    """
+    @keyset_pagination - neighbour pages are fetched by seeking after
+    boundary row instead of OFFSET, good for big tables.
+    @approximate_count - number of pages is taken from cached count
+    or table statistics, so COUNT(*) is not made for each page.
+    @keyset_unique_field - field that is appended to ordering to make it stable.
+    """
     paginate_by = getattr(settings, 'PAGINATION_ITEMS_PER_PAGE', 10)
+    keyset_pagination = False
+    approximate_count = False
+    keyset_unique_field = 'pk'
+
+    def get_paginator(self, queryset, per_page, orphans=0,
+                      allow_empty_first_page=True, **kwargs):
+        if self.keyset_pagination:
+            return KeysetPaginator(
+                queryset, per_page,
+                allow_empty_first_page=allow_empty_first_page,
+                approximate=self.approximate_count,
+                unique_field=self.keyset_unique_field
+            )
+        return super(OrderedFilteredList, self).get_paginator(
+            queryset, per_page, orphans=orphans,
+            allow_empty_first_page=allow_empty_first_page, **kwargs
+        )
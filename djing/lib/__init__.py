@@ -104,6 +104,26 @@ def check_sign(get_list, sign):
     return sign == my_sign
 
 
+class LazyValue(object):
+    """
+    Value for template context that is counted only when template
+    reads it, and only once. Templates call callable variables,
+    so pages that do not show the value make no queries for it.
+    """
+    __slots__ = ('_fn', '_args', '_value', '_done')
+
+    def __init__(self, fn, *args):
+        self._fn = fn
+        self._args = args
+        self._done = False
+
+    def __call__(self):
+        if not self._done:
+            self._value = self._fn(*self._args)
+            self._done = True
+        return self._value
+
+
 class ProcessLocked(OSError):
     """only one process for function"""
 
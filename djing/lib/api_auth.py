@@ -0,0 +1,118 @@
+"""
+Auth of api requests from scripts and agents, shared by SecureApiView
+and hash_auth_view. Request passes when it comes from API_AUTH_SUBNET
+and its sign is sha256 of sorted GET values, hash of POST body and
+API_AUTH_SECRET, joined by '_'.
+"""
+import logging
+from functools import lru_cache
+from hmac import compare_digest
+from time import time
+from typing import Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from djing.lib import calc_hash
+from djing.lib.net_index import NetworkIndex
+
+_NONCE_KEY = 'api_auth_sign_%s'
+
+# Each process of uwsgi has own cache with these backends
+_LOCAL_CACHE_BACKENDS = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache'
+)
+
+
+def _is_cache_shared() -> bool:
+    return settings.CACHES['default']['BACKEND'] not in _LOCAL_CACHE_BACKENDS
+
+
+def _subnets_list(api_auth_subnet) -> list:
+    if isinstance(api_auth_subnet, str):
+        return [api_auth_subnet]
+    try:
+        return [str(net) for net in api_auth_subnet]
+    except TypeError:
+        return [str(api_auth_subnet)]
+
+
+@lru_cache(maxsize=1)
+def _allowed_subnets() -> NetworkIndex:
+    return NetworkIndex(
+        (net, net) for net in _subnets_list(getattr(settings, 'API_AUTH_SUBNET'))
+    )
+
+
+@lru_cache(maxsize=1024)
+def is_allowed_ip(ip: Optional[str]) -> bool:
+    """
+    Check if ip is in API_AUTH_SUBNET. Requests come from few
+    addresses of scripts, so result is cached by address.
+    """
+    if not ip:
+        return False
+    return _allowed_subnets().find(ip) is not None
+
+
+@lru_cache(maxsize=4096)
+def _is_valid_sign(values: tuple, body_hash: Optional[str], sign: str, secret: str) -> bool:
+    # Agents repeat the same requests, so result is cached by values.
+    # Secret is in key, so cache is not valid after it is changed.
+    values_list = sorted(values)
+    if body_hash is not None:
+        values_list.append(body_hash)
+    values_list.append(secret)
+    # compare_digest does not take str with not ascii chars
+    return compare_digest(calc_hash('_'.join(values_list)).encode(), sign.encode())
+
+
+def check_request_sign(request) -> bool:
+    sign = request.GET.get('sign')
+    if not sign:
+        return False
+    values = tuple(v for k, v in request.GET.items() if k != 'sign' and v)
+    # Body of POST request is signed by its hash
+    body_hash = None
+    if request.method == 'POST' and request.body:
+        body_hash = calc_hash(request.body)
+    if not _is_valid_sign(values, body_hash, sign, getattr(settings, 'API_AUTH_SECRET')):
+        return False
+    return _check_replay(request.GET.get('ts'), sign)
+
+
+def _check_replay(ts: Optional[str], sign: str) -> bool:
+    """
+    Request with param ts (unix time) is accepted only within
+    API_AUTH_REPLAY_WINDOW seconds, and only once: sign of accepted
+    request is kept in cache. ts is signed with other GET values,
+    so it can not be changed. Script adds param nonce with random
+    value if it sends the same request repeatedly.
+    """
+    require_ts = getattr(settings, 'API_AUTH_REQUIRE_TIMESTAMP', False)
+    if require_ts and not _is_cache_shared():
+        # each process would remember only own signs
+        logging.error('API_AUTH_REQUIRE_TIMESTAMP needs cache shared by processes '
+                      'in CACHES, api requests are refused')
+        return False
+    if not ts:
+        # scripts that do not send ts yet
+        return not require_ts
+    try:
+        ts = int(ts)
+    except ValueError:
+        return False
+    window = getattr(settings, 'API_AUTH_REPLAY_WINDOW', 60)
+    if abs(time() - ts) > window:
+        return False
+    return cache.add(_NONCE_KEY % sign, 1, window * 2)
+
+
+@receiver(setting_changed)
+def api_auth_subnet_changed(sender, setting, **kwargs):
+    if setting == 'API_AUTH_SUBNET':
+        _allowed_subnets.cache_clear()
+        is_allowed_ip.cache_clear()
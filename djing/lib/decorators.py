@@ -3,7 +3,7 @@ from django.conf import settings
 from django.http import HttpResponseRedirect, HttpResponseForbidden, JsonResponse
 from django.shortcuts import redirect
 
-from djing.lib import check_sign
+from djing.lib.api_auth import check_request_sign
 
 
 def require_ssl(view):
@@ -39,21 +39,9 @@ def only_admins(fn):
 def hash_auth_view(fn):
     @wraps(fn)
     def wrapped(request, *args, **kwargs):
-        api_auth_secret = getattr(settings, 'API_AUTH_SECRET')
-        sign = request.GET.get('sign')
-        if sign is None or sign == '':
-            return HttpResponseForbidden('Access Denied')
-
-        # Transmittent get list without sign
-        get_values = request.GET.copy()
-        del get_values['sign']
-        values_list = [l for l in get_values.values() if l]
-        values_list.sort()
-        values_list.append(api_auth_secret)
-        if check_sign(values_list, sign):
+        if check_request_sign(request):
             return fn(request, *args, **kwargs)
-        else:
-            return HttpResponseForbidden('Access Denied')
+        return HttpResponseForbidden('Access Denied')
     return wrapped
 
 
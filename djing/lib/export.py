@@ -0,0 +1,257 @@
+import csv
+import os
+import re
+from datetime import date, datetime
+from secrets import token_hex
+from time import time
+from decimal import Decimal
+from typing import Iterable, Optional, Generator, Sequence
+from xml.sax.saxutils import escape
+from zipfile import ZipFile, ZIP_DEFLATED
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+
+# Rows of queryset are read by chunks of this size
+EXPORT_CHUNK_SIZE = 2000
+
+# Files of background exports, it must not be served by web server
+# because exports contain personal data of subscribers
+EXPORT_DIR = getattr(settings, 'EXPORT_DIR', os.path.join(settings.BASE_DIR, 'exports'))
+
+# Exports older than this are removed, in seconds
+EXPORT_FILE_TTL = getattr(settings, 'EXPORT_FILE_TTL', 24 * 3600)
+
+_TOKEN_REGEX = re.compile(r'^[0-9a-f]{32}$')
+
+# Output is sent to client by pieces of about this size
+_FLUSH_SIZE = 64 * 1024
+
+FORMATS = {
+    'csv': 'text/csv',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+}
+
+# Symbols that are not allowed in xml 1.0
+_XML_ILLEGAL = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+class _Buffer(object):
+    """
+    File-like object that keeps written data until it is taken,
+    so writers like csv and zipfile can be used in generator
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self._chunks.append(data)
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(c.encode() if isinstance(c, str) else bytes(c) for c in self._chunks)
+        self._chunks.clear()
+        self.size = 0
+        return data
+
+
+def iter_by_pk(queryset, *fields, chunk_size: int = EXPORT_CHUNK_SIZE) -> Generator:
+    """
+    Rows of queryset.values_list(*fields), ordered by pk. Each chunk is
+    a separate query that seeks after last pk, because mysqlclient
+    loads all result set into memory even for iterator().
+    """
+    qs = queryset.order_by('pk').values_list('pk', *fields)
+    last_pk = None
+    while True:
+        chunk = list((qs if last_pk is None else qs.filter(pk__gt=last_pk))[:chunk_size])
+        for row in chunk:
+            yield row[1:]
+        if len(chunk) < chunk_size:
+            break
+        last_pk = chunk[-1][0]
+
+
+def csv_stream(rows: Iterable[Sequence], header: Optional[Sequence] = None) -> Generator:
+    buf = _Buffer()
+    writer = csv.writer(buf, quoting=csv.QUOTE_NONNUMERIC)
+    if header:
+        writer.writerow(header)
+    for row in rows:
+        writer.writerow(row)
+        if buf.size > _FLUSH_SIZE:
+            yield buf.take()
+    yield buf.take()
+
+
+def _col_name(n: int) -> str:
+    name = ''
+    n += 1
+    while n:
+        n, rem = divmod(n - 1, 26)
+        name = chr(65 + rem) + name
+    return name
+
+
+def _xlsx_cell(ref: str, val) -> str:
+    if val is None:
+        return ''
+    if isinstance(val, bool):
+        return '<c r="%s" t="b"><v>%d</v></c>' % (ref, val)
+    if isinstance(val, (int, float, Decimal)):
+        return '<c r="%s"><v>%s</v></c>' % (ref, val)
+    if isinstance(val, datetime):
+        val = val.strftime('%Y-%m-%d %H:%M:%S')
+    elif isinstance(val, date):
+        val = val.strftime('%Y-%m-%d')
+    val = _XML_ILLEGAL.sub('', str(val))
+    return '<c r="%s" t="inlineStr"><is><t xml:space="preserve">%s</t></is></c>' % (ref, escape(val))
+
+
+_XLSX_STATIC_PARTS = (
+    ('[Content_Types].xml',
+     '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+     '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+     '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+     '<Default Extension="xml" ContentType="application/xml"/>'
+     '<Override PartName="/xl/workbook.xml" '
+     'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+     '<Override PartName="/xl/worksheets/sheet1.xml" '
+     'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+     '</Types>'),
+    ('_rels/.rels',
+     '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+     '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+     '<Relationship Id="rId1" '
+     'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+     'Target="xl/workbook.xml"/>'
+     '</Relationships>'),
+    ('xl/workbook.xml',
+     '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+     '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+     'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+     '<sheets><sheet name="Sheet1" sheetId="1" r:id="rId1"/></sheets>'
+     '</workbook>'),
+    ('xl/_rels/workbook.xml.rels',
+     '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+     '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+     '<Relationship Id="rId1" '
+     'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+     'Target="worksheets/sheet1.xml"/>'
+     '</Relationships>')
+)
+
+
+def xlsx_stream(rows: Iterable[Sequence], header: Optional[Sequence] = None) -> Generator:
+    """
+    Minimal xlsx workbook with one sheet. Strings are inline,
+    so rows are written as they come, without shared strings table.
+    Zip is written to unseekable buffer, with data descriptors.
+    """
+    buf = _Buffer()
+    with ZipFile(buf, 'w', compression=ZIP_DEFLATED) as zf:
+        for name, content in _XLSX_STATIC_PARTS:
+            zf.writestr(name, content)
+        with zf.open('xl/worksheets/sheet1.xml', 'w') as sheet:
+            sheet.write(
+                b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                b'<sheetData>'
+            )
+            all_rows = rows if header is None else _chain_header(header, rows)
+            for row_num, row in enumerate(all_rows, 1):
+                sheet.write(('<row r="%d">%s</row>' % (row_num, ''.join(
+                    _xlsx_cell('%s%d' % (_col_name(col), row_num), val)
+                    for col, val in enumerate(row)
+                ))).encode())
+                if buf.size > _FLUSH_SIZE:
+                    yield buf.take()
+            sheet.write(b'</sheetData></worksheet>')
+    yield buf.take()
+
+
+def _chain_header(header, rows):
+    yield header
+    yield from rows
+
+
+def export_stream(rows: Iterable[Sequence], fmt: str, header: Optional[Sequence] = None) -> Generator:
+    """
+    :param rows: iterable of row tuples, from iter_by_pk for example
+    :param fmt: one of FORMATS keys
+    :param header: names of columns
+    :return: generator of bytes
+    """
+    if fmt == 'xlsx':
+        return xlsx_stream(rows, header)
+    elif fmt == 'csv':
+        return csv_stream(rows, header)
+    raise ValueError('Unexpected export format "%s"' % fmt)
+
+
+def export_response(rows: Iterable[Sequence], fmt: str, filename: str,
+                    header: Optional[Sequence] = None) -> StreamingHttpResponse:
+    """
+    Response that sends file while rows are read, so memory
+    does not depend on count of rows
+    :param filename: name of file without extension
+    """
+    response = StreamingHttpResponse(export_stream(rows, fmt, header), content_type=FORMATS[fmt])
+    response['Content-Disposition'] = 'attachment; filename="%s.%s"' % (filename, fmt)
+    return response
+
+
+def new_export_token() -> str:
+    return token_hex(16)
+
+
+def export_file_path(user_id: int, token: str, fmt: str) -> str:
+    """
+    Each user has own directory, so user can download only own exports
+    """
+    if not _TOKEN_REGEX.match(token) or fmt not in FORMATS:
+        raise ValueError('Bad export token or format')
+    return os.path.join(EXPORT_DIR, str(int(user_id)), '%s.%s' % (token, fmt))
+
+
+def remove_old_exports(user_id: int) -> None:
+    user_dir = os.path.join(EXPORT_DIR, str(int(user_id)))
+    if not os.path.isdir(user_dir):
+        return
+    old_time = time() - EXPORT_FILE_TTL
+    for name in os.listdir(user_dir):
+        path = os.path.join(user_dir, name)
+        try:
+            if os.path.getmtime(path) < old_time:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def export_to_file(path: str, rows: Iterable[Sequence], fmt: str,
+                   header: Optional[Sequence] = None) -> None:
+    """
+    Write export to file. File appears under path only
+    when it is complete, so half-written file is never sent.
+    If export fails, empty file path.error is left, so user
+    does not wait for it.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = '%s.part' % path
+    try:
+        with open(tmp_path, 'wb') as f:
+            for chunk in export_stream(rows, fmt, header):
+                f.write(chunk)
+        os.replace(tmp_path, path)
+    except Exception:
+        open('%s.error' % path, 'w').close()
+        raise
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
@@ -0,0 +1,143 @@
+import re
+from ipaddress import ip_address
+from socket import inet_pton, AF_INET
+from typing import Iterable, List, Optional, Union
+
+IpType = Union[int, str]
+
+# Byte with at least one free address
+_NOT_FULL_BYTE = re.compile(b'[^\xff]')
+
+
+def _ip2int(ip: IpType) -> Optional[int]:
+    if isinstance(ip, int):
+        return ip
+    try:
+        # much faster than ipaddress for ipv4
+        return int.from_bytes(inet_pton(AF_INET, ip), 'big')
+    except (OSError, TypeError):
+        pass
+    try:
+        return int(ip_address(ip))
+    except ValueError:
+        return
+
+
+class IpBitmap(object):
+    """
+    Occupancy bitmap of ip range, one bit for each address.
+    Free address is found by searching byte that is not 0xff,
+    search goes in C by re module, so for /12 network it takes
+    a fraction of millisecond instead of walking over all hosts.
+    """
+
+    def __init__(self, first: int, last: int, used: Iterable[IpType] = ()):
+        """
+        :param first: first address of range as integer
+        :param last: last address of range as integer
+        :param used: addresses that are employed
+        """
+        if last < first:
+            raise ValueError('Ip range is empty')
+        self.first = first
+        self.size = last - first + 1
+        self._bits = bytearray((self.size + 7) // 8)
+        # bits after end of range are busy, so they are never found
+        tail = len(self._bits) * 8 - self.size
+        if tail:
+            self._bits[-1] = (0xff << (8 - tail)) & 0xff
+        self.set_used_many(used)
+
+    def _offset(self, ip: IpType) -> Optional[int]:
+        ip = _ip2int(ip)
+        if ip is None:
+            return
+        offset = ip - self.first
+        if 0 <= offset < self.size:
+            return offset
+
+    def set_used(self, ip: IpType) -> None:
+        offset = self._offset(ip)
+        if offset is not None:
+            self._bits[offset >> 3] |= 1 << (offset & 7)
+
+    def set_used_many(self, ips: Iterable[IpType]) -> None:
+        bits = self._bits
+        first = self.first
+        size = self.size
+        for ip in ips:
+            ip = _ip2int(ip)
+            if ip is None:
+                continue
+            offset = ip - first
+            if 0 <= offset < size:
+                bits[offset >> 3] |= 1 << (offset & 7)
+
+    def set_free(self, ip: IpType) -> None:
+        offset = self._offset(ip)
+        if offset is not None:
+            self._bits[offset >> 3] &= ~(1 << (offset & 7)) & 0xff
+
+    def is_used(self, ip: IpType) -> bool:
+        offset = self._offset(ip)
+        if offset is None:
+            return False
+        return bool(self._bits[offset >> 3] & (1 << (offset & 7)))
+
+    def find_free(self, start: int = 0) -> Optional[int]:
+        """
+        Find first free address from offset start
+        :return: offset of free address from beginning of range, or None
+        """
+        bits = self._bits
+        i = start >> 3
+        if i >= len(bits):
+            return
+        # rest of first byte, bits before start are considered busy
+        b = bits[i] | ((1 << (start & 7)) - 1)
+        if b == 0xff:
+            m = _NOT_FULL_BYTE.search(bits, i + 1)
+            if m is None:
+                return
+            i = m.start()
+            b = bits[i]
+        # lowest zero bit of byte
+        return (i << 3) + ((~b & (b + 1)).bit_length() - 1)
+
+    def allocate(self, count: int = 1) -> List[int]:
+        """
+        Find and mark as used up to count free addresses
+        :return: list of integer addresses, shorter than count
+                 if range has not enough free addresses
+        """
+        res = []
+        offset = 0
+        while len(res) < count:
+            offset = self.find_free(offset)
+            if offset is None:
+                break
+            self._bits[offset >> 3] |= 1 << (offset & 7)
+            res.append(self.first + offset)
+            offset += 1
+        return res
+
+    def free_count(self) -> int:
+        # tail bits are set too, so they are not counted as free
+        return len(self._bits) * 8 - bin(int.from_bytes(self._bits, 'little')).count('1')
+
+    def to_bytes(self) -> bytes:
+        return bytes(self._bits)
+
+    @classmethod
+    def from_bytes(cls, first: int, last: int, data: bytes):
+        bm = cls(first, last)
+        if len(data) != len(bm._bits):
+            raise ValueError('Size of bitmap does not match ip range')
+        bm._bits = bytearray(data)
+        return bm
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, ip: IpType):
+        return self.is_used(ip)
@@ -0,0 +1,64 @@
+"""
+Compare search of free ip by walking over network hosts,
+as it was in NetworkModel.get_free_ip, with IpBitmap.
+Run: python3 -m djing.lib.ip_bitmap_benchmark [busy percent]
+"""
+import sys
+from ipaddress import ip_network, ip_address
+from time import perf_counter
+
+from djing.lib.ip_bitmap import IpBitmap
+
+NETWORKS = ('10.0.0.0/24', '10.0.0.0/16', '10.0.0.0/12')
+
+
+def walk_hosts(network, employed_ips):
+    # old algorithm, employed_ips is sorted generator of ip strings
+    for ip in network.hosts():
+        used_ip = next(employed_ips, None)
+        if used_ip is None:
+            return ip
+        if ip < ip_address(used_ip):
+            return ip
+
+
+def bench(net: str, busy_percent: int):
+    network = ip_network(net)
+    first = int(network.network_address) + 1
+    last = int(network.broadcast_address) - 1
+    busy = (last - first + 1) * busy_percent // 100
+    used = [str(ip_address(first + i)) for i in range(busy)]
+
+    t = perf_counter()
+    old_ip = walk_hosts(network, iter(used))
+    walk_time = perf_counter() - t
+
+    t = perf_counter()
+    bm = IpBitmap(first, last, used)
+    build_time = perf_counter() - t
+
+    data = bm.to_bytes()
+    t = perf_counter()
+    bm = IpBitmap.from_bytes(first, last, data)
+    new_ip = ip_address(bm.allocate(1)[0])
+    alloc_time = perf_counter() - t
+    assert old_ip == new_ip
+
+    t = perf_counter()
+    bm.allocate(1000)
+    bulk_time = perf_counter() - t
+
+    print('%-12s walk hosts: %9.3f ms, bitmap build: %9.3f ms, '
+          'load and allocate: %7.3f ms, allocate 1000: %7.3f ms' % (
+              net, walk_time * 1000, build_time * 1000,
+              alloc_time * 1000, bulk_time * 1000))
+
+
+def main(busy_percent: int):
+    print('%d%% of addresses are busy' % busy_percent)
+    for net in NETWORKS:
+        bench(net, busy_percent)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 90)
@@ -0,0 +1,184 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import repeat
+from ipaddress import IPv4Address, AddressValueError
+from typing import Iterable, Iterator, Tuple, Optional, Union, List
+
+IpType = Union[int, str, IPv4Address]
+
+
+def ip2int(ip: IpType) -> Optional[int]:
+    """
+    Convert ipv4 address to integer, like INET_ATON in mysql.
+    :param ip: str, int or IPv4Address
+    :return: integer presentation, or None if ip is not valid ipv4
+    """
+    if isinstance(ip, int):
+        return ip
+    try:
+        return int(IPv4Address(ip))
+    except (AddressValueError, ValueError):
+        return
+
+
+class IpAccountIndex(object):
+    """
+    Lookup table from ipv4 address to subscriber account id.
+    Ip address is unique only for one NAS, so entries are keyed by
+    (ip, nas_id) and kept sorted in arrays array('I'), searched by bisect,
+    so table is compact and may be rebuilt from db quickly.
+    """
+
+    def __init__(self, rows: Iterable[Tuple] = ()):
+        self._ips = array('I')
+        self._nas = array('I')
+        self._accs = array('I')
+        self._by_account = {}
+        self._bulk_cache = None
+        self.rebuild(rows)
+
+    def rebuild(self, rows: Iterable[Tuple]) -> None:
+        """
+        Replace all table contents.
+        :param rows: iterable of (ip, account_id) or (ip, account_id, nas_id)
+        """
+        by_key = {}
+        for row in rows:
+            ip, acc_id = ip2int(row[0]), row[1]
+            if ip is None or acc_id is None:
+                continue
+            nas_id = row[2] if len(row) > 2 else None
+            by_key[ip, nas_id or 0] = int(acc_id)
+        keys = sorted(by_key)
+        self._ips = array('I', (k[0] for k in keys))
+        self._nas = array('I', (k[1] for k in keys))
+        self._accs = array('I', (by_key[k] for k in keys))
+        self._by_account = {acc: key for key, acc in by_key.items()}
+        self._bulk_cache = None
+
+    def _range(self, ip: int) -> range:
+        return range(bisect_left(self._ips, ip), bisect_right(self._ips, ip))
+
+    def _find(self, ip: int, nas_id: int) -> int:
+        for i in self._range(ip):
+            if self._nas[i] == nas_id:
+                return i
+        return -1
+
+    def get(self, ip: IpType, default=None, nas_id: Optional[int] = None) -> Optional[int]:
+        """
+        :param nas_id: if it is None then the first account that
+                       has this ip on any NAS is returned
+        """
+        ip = ip2int(ip)
+        if ip is None:
+            return default
+        if nas_id is None:
+            r = self._range(ip)
+            return self._accs[r.start] if r else default
+        i = self._find(ip, nas_id)
+        if i < 0:
+            return default
+        return self._accs[i]
+
+    def get_all(self, ip: IpType) -> List[int]:
+        """
+        :return: ids of accounts that have this ip on different NAS
+        """
+        ip = ip2int(ip)
+        if ip is None:
+            return []
+        return [self._accs[i] for i in self._range(ip)]
+
+    def _remove(self, i: int) -> None:
+        acc_id = self._accs[i]
+        if self._by_account.get(acc_id) == (self._ips[i], self._nas[i]):
+            del self._by_account[acc_id]
+        del self._ips[i]
+        del self._nas[i]
+        del self._accs[i]
+        self._bulk_cache = None
+
+    def remove_ip(self, ip: IpType, nas_id: Optional[int] = None) -> None:
+        """
+        :param nas_id: if it is None then ip is removed on all NAS
+        """
+        ip = ip2int(ip)
+        if ip is None:
+            return
+        if nas_id is None:
+            for i in reversed(self._range(ip)):
+                self._remove(i)
+            return
+        i = self._find(ip, nas_id)
+        if i >= 0:
+            self._remove(i)
+
+    def remove_account(self, account_id: int) -> None:
+        key = self._by_account.get(account_id)
+        if key is not None:
+            self.remove_ip(*key)
+
+    def set_account_ip(self, account_id: int, ip: Optional[IpType], nas_id: Optional[int] = None) -> None:
+        """
+        Attach ip to account, old ip of account is forgotten.
+        If ip is None then account is removed from table.
+        """
+        self.remove_account(account_id)
+        ip = ip2int(ip) if ip is not None else None
+        if ip is None:
+            return
+        nas_id = nas_id or 0
+        i = self._find(ip, nas_id)
+        if i >= 0:
+            # ip was owned by another account on the same NAS
+            other_acc = self._accs[i]
+            if self._by_account.get(other_acc) == (ip, nas_id):
+                del self._by_account[other_acc]
+            self._accs[i] = account_id
+        else:
+            r = self._range(ip)
+            i = r.start
+            while i < r.stop and self._nas[i] < nas_id:
+                i += 1
+            self._ips.insert(i, ip)
+            self._nas.insert(i, nas_id)
+            self._accs.insert(i, account_id)
+        self._by_account[account_id] = (ip, nas_id)
+        self._bulk_cache = None
+
+    def attribute(self, ips: Iterable[int], default=0) -> Iterator:
+        """
+        Find account id for each of integer ip addresses.
+        Used for bulk attribution of flow records. Flows do not
+        know NAS, so ip that is used on several NAS is attributed
+        to the first of its accounts.
+        :param ips: iterable of integer ipv4 addresses
+        :param default: value for ip that is not owned by anyone
+        :return: iterator of account ids
+        """
+        # Hash table is built once after each change of index,
+        # it is much faster than bisect for millions of lookups
+        cache = self._bulk_cache
+        if cache is None:
+            cache = {}
+            for ip, acc in zip(self._ips, self._accs):
+                cache.setdefault(ip, acc)
+            self._bulk_cache = cache
+        return map(cache.get, ips, repeat(default))
+
+    def items(self) -> Iterator:
+        return zip(self._ips, self._accs)
+
+    def dump(self, f) -> None:
+        """
+        Write table into file object in format that djing_flow understands.
+        """
+        f.write("count: %d\n" % len(self))
+        f.writelines("%d-%d\n" % pair for pair in self.items())
+
+    def __len__(self):
+        return len(self._ips)
+
+    def __contains__(self, ip: IpType):
+        return self.get(ip) is not None
@@ -0,0 +1,314 @@
+import json
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from binascii import Error as Base64Error
+from hashlib import md5
+from math import ceil
+from typing import Optional, List, Tuple
+from zlib import crc32
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError, FieldError, EmptyResultSet, FieldDoesNotExist
+from django.core.paginator import Paginator, Page, EmptyPage, PageNotAnInteger
+from django.db import connections, models
+from django.db.models import Q
+from django.utils.functional import cached_property
+from django.utils.translation import gettext_lazy as _
+
+COUNT_CACHE_KEY = 'keyset_count_%s'
+COUNT_CACHE_TIMEOUT = getattr(settings, 'PAGINATION_COUNT_CACHE_TIMEOUT', 60)
+# statistics of small tables are not precise, and counting them is cheap
+ESTIMATE_MIN_ROWS = 100000
+
+OrderField = Tuple[str, bool]
+
+
+def approximate_count(queryset) -> int:
+    """
+    Count of rows that may be stale or estimated.
+    For unfiltered table in MySQL it is estimate from table statistics,
+    otherwise exact count that is cached for COUNT_CACHE_TIMEOUT seconds.
+    """
+    query = queryset.query
+    if not query.where and not query.distinct and connections[queryset.db].vendor == 'mysql':
+        with connections[queryset.db].cursor() as cur:
+            cur.execute(
+                'SELECT TABLE_ROWS FROM information_schema.TABLES '
+                'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s',
+                (queryset.model._meta.db_table,)
+            )
+            row = cur.fetchone()
+        if row and row[0] and row[0] > ESTIMATE_MIN_ROWS:
+            return row[0]
+    try:
+        sql = str(query)
+    except EmptyResultSet:
+        return 0
+    cache_key = COUNT_CACHE_KEY % md5(sql.encode()).hexdigest()
+    count = cache.get(cache_key)
+    if count is None:
+        count = queryset.count()
+        cache.set(cache_key, count, COUNT_CACHE_TIMEOUT)
+    return count
+
+
+class KeysetPage(Page):
+    """
+    Page with the same interface as django Page, so templates
+    are not changed. It knows whether next page exists without
+    count, and has cursors for neighbour pages.
+    """
+
+    def __init__(self, object_list, number, paginator, has_next: bool,
+                 next_cursor: Optional[str] = None,
+                 previous_cursor: Optional[str] = None):
+        super(KeysetPage, self).__init__(object_list, number, paginator)
+        self._has_next = has_next
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self.number > 1
+
+    def next_page_number(self):
+        if not self._has_next:
+            raise EmptyPage(_('That page contains no results'))
+        return self.number + 1
+
+    def previous_page_number(self):
+        if self.number < 2:
+            raise EmptyPage(_('That page number is less than 1'))
+        return self.number - 1
+
+
+class KeysetPaginator(Paginator):
+    """
+    Paginator that seeks rows after last row of previous page
+    by ordering fields instead of OFFSET. Ordering is made stable
+    by adding unique field to the end of it.
+    Neighbour pages are reached by cursor, that contains key of
+    boundary row, last page is taken from the end of reversed ordering.
+    Other pages, or ordering that can not be used as a key,
+    are fetched by OFFSET like in usual Paginator. Ordering by
+    nullable field is not seeked too, because rows with NULL
+    are not found by comparison.
+    """
+
+    def __init__(self, object_list, per_page, orphans=0,
+                 allow_empty_first_page=True, approximate=False,
+                 unique_field='pk'):
+        """
+        :param approximate: use approximate_count instead of exact count
+        :param unique_field: field that makes ordering unique
+        """
+        # orphans are not supported, page size must be constant for seeking
+        super(KeysetPaginator, self).__init__(
+            object_list, per_page, orphans=0,
+            allow_empty_first_page=allow_empty_first_page
+        )
+        self.approximate = approximate
+        self.ordering = self._stable_ordering(unique_field)
+        self.seekable = False
+        if self.ordering is not None:
+            self.object_list = self.object_list.order_by(*(
+                '-%s' % name if desc else name for name, desc in self.ordering
+            ))
+            self.seekable = not any(self._is_nullable(name) for name, desc in self.ordering)
+
+    def _stable_ordering(self, unique_field: str) -> Optional[List[OrderField]]:
+        query = self.object_list.query
+        if query.order_by:
+            ordering = query.order_by
+        elif query.default_ordering:
+            ordering = query.get_meta().ordering
+        else:
+            ordering = ()
+        pk_name = self.object_list.model._meta.pk.name
+        if unique_field == pk_name:
+            unique_field = 'pk'
+        res = []
+        for field in ordering:
+            if not isinstance(field, str) or field == '?' or '.' in field:
+                # expressions and extra ordering can not be a key
+                return
+            name = field.lstrip('-')
+            if name == pk_name:
+                name = 'pk'
+            res.append((name, field.startswith('-')))
+            if name == unique_field:
+                return res
+        res.append((unique_field, False))
+        return res
+
+    def _is_nullable(self, name: str) -> bool:
+        """
+        Whether field, or relation on the way to it, may give NULL.
+        Annotations and unknown fields are considered nullable.
+        """
+        if name == 'pk':
+            return False
+        opts = self.object_list.model._meta
+        for attr in name.split('__'):
+            try:
+                field = opts.get_field(attr)
+            except FieldDoesNotExist:
+                return True
+            if field.null or field.one_to_many or field.many_to_many:
+                return True
+            if field.is_relation:
+                opts = field.related_model._meta
+        return False
+
+    @cached_property
+    def count(self):
+        if self.approximate:
+            return approximate_count(self.object_list)
+        return super(KeysetPaginator, self).count
+
+    @cached_property
+    def num_pages(self):
+        if self.count == 0 and not self.allow_empty_first_page:
+            return 0
+        return max(1, int(ceil(self.count / self.per_page)))
+
+    @cached_property
+    def signature(self) -> str:
+        # cursor is valid only for the same filter and ordering
+        try:
+            sql = str(self.object_list.query)
+        except EmptyResultSet:
+            sql = ''
+        return '%08x' % crc32(sql.encode())
+
+    def validate_number(self, number):
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger(_('That page number is not an integer'))
+        if number < 1:
+            raise EmptyPage(_('That page number is less than 1'))
+        # with approximate count pages after num_pages may exist
+        if number > self.num_pages and not self.approximate:
+            if number == 1 and self.allow_empty_first_page:
+                pass
+            else:
+                raise EmptyPage(_('That page contains no results'))
+        return number
+
+    def _row_key(self, obj) -> Optional[list]:
+        key = []
+        for name, desc in self.ordering:
+            val = obj
+            for attr in name.split('__'):
+                val = getattr(val, attr, None)
+                if val is None:
+                    # NULLs are sorted differently by databases, do not seek
+                    return
+            if isinstance(val, models.Model):
+                # ordering by relation is expanded by ordering of related model
+                return
+            key.append(val)
+        return key
+
+    def make_cursor(self, number: int, forward: bool, obj) -> Optional[str]:
+        """
+        :param number: number of page that cursor leads to
+        :param forward: cursor is after obj, else before it
+        :param obj: boundary row of current page
+        """
+        if not self.seekable:
+            return
+        key = self._row_key(obj)
+        if key is None:
+            return
+        data = json.dumps((number, forward, self.signature, key), default=str)
+        return urlsafe_b64encode(data.encode()).decode()
+
+    def _parse_cursor(self, number: int, cursor: str):
+        try:
+            cnumber, forward, signature, key = json.loads(urlsafe_b64decode(cursor.encode()).decode())
+        except (ValueError, TypeError, Base64Error, UnicodeError):
+            return
+        # cursor from other page or other ordering is ignored
+        if cnumber == number and signature == self.signature and len(key) == len(self.ordering):
+            return bool(forward), key
+
+    def _seek_q(self, key: list, forward: bool) -> Q:
+        q = None
+        eq = {}
+        for (name, desc), val in zip(self.ordering, key):
+            lookup = '%s__%s' % (name, 'lt' if desc == forward else 'gt')
+            cond = Q(**eq) & Q(**{lookup: val})
+            q = cond if q is None else q | cond
+            eq[name] = val
+        # redundant condition on first field lets database use range scan
+        name, desc = self.ordering[0]
+        return Q(**{'%s__%s' % (name, 'lte' if desc == forward else 'gte'): key[0]}) & q
+
+    def _reversed(self):
+        return self.object_list.order_by(*(
+            name if desc else '-%s' % name for name, desc in self.ordering
+        ))
+
+    def _fetch(self, number: int, cursor: Optional[str]):
+        """
+        :return: rows of page, page number and whether next page exists
+        """
+        per_page = self.per_page
+        seek = self._parse_cursor(number, cursor) if cursor and self.seekable else None
+        if seek is not None:
+            forward, key = seek
+            try:
+                q = self._seek_q(key, forward)
+                if forward:
+                    rows = list(self.object_list.filter(q)[:per_page + 1])
+                    return rows[:per_page], number, len(rows) > per_page
+                rows = list(self._reversed().filter(q)[:per_page])
+            except (ValueError, TypeError, ValidationError, FieldError):
+                # broken cursor, fetch by offset
+                pass
+            else:
+                rows.reverse()
+                return rows, number, True
+
+        if number > 1 and number == self.num_pages and self.ordering is not None:
+            # last page, rows are taken from the end
+            tail = per_page if self.approximate else self.count - (number - 1) * per_page
+            rows = list(self._reversed()[:tail + 1])
+            if len(rows) <= tail:
+                # all rows fit into first page
+                number = 1
+            rows = rows[:tail]
+            rows.reverse()
+            return rows, number, False
+
+        bottom = (number - 1) * per_page
+        rows = list(self.object_list[bottom:bottom + per_page + 1])
+        return rows[:per_page], number, len(rows) > per_page
+
+    def page(self, number, cursor: Optional[str] = None):
+        """
+        :param number: number of page
+        :param cursor: cursor from url of neighbour page
+        """
+        number = self.validate_number(number)
+        rows, number, has_next = self._fetch(number, cursor)
+        if not rows and (number > 1 or not self.allow_empty_first_page):
+            raise EmptyPage(_('That page contains no results'))
+
+        # count may be stale or approximate, real rows are more important
+        if has_next and self.num_pages <= number:
+            self.num_pages = number + 1
+        elif not has_next:
+            self.num_pages = number
+
+        next_cursor = previous_cursor = None
+        if rows:
+            if has_next:
+                next_cursor = self.make_cursor(number + 1, True, rows[-1])
+            if number > 1:
+                previous_cursor = self.make_cursor(number - 1, False, rows[0])
+        return KeysetPage(rows, number, self, has_next, next_cursor, previous_cursor)
@@ -3,5 +3,6 @@
 from djing.lib.messaging.sms.deliver import SmsDeliver
 from djing.lib.messaging.sms.submit import SmsSubmit
 from djing.lib.messaging.sms.gsm0338 import is_gsm_text
+from djing.lib.messaging.sms.bulk import BulkSmsEncoder
 
-__all__ = ("SmsSubmit", "SmsDeliver", "is_gsm_text")
+__all__ = ("SmsSubmit", "SmsDeliver", "is_gsm_text", "BulkSmsEncoder")
@@ -0,0 +1,49 @@
+# See LICENSE
+"""
+Compare speed of SmsSubmit.to_pdu and BulkSmsEncoder.
+Run: python3 -m djing.lib.messaging.sms.benchmark [count]
+"""
+import sys
+from time import perf_counter
+
+from djing.lib.messaging.sms.bulk import BulkSmsEncoder
+from djing.lib.messaging.sms.submit import SmsSubmit
+
+TEXTS = (
+    'Уважаемый абонент, на вашем счету недостаточно средств. Пополните счёт.',
+    'Dear subscriber, your balance is -150 rub. Please pay until 10th of month.',
+    'Уважаемый абонент! Ваш долг составляет 350 руб. Услуги будут '
+    'приостановлены 10 числа, если счёт не будет пополнен. Спасибо.',
+    'Dear subscriber, your internet access will be suspended at 10th day of month '
+    'because of debt. Please pay for the services in any of our offices or by terminal.',
+)
+
+
+def messages(cnt: int):
+    return (('+7978%07d' % i, TEXTS[i % len(TEXTS)]) for i in range(cnt))
+
+
+def bench_submit(cnt: int) -> float:
+    t = perf_counter()
+    for number, text in messages(cnt):
+        SmsSubmit(number, text).to_pdu()
+    return perf_counter() - t
+
+
+def bench_bulk(cnt: int) -> float:
+    t = perf_counter()
+    for _number, _pdus in BulkSmsEncoder().encode_many(messages(cnt)):
+        pass
+    return perf_counter() - t
+
+
+def main(cnt: int):
+    submit_time = bench_submit(cnt)
+    bulk_time = bench_bulk(cnt)
+    print('SmsSubmit.to_pdu: %d messages in %.3f sec' % (cnt, submit_time))
+    print('BulkSmsEncoder:   %d messages in %.3f sec' % (cnt, bulk_time))
+    print('Speedup: %.1fx' % (submit_time / bulk_time))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
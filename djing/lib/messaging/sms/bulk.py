@@ -0,0 +1,198 @@
+# See LICENSE
+"""Fast encoder of many SMS-SUBMIT pdu at once"""
+
+from functools import lru_cache
+from itertools import count
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from djing.lib.messaging.sms import consts
+from djing.lib.messaging.sms.gsm0338 import (
+    def_regular_encode_dict, def_escape_encode_dict
+)
+from djing.lib.messaging.sms.pdu import Pdu
+from djing.lib.messaging.utils import clean_number
+
+# unicode -> GSM 03.38 for str.translate, escaped chars take 2 septets
+GSM_ENCODE_TABLE = dict(
+    (ord(u), g) for u, g in def_regular_encode_dict.items() if g != '\x1b'
+)
+GSM_ENCODE_TABLE.update(
+    (ord(u), '\x1b' + g) for u, g in def_escape_encode_dict.items()
+)
+
+# deletes all GSM chars, so something remains only in not GSM text
+_GSM_DELETE_TABLE = dict.fromkeys(GSM_ENCODE_TABLE)
+
+ESC = 0x1b
+
+
+def is_gsm_text(text: str) -> bool:
+    return not text.translate(_GSM_DELETE_TABLE)
+
+
+def gsm_encode(text: str) -> Optional[bytes]:
+    """
+    Encode text to GSM 03.38 septets, one septet in byte.
+    :return: None if text can not be encoded to GSM
+    """
+    if text.translate(_GSM_DELETE_TABLE):
+        return
+    return text.translate(GSM_ENCODE_TABLE).encode('latin1')
+
+
+def _repeat_mask(value: int, width: int, blocks: int) -> int:
+    return int.from_bytes(value.to_bytes(width // 8, 'little') * (blocks * 64 // width), 'little')
+
+
+@lru_cache(maxsize=64)
+def _pack_masks(blocks: int) -> Tuple[int, ...]:
+    return (
+        _repeat_mask(0x007f, 16, blocks), _repeat_mask(0x3f80, 16, blocks),
+        _repeat_mask(0x00003fff, 32, blocks), _repeat_mask(0x0fffc000, 32, blocks),
+        _repeat_mask(0x000000000fffffff, 64, blocks), _repeat_mask(0x00fffffff0000000, 64, blocks),
+    )
+
+
+def pack_septets(septets: bytes) -> bytes:
+    """
+    Pack 7-bit values into octets as GSM 03.38 requires.
+    All message is processed as one big integer: pairs of septets are
+    joined into 14 bits, then into 28 and 56 bits, so each 8 septets
+    become 7 bytes without loop over chars.
+    """
+    n = len(septets)
+    blocks = (n + 7) // 8
+    m = _pack_masks(blocks)
+    x = int.from_bytes(septets, 'little')
+    x = (x & m[0]) | ((x >> 1) & m[1])
+    x = (x & m[2]) | ((x >> 2) & m[3])
+    x = (x & m[4]) | ((x >> 4) & m[5])
+    packed = bytearray(x.to_bytes(blocks * 8, 'little'))
+    # each 8th byte is empty now
+    del packed[7::8]
+    return bytes(packed[:(n * 7 + 7) // 8])
+
+
+def _split(data: bytes, part_len: int, step: int = 1, is_last_bad=None) -> List[bytes]:
+    parts = []
+    pi = 0
+    total_len = len(data)
+    while pi < total_len:
+        pe = min(pi + part_len, total_len)
+        if pe < total_len and is_last_bad is not None and is_last_bad(data[pe - step:pe]):
+            pe -= step
+        parts.append(data[pi:pe])
+        pi = pe
+    return parts
+
+
+def _gsm_escape_at_end(last: bytes) -> bool:
+    # do not split escaped char between messages
+    return last[0] == ESC
+
+
+def _high_surrogate_at_end(last: bytes) -> bool:
+    # do not split surrogate pair between messages
+    return 0xd8 <= last[0] <= 0xdb
+
+
+class BulkSmsEncoder(object):
+    """
+    Encoder of SMS-SUBMIT pdu for many messages.
+    Results are the same as SmsSubmit.to_pdu() gives, but tables
+    and headers are precomputed, and text is encoded by
+    str.translate and packed without loops over chars.
+    Each long message gets own concatenation reference number.
+    """
+
+    def __init__(self, csca: Optional[str] = None, request_status=False, ref_start=0):
+        self.smsc = self._encode_smsc(csca)
+        first_octet = 0x01
+        if request_status:
+            first_octet |= 0x20
+        self._first_octet = first_octet
+        self._refs = count(ref_start)
+        self._number_cache = {}
+
+    @staticmethod
+    def _encode_smsc(csca: Optional[str]) -> bytes:
+        if not csca or not csca.strip():
+            return b'\x00'
+        number = clean_number(csca)
+        ptype = 0x81
+        if number[0] == '+':
+            number = number[1:]
+            ptype = 0x91
+        bcd = BulkSmsEncoder._bcd(number)
+        return bytes((len(bcd) + 1, ptype)) + bcd
+
+    @staticmethod
+    def _bcd(number: str) -> bytes:
+        if len(number) % 2:
+            number += 'F'
+        return bytes.fromhex(''.join(number[n + 1] + number[n] for n in range(0, len(number), 2)))
+
+    def _encode_number(self, number: str) -> bytes:
+        enc = self._number_cache.get(number)
+        if enc is None:
+            num = clean_number(number)
+            ptype = 0x81
+            if num[0] == '+':
+                num = num[1:]
+                ptype = 0x91
+            enc = bytes((len(num), ptype)) + self._bcd(num)
+            self._number_cache[number] = enc
+        return enc
+
+    def _pdu(self, first_octet: int, ref: int, number: bytes, dcs: int, ud: bytes, cnt=1, seq=1) -> Pdu:
+        data = b''.join((
+            self.smsc, bytes((first_octet, ref)), number, bytes((0x00, dcs)), ud
+        ))
+        return Pdu(data.hex(), len(self.smsc), cnt=cnt, seq=seq)
+
+    def encode(self, number: str, text: str) -> List[Pdu]:
+        """
+        :param number: recipient phone number
+        :param text: text of message
+        :return: list of Pdu, more than one for long text
+        """
+        ref = next(self._refs) & 0xff
+        number_pdu = self._encode_number(number)
+        septets = gsm_encode(text)
+        if septets is not None:
+            if len(septets) <= consts.SEVENBIT_SIZE:
+                ud = bytes((len(septets),)) + pack_septets(septets)
+                return [self._pdu(self._first_octet, ref, number_pdu, 0x00, ud)]
+            parts = _split(septets, consts.SEVENBIT_MP_SIZE, 1, _gsm_escape_at_end)
+            dcs = 0x00
+        else:
+            ucs2 = text.encode('utf-16-be')
+            if len(ucs2) <= consts.UCS2_SIZE * 2:
+                ud = bytes((len(ucs2),)) + ucs2
+                return [self._pdu(self._first_octet, ref, number_pdu, 0x08, ud)]
+            parts = _split(ucs2, consts.UCS2_MP_SIZE * 2, 2, _high_surrogate_at_end)
+            dcs = 0x08
+
+        first_octet = self._first_octet | 0x40
+        cnt = len(parts)
+        res = []
+        for seq, part in enumerate(parts, 1):
+            udh = bytes((0x05, 0x00, 0x03, ref, cnt, seq))
+            if dcs == 0x00:
+                # header with fill bit takes 7 septets
+                packed = bytearray(pack_septets(b'\x00' * 7 + part))
+                packed[:6] = udh
+                ud = bytes((len(part) + 7,)) + packed
+            else:
+                ud = bytes((len(part) + 6,)) + udh + part
+            res.append(self._pdu(first_octet, ref, number_pdu, dcs, ud, cnt=cnt, seq=seq))
+        return res
+
+    def encode_many(self, messages: Iterable[Tuple[str, str]]) -> Iterator[Tuple[str, List[Pdu]]]:
+        """
+        :param messages: iterable of (number, text)
+        :return: iterator of (number, list of Pdu)
+        """
+        encode = self.encode
+        for number, text in messages:
+            yield number, encode(number, text)
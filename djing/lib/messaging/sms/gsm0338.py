@@ -228,7 +228,7 @@ def encode(input_, errors='strict'):
                 else:
                     raise UnicodeError("Unknown error handling")
 
-    ret = ''.join(result)
+    ret = ''.join(result).encode('latin1')
     return ret, len(ret)
 
 
@@ -283,8 +283,7 @@ codecs.register(getregentry)
 def is_gsm_text(text):
     """Returns True if ``text`` can be encoded as gsm text"""
     try:
-        tx = text.encode("gsm0338")
-        print(tx, type(tx), len(tx))
+        text.encode("gsm0338")
     except UnicodeError:
         return False
     except:
@@ -290,7 +290,7 @@ class SmsSubmit(SmsBase):
         pi, pe = 0, len_without_udh
 
         while pi < total_len:
-            if text[pi:pe][-1] == '\x1b':
+            if text[pi:pe][-1:] in ('\x1b', b'\x1b'):
                 pe -= 1
 
             msgs.append(text[pi:pe])
@@ -312,11 +312,11 @@ class SmsSubmit(SmsBase):
             if limit == consts.SEVENBIT_SIZE:
                 udh = (chr(udh_len) + chr(mid) + chr(data_len) +
                        chr(sms_ref) + chr(total_parts) + chr(i))
-                padding = " "
+                padding = b" "
             else:
-                udh = (unichr(int("%04x" % ((udh_len << 8) | mid), 16)) +
-                       unichr(int("%04x" % ((data_len << 8) | sms_ref), 16)) +
-                       unichr(int("%04x" % ((total_parts << 8) | i), 16)))
+                udh = (chr((udh_len << 8) | mid) +
+                       chr((data_len << 8) | sms_ref) +
+                       chr((total_parts << 8) | i))
                 padding = ""
 
             pdu_msgs.append(packing_func(padding + msg, udh))
@@ -0,0 +1,40 @@
+import logging
+from time import perf_counter
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+logger = logging.getLogger('djing.queries')
+
+
+class QueryCountMiddleware(object):
+    """
+    Counts sql queries of each request and puts count and time of them
+    to headers X-Query-Count and X-Query-Time (ms), and to log 'djing.queries'.
+    Queries of streaming response, made after view returned, are not counted.
+    Works when DEBUG or QUERY_COUNT_HEADERS is True, otherwise it is disabled.
+    """
+
+    def __init__(self, get_response):
+        if not (settings.DEBUG or getattr(settings, 'QUERY_COUNT_HEADERS', False)):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        stat = [0, 0.0]
+
+        def count_query(execute, sql, params, many, context):
+            t = perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                stat[0] += 1
+                stat[1] += perf_counter() - t
+
+        with connection.execute_wrapper(count_query):
+            response = self.get_response(request)
+        response['X-Query-Count'] = str(stat[0])
+        response['X-Query-Time'] = '%.1f' % (stat[1] * 1000)
+        logger.debug('%s %s: %d queries, %.1f ms', request.method, request.path, stat[0], stat[1] * 1000)
+        return response
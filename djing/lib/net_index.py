@@ -0,0 +1,94 @@
+from bisect import bisect_right
+from ipaddress import ip_network, ip_address
+from typing import Iterable, Tuple, Optional, Any, List, Union
+
+NetType = Union[str, Any]
+
+
+def net2range(net: NetType) -> Tuple[int, int, int]:
+    """
+    :param net: network as str or ip_network
+    :return: ip version, first and last address as integers
+    """
+    if isinstance(net, str):
+        net = ip_network(net, strict=False)
+    return net.version, int(net.network_address), int(net.broadcast_address)
+
+
+class _Intervals(object):
+    # Sorted intervals of one ip version. _max_ends[i] is max end of
+    # intervals 0..i, so nested intervals are found correctly too.
+    __slots__ = ('starts', 'ends', 'keys', 'max_ends')
+
+    def __init__(self, items: List[Tuple[int, int, Any]]):
+        items.sort(key=lambda it: (it[0], -it[1]))
+        self.starts = [it[0] for it in items]
+        self.ends = [it[1] for it in items]
+        self.keys = [it[2] for it in items]
+        self.max_ends = []
+        max_end = -1
+        for end in self.ends:
+            max_end = max(max_end, end)
+            self.max_ends.append(max_end)
+
+    def find(self, ip: int):
+        i = bisect_right(self.starts, ip) - 1
+        while i >= 0 and self.max_ends[i] >= ip:
+            # nearest start is the most specific network
+            if self.ends[i] >= ip:
+                return self.keys[i]
+            i -= 1
+
+    def overlaps(self, start: int, end: int, exclude=None):
+        i = bisect_right(self.starts, end) - 1
+        while i >= 0 and self.max_ends[i] >= start:
+            if self.ends[i] >= start and self.keys[i] != exclude:
+                return self.keys[i]
+            i -= 1
+
+
+class NetworkIndex(object):
+    """
+    Index of networks as sorted integer intervals for ipv4 and ipv6.
+    Network that contains address, and networks that overlap
+    with given network, are found by bisect in O(log n).
+    """
+
+    def __init__(self, networks: Iterable[Tuple[Any, NetType]] = ()):
+        """
+        :param networks: iterable of (key, network) pairs,
+                         network is str or ip_network
+        """
+        by_version = {4: [], 6: []}
+        for key, net in networks:
+            try:
+                version, start, end = net2range(net)
+            except ValueError:
+                continue
+            by_version[version].append((start, end, key))
+        self._intervals = {v: _Intervals(items) for v, items in by_version.items()}
+
+    def find(self, ip) -> Optional[Any]:
+        """
+        :param ip: str or ip_address
+        :return: key of the most specific network that contains ip
+        """
+        if isinstance(ip, str):
+            try:
+                ip = ip_address(ip)
+            except ValueError:
+                return
+        return self._intervals[ip.version].find(int(ip))
+
+    def overlaps(self, net: NetType, exclude=None) -> Optional[Any]:
+        """
+        :param net: str or ip_network
+        :param exclude: key of network that is not checked,
+                        for example network that is edited
+        :return: key of some network that overlaps with net
+        """
+        version, start, end = net2range(net)
+        return self._intervals[version].overlaps(start, end, exclude)
+
+    def __len__(self):
+        return sum(len(iv.keys) for iv in self._intervals.values())
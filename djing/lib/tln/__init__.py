@@ -1,4 +1,5 @@
 from .tln import *
 
 __all__ = ('TelnetApi', 'ValidationError', 'ZTEFiberIsFull', 'ZteOltLoginFailed',
-           'OnuZteRegisterError', 'ZteOltConsoleError', 'register_onu_ZTE_F660')
+           'OnuZteRegisterError', 'ZteOltConsoleError', 'register_onu_ZTE_F660',
+           'register_onus_ZTE_F660', 'close_olt_sessions')
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+import asyncio
+import re
+from typing import Iterable, List, Optional, Tuple, Dict, Union, Pattern
+
+from .tln import ZteOltLoginFailed, PAGER_MARKER, parse_uncfg_lines
+
+IAC = 255
+DONT = 254
+DO = 253
+WONT = 252
+WILL = 251
+SB = 250
+SE = 240
+
+
+class ConsoleStreamParser(object):
+    """
+    Incremental parser of telnet console stream.
+    Telnet commands are cut from stream and negotiation is refused,
+    pager markers are answered by space, and prompt is searched
+    only in last line of output, so each chunk is processed once.
+    """
+
+    def __init__(self, pager_marker: bytes = PAGER_MARKER):
+        self._pager_marker = pager_marker
+        self._out = bytearray()
+        self._reply = bytearray()
+        self._iac_tail = b''
+        self._in_sb = False
+
+    def _strip_telnet(self, data: bytes) -> bytes:
+        data = self._iac_tail + data
+        self._iac_tail = b''
+        clean = bytearray()
+        i, n = 0, len(data)
+        while i < n:
+            c = data[i]
+            if self._in_sb:
+                # skip subnegotiation until IAC SE
+                if c == IAC:
+                    if i + 1 >= n:
+                        self._iac_tail = data[i:]
+                        break
+                    if data[i + 1] == SE:
+                        self._in_sb = False
+                    i += 2
+                    continue
+                i += 1
+                continue
+            if c != IAC:
+                clean.append(c)
+                i += 1
+                continue
+            if i + 1 >= n:
+                self._iac_tail = data[i:]
+                break
+            cmd = data[i + 1]
+            if cmd == IAC:
+                clean.append(IAC)
+                i += 2
+            elif cmd in (DO, DONT, WILL, WONT):
+                if i + 2 >= n:
+                    self._iac_tail = data[i:]
+                    break
+                opt = data[i + 2]
+                if cmd == DO:
+                    self._reply += bytes((IAC, WONT, opt))
+                elif cmd == WILL:
+                    self._reply += bytes((IAC, DONT, opt))
+                i += 3
+            elif cmd == SB:
+                self._in_sb = True
+                i += 2
+            else:
+                i += 2
+        return bytes(clean)
+
+    def feed(self, data: bytes) -> None:
+        clean = self._strip_telnet(data).replace(b'\x08', b'')
+        if not clean:
+            return
+        self._out += clean
+        tail = self._out[-len(self._pager_marker) - 8:]
+        if self._pager_marker in tail:
+            pos = self._out.rfind(self._pager_marker)
+            del self._out[pos:]
+            while self._out[-1:] == b' ':
+                del self._out[-1]
+            self._reply += b' '
+
+    def take_reply(self) -> bytes:
+        reply = bytes(self._reply)
+        self._reply.clear()
+        return reply
+
+    def last_line(self) -> bytes:
+        pos = self._out.rfind(b'\n')
+        return bytes(self._out[pos + 1:]).strip()
+
+    def match_prompt(self, prompts: Iterable[Pattern]) -> Optional[int]:
+        """
+        :return: index of prompt that last line of output matches, or None
+        """
+        line = self.last_line()
+        if not line:
+            return
+        for i, prompt in enumerate(prompts):
+            if prompt.fullmatch(line):
+                return i
+
+    def pop_lines(self) -> List[bytes]:
+        """
+        Take lines of output without last line, that is prompt
+        """
+        pos = self._out.rfind(b'\n')
+        lines = bytes(self._out[:pos + 1 if pos >= 0 else 0])
+        del self._out[:]
+        return [ln.rstrip(b'\r') for ln in lines.split(b'\n') if ln.strip()]
+
+
+class AsyncOltConsole(object):
+    """
+    Console of OLT via telnet for asyncio. Each method waits only
+    for console prompt, there is no fixed sleeps.
+    """
+
+    def __init__(self, host: str, prompt_title: bytes, port=23, timeout=10):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.prompt_title = prompt_title
+        # any prompt of console, like ZTE#, ZTE(config)#, ZTE(config-if)#
+        self.prompt_regexp = re.compile(re.escape(prompt_title) + b'(\\([-\\w]+\\))?#')
+        self._parser = ConsoleStreamParser()
+        self._reader = None
+        self._writer = None
+
+    async def connect(self) -> None:
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.timeout
+        )
+
+    async def read_until_prompt(self, prompts: Iterable[Pattern]) -> Tuple[int, List[bytes]]:
+        prompts = tuple(prompts)
+        parser = self._parser
+        while True:
+            data = await asyncio.wait_for(self._reader.read(4096), self.timeout)
+            if not data:
+                raise EOFError('Connection closed by %s' % self.host)
+            parser.feed(data)
+            reply = parser.take_reply()
+            if reply:
+                self._writer.write(reply)
+            idx = parser.match_prompt(prompts)
+            if idx is not None:
+                return idx, parser.pop_lines()
+
+    async def write(self, line: bytes) -> None:
+        self._writer.write(line + b'\n')
+        await self._writer.drain()
+
+    async def login(self, username: bytes, passw: bytes) -> None:
+        username_re = re.compile(b'Username:')
+        await self.read_until_prompt((username_re,))
+        await self.write(username)
+        await self.read_until_prompt((re.compile(b'Password:'),))
+        await self.write(passw)
+        idx, lines = await self.read_until_prompt((self.prompt_regexp, username_re))
+        if idx != 0 or any(b'bad password' in ln for ln in lines):
+            raise ZteOltLoginFailed
+        # disable paging of long output
+        await self.command(b'terminal length 0')
+
+    async def command(self, cmd: bytes) -> List[bytes]:
+        """
+        Run command and return lines of its output
+        """
+        await self.write(cmd)
+        _idx, lines = await self.read_until_prompt((self.prompt_regexp,))
+        # first line is echo of command
+        if lines and lines[0].strip().endswith(cmd):
+            lines = lines[1:]
+        return lines
+
+    async def close(self) -> None:
+        if self._writer is None:
+            return
+        try:
+            await self.write(b'exit')
+        except OSError:
+            pass
+        self._writer.close()
+        self._writer = None
+
+
+async def olt_run_commands(host: str, login_passwd: Tuple[bytes, bytes], prompt_title: bytes,
+                           commands: Iterable[bytes], timeout=10) -> List[List[bytes]]:
+    """
+    Login to OLT and run commands one by one.
+    :return: list of output lines for each command
+    """
+    console = AsyncOltConsole(host, prompt_title, timeout=timeout)
+    await console.connect()
+    try:
+        await console.login(*login_passwd)
+        return [await console.command(cmd) for cmd in commands]
+    finally:
+        await console.close()
+
+
+def run_on_olts(jobs: Iterable[Tuple[str, Tuple[bytes, bytes], bytes, Iterable[bytes]]],
+                timeout=10) -> Dict[str, Union[List[List[bytes]], Exception]]:
+    """
+    Run commands on different OLTs concurrently.
+    :param jobs: iterable of (host, (login, password), prompt_title, commands)
+    :param timeout: timeout for each read from OLT
+    :return: dict of host -> list of outputs of commands, or host -> exception
+    """
+    jobs = tuple(jobs)
+
+    async def run_all():
+        return await asyncio.gather(*(
+            olt_run_commands(host, login_passwd, prompt_title, commands, timeout)
+            for host, login_passwd, prompt_title, commands in jobs
+        ), return_exceptions=True)
+
+    loop = asyncio.new_event_loop()
+    try:
+        results = loop.run_until_complete(run_all())
+    finally:
+        loop.close()
+    return {job[0]: res for job, res in zip(jobs, results)}
+
+
+def olts_unregistered_onus(olts: Iterable[Tuple[str, Tuple[bytes, bytes], bytes]],
+                           timeout=10) -> Dict[str, Union[List[Dict], Exception]]:
+    """
+    Read unregistered onu from different OLTs concurrently.
+    :param olts: iterable of (host, (login, password), prompt_title)
+    :param timeout: timeout for each read from OLT
+    :return: dict of host -> list of onu like parse_uncfg_lines returns, or host -> exception
+    """
+    results = run_on_olts((
+        (host, login_passwd, prompt_title, (b'show gpon onu uncfg',))
+        for host, login_passwd, prompt_title in olts
+    ), timeout)
+    return {
+        host: res if isinstance(res, Exception) else parse_uncfg_lines(res[0])
+        for host, res in results.items()
+    }
+
+
+__all__ = ('ConsoleStreamParser', 'AsyncOltConsole', 'olt_run_commands', 'run_on_olts',
+           'olts_unregistered_onus')
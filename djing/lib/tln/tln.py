@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
+import atexit
 import re
 import struct
 from telnetlib import Telnet
-from time import sleep
-from typing import Generator, Dict, Optional, Tuple
+from threading import Lock, Timer
+from time import monotonic
+from typing import Generator, Dict, Optional, Tuple, Iterable, List
 
 from djing.lib import process_lock
 
@@ -13,7 +15,11 @@ class ZteOltConsoleError(Exception):
 
 
 class OnuZteRegisterError(ZteOltConsoleError):
-    pass
+    def __init__(self, *args, onu_position: Optional[Tuple] = None):
+        super().__init__(*args)
+        # (stack_num, rack_num, fiber_num, onu_port_num) when onu was
+        # registered on OLT, but its configuration failed
+        self.onu_position = onu_position
 
 
 class ZTEFiberIsFull(ZteOltConsoleError):
@@ -36,6 +42,7 @@ IP_ADDR_REGEX = (
     '(25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)$'
 )
 ONU_SN_REGEX = b'^ZTEG[A-F\d]{8}$'
+PAGER_MARKER = b'--More--'
 
 
 class TelnetApi(Telnet):
@@ -63,12 +70,26 @@ class TelnetApi(Telnet):
         sock.send(naws_cmd)
 
     def read_lines(self) -> Generator:
+        """
+        Read command output until console prompt. Reading is driven
+        by prompt and pager marker, so it does not wait for timeout
+        """
+        # buffer is read up to line end, so prompt is searched only
+        # at start of line, not in partially read line
+        patterns = [re.compile(p) for p in (
+            b'\r\n', b'^[\x08 ]*' + re.escape(self._prompt_string), PAGER_MARKER
+        )]
         while True:
-            line = self.read_until(b'\r\n', timeout=self._timeout)
-            line = line.replace(b'\r\n', b'')
-            if self._prompt_string == line:
+            idx, _match, line = self.expect(patterns, timeout=self._timeout)
+            if idx == 2:
+                # pager, ask next page
+                line = line[:-len(PAGER_MARKER)].rstrip()
+                super().write(b' ')
+            elif idx != 0:
+                # prompt or timeout
                 break
-            if line == b'':
+            line = line.replace(b'\r\n', b'').replace(b'\x08', b'').strip(b'\r')
+            if line == b'' or line.strip() == b'':
                 continue
             yield line
 
@@ -104,6 +125,41 @@ def parse_onu_name(onu_name: bytes, name_regexp=re.compile(b'[/:_]')) -> Dict[st
     }
 
 
+def parse_uncfg_lines(lines: Iterable[bytes]) -> List[Dict]:
+    """
+    Parse output of 'show gpon onu uncfg'
+    :return: list of dicts with numbers, name, sn and state of onu
+    """
+    onus = []
+    for line in lines:
+        chunks = line.split()
+        if len(chunks) != 3 or not chunks[0].startswith(b'gpon-onu_'):
+            continue
+        onu_name, onu_sn, onu_state = chunks
+        onu_numbers = parse_onu_name(onu_name)
+        onu_numbers.update({
+            'onu_name': onu_name,
+            'onu_sn': onu_sn,
+            'onu_state': onu_state
+        })
+        onus.append(onu_numbers)
+    return onus
+
+
+def parse_registered_onu_numbers(lines: Iterable[bytes],
+                                 onu_type_regexp=re.compile(b'^\\s{2}onu \\d{1,3} type [-\\w\\d]{4,64} sn \\w{4,64}$')
+                                 ) -> List[int]:
+    """
+    Parse onu numbers from output of 'show run int gpon-olt_x/y/z'
+    """
+    numbers = []
+    for line in lines:
+        if onu_type_regexp.match(line):
+            _onu, num, _type, onu_type, _sn, onu_sn = line.split()
+            numbers.append(int(num))
+    return numbers
+
+
 class OltZTERegister(TelnetApi):
 
     def __init__(self, screen_size: Tuple[int, int], prompt_title: bytes, *args, **kwargs):
@@ -120,39 +176,39 @@ class OltZTERegister(TelnetApi):
         for l in self.read_lines():
             if b'bad password' in l:
                 raise ZteOltLoginFailed
+        # disable paging of long output
+        tuple(self.command_to(b'terminal length 0'))
 
     def get_unregistered_onu(self, sn: bytes) -> Optional[Dict]:
-        lines = tuple(self.command_to(b'show gpon onu uncfg'))
-        if len(lines) > 3:
-            # devices available
-            # find onu by sn
-            line = tuple(ln for ln in lines if sn.lower() in ln.lower())
-            if len(line) > 0:
-                line = line[0]
-                onu_name, onu_sn, onu_state = line.split()
-                onu_numbers = parse_onu_name(onu_name)
-                onu_numbers.update({
-                    'onu_name': onu_name,
-                    'onu_sn': onu_sn,
-                    'onu_state': onu_state
-                })
-                return onu_numbers
-
-    def get_last_registered_onu_number(self, stack_num: int, rack_num: int, fiber_num: int) -> int:
-        registered_lines = self.command_to(b'show run int gpon-olt_%d/%d/%d' % (
+        sn = sn.lower()
+        for onu in self.get_unregistered_onus():
+            if sn in onu['onu_sn'].lower():
+                return onu
+
+    def get_unregistered_onus(self) -> List[Dict]:
+        """
+        All unregistered onu from 'show gpon onu uncfg', read once per batch
+        """
+        return parse_uncfg_lines(self.command_to(b'show gpon onu uncfg'))
+
+    def get_registered_onu_numbers(self, stack_num: int, rack_num: int, fiber_num: int) -> List[int]:
+        return parse_registered_onu_numbers(self.command_to(b'show run int gpon-olt_%d/%d/%d' % (
             stack_num,
             rack_num,
             fiber_num
-        ))
-        onu_type_regexp = re.compile(b'^\s{2}onu \d{1,3} type [-\w\d]{4,64} sn \w{4,64}$')
-        last_onu = 0
-        for rl in registered_lines:
-            if rl == b' --More--':
-                self.write(b' ')
-            if onu_type_regexp.match(rl):
-                _onu, num, _type, onu_type, _sn, onu_sn = rl.split()
-                last_onu = int(num)
-        return last_onu
+        )))
+
+    def get_last_registered_onu_number(self, stack_num: int, rack_num: int, fiber_num: int) -> int:
+        return max(self.get_registered_onu_numbers(stack_num, rack_num, fiber_num), default=0)
+
+    def is_alive(self) -> bool:
+        if self.sock is None:
+            return False
+        try:
+            self.read_very_eager()
+        except (EOFError, OSError):
+            return False
+        return True
 
     def enter_to_config_mode(self) -> bool:
         prompt = b'%s(config)#' % self.prompt_title
@@ -191,7 +247,7 @@ class OltZTERegister(TelnetApi):
             b'ip dhcp snooping enable vport 1'
         )
         for conf_line in tmpl:
-            self.write(conf_line)
+            tuple(self.command_to(conf_line))
 
     def register_onu_on_olt_fiber(self, onu_type: bytes, new_onu_num: int, onu_sn: bytes, line_profile: bytes,
                                   remote_profile: bytes) -> Tuple:
@@ -205,60 +261,206 @@ class OltZTERegister(TelnetApi):
         ))) + r
 
 
+# Authenticated telnet sessions to OLTs, kept open for a while
+# so consecutive registrations do not login each time. Idle sessions
+# are closed by timer, so they do not hold vty lines of OLT.
+OLT_SESSION_IDLE_TIMEOUT = 60
+_olt_sessions = {}  # type: Dict[Tuple[str, bytes], Tuple[OltZTERegister, float]]
+_olt_sessions_lock = Lock()
+_expire_timer = None  # type: Optional[Timer]
+
+
+def get_olt_session(olt_ip: str, login_passwd: Tuple[bytes, bytes], prompt_title: bytes) -> OltZTERegister:
+    """
+    Get authenticated telnet session to OLT from pool, or open new one.
+    :param olt_ip: ip address of OLT
+    :param login_passwd: telnet login and password
+    :param prompt_title: title of OLT console prompt
+    """
+    key = (olt_ip, login_passwd[0])
+    with _olt_sessions_lock:
+        tn, last_used = _olt_sessions.pop(key, (None, 0.0))
+    if tn is not None:
+        if monotonic() - last_used < OLT_SESSION_IDLE_TIMEOUT and tn.is_alive():
+            return tn
+        tn.close()
+    tn = OltZTERegister(host=olt_ip, timeout=2, screen_size=(120, 128), prompt_title=prompt_title)
+    tn.enter(*login_passwd)
+    return tn
+
+
+def release_olt_session(olt_ip: str, login_passwd: Tuple[bytes, bytes], tn: OltZTERegister) -> None:
+    """Return session to pool, it must be on root console level"""
+    global _expire_timer
+    if tn.sock is None:
+        return
+    if len(tn.config_level) != 1:
+        tn.close()
+        return
+    with _olt_sessions_lock:
+        _olt_sessions[(olt_ip, login_passwd[0])] = (tn, monotonic())
+        if _expire_timer is None:
+            _expire_timer = Timer(OLT_SESSION_IDLE_TIMEOUT, _expire_olt_sessions)
+            _expire_timer.daemon = True
+            _expire_timer.start()
+
+
+def _expire_olt_sessions() -> None:
+    global _expire_timer
+    now = monotonic()
+    with _olt_sessions_lock:
+        expired = [k for k, (tn, last_used) in _olt_sessions.items()
+                   if now - last_used >= OLT_SESSION_IDLE_TIMEOUT]
+        expired = [_olt_sessions.pop(k)[0] for k in expired]
+        if _olt_sessions:
+            # check again when the oldest of left sessions expires
+            oldest = min(last_used for tn, last_used in _olt_sessions.values())
+            _expire_timer = Timer(oldest + OLT_SESSION_IDLE_TIMEOUT - now, _expire_olt_sessions)
+            _expire_timer.daemon = True
+            _expire_timer.start()
+        else:
+            _expire_timer = None
+    for tn in expired:
+        tn.close()
+
+
+@atexit.register
+def close_olt_sessions() -> None:
+    with _olt_sessions_lock:
+        sessions = [tn for tn, _last_used in _olt_sessions.values()]
+        _olt_sessions.clear()
+    for tn in sessions:
+        tn.close()
+
+
+def _get_free_onu_numbers(used_numbers: Iterable[int], count: int, max_onu_num=128) -> List[int]:
+    used_numbers = set(used_numbers)
+    free = [n for n in range(1, max_onu_num + 1) if n not in used_numbers][:count]
+    if len(free) < count:
+        raise ZTEFiberIsFull('olt fiber is full')
+    return free
+
+
 @process_lock
-def register_onu_ZTE_F660(olt_ip: str, onu_sn: bytes, login_passwd: Tuple[bytes, bytes], onu_mac: bytes, prompt_title: bytes, vlan_id: int) -> Tuple:
+def register_onus_ZTE_F660(olt_ip: str, onus: Iterable[Tuple[bytes, bytes]], login_passwd: Tuple[bytes, bytes],
+                           prompt_title: bytes, vlan_id: int) -> Dict[bytes, Tuple]:
+    """
+    Register many onu on one OLT in one telnet session and one config-mode pass.
+    Unregistered onu list and used onu numbers are read once per fiber.
+    :param olt_ip: ip address of OLT
+    :param onus: iterable of (onu_sn, onu_mac)
+    :param login_passwd: telnet login and password
+    :param prompt_title: title of OLT console prompt
+    :param vlan_id: vlan for onu
+    :return: dict of onu_sn -> (stack_num, rack_num, fiber_num, onu_port_num),
+             or onu_sn -> exception if onu was not registered
+    """
     onu_type = b'ZTE-F660'
     line_profile = b'ZTE-F660-LINE'
     remote_profile = b'ZTE-F660-ROUTER'
-    if not re.match(MAC_ADDR_REGEX, onu_mac):
-        raise ValidationError
     if not re.match(IP_ADDR_REGEX, olt_ip):
         raise ValidationError
-    if not re.match(ONU_SN_REGEX, onu_sn):
-        raise ValidationError
-
-    tn = OltZTERegister(host=olt_ip, timeout=2, screen_size=(120, 128), prompt_title=prompt_title)
-    tn.enter(*login_passwd)
-
-    unregistered_onu = tn.get_unregistered_onu(onu_sn)
-    if unregistered_onu is None:
-        raise OnuZteRegisterError('unregistered onu not found, sn=%s' % onu_sn.decode('utf-8'))
-
-    stack_num = int(unregistered_onu['stack_num'])
-    rack_num = int(unregistered_onu['rack_num'])
-    fiber_num = int(unregistered_onu['fiber_num'])
-
-    last_onu_number = tn.get_last_registered_onu_number(
-        stack_num, rack_num, fiber_num
-    )
-
-    if last_onu_number > 126:
-        raise ZTEFiberIsFull('olt fiber %d is full' % fiber_num)
-
-    # enter to config
-    if not tn.enter_to_config_mode():
-        raise ZteOltConsoleError('Failed to enter to config mode')
-
-    # go to olt interface
-    if not tn.go_to_olt_interface(stack_num, rack_num, fiber_num):
-        raise ZteOltConsoleError('Failed to enter in olt fiber port')
-
-    # new onu port number
-    new_onu_port_num = last_onu_number + 1
-
-    # register onu on olt interface
-    r = tn.register_onu_on_olt_fiber(onu_type, new_onu_port_num, onu_sn, line_profile, remote_profile)
-    print(r)
-
-    # exit from olt interface
-    tn.level_exit()
+    onus = tuple(onus)
+    for onu_sn, onu_mac in onus:
+        if not re.match(MAC_ADDR_REGEX, onu_mac):
+            raise ValidationError
+        if not re.match(ONU_SN_REGEX, onu_sn):
+            raise ValidationError
+
+    results = {}
+    tn = get_olt_session(olt_ip, login_passwd, prompt_title)
+    try:
+        unregistered = {u['onu_sn'].lower(): u for u in tn.get_unregistered_onus()}
+
+        # group onus by fibers
+        fibers = {}
+        for onu_sn, onu_mac in onus:
+            unregistered_onu = unregistered.get(onu_sn.lower())
+            if unregistered_onu is None:
+                results[onu_sn] = OnuZteRegisterError('unregistered onu not found, sn=%s' % onu_sn.decode('utf-8'))
+                continue
+            fiber_addr = (
+                int(unregistered_onu['stack_num']),
+                int(unregistered_onu['rack_num']),
+                int(unregistered_onu['fiber_num'])
+            )
+            fibers.setdefault(fiber_addr, []).append((onu_sn, onu_mac))
+
+        # choose new onu numbers
+        new_onus = []
+        for fiber_addr, fiber_onus in fibers.items():
+            try:
+                free_numbers = _get_free_onu_numbers(
+                    tn.get_registered_onu_numbers(*fiber_addr), len(fiber_onus)
+                )
+            except ZTEFiberIsFull:
+                for onu_sn, onu_mac in fiber_onus:
+                    results[onu_sn] = ZTEFiberIsFull('olt fiber %d is full' % fiber_addr[2])
+                continue
+            new_onus.append((fiber_addr, [
+                (onu_sn, onu_mac, num) for (onu_sn, onu_mac), num in zip(fiber_onus, free_numbers)
+            ]))
+
+        if not new_onus:
+            return results
+
+        # enter to config
+        if not tn.enter_to_config_mode():
+            raise ZteOltConsoleError('Failed to enter to config mode')
+
+        for fiber_idx, (fiber_addr, fiber_onus) in enumerate(new_onus):
+            registered = {}
+            try:
+                # go to olt interface
+                if not tn.go_to_olt_interface(*fiber_addr):
+                    raise ZteOltConsoleError('Failed to enter in olt fiber port')
+
+                # register onus on olt interface
+                for onu_sn, onu_mac, new_onu_port_num in fiber_onus:
+                    tn.register_onu_on_olt_fiber(onu_type, new_onu_port_num, onu_sn, line_profile, remote_profile)
+                    registered[onu_sn] = fiber_addr + (new_onu_port_num,)
+
+                # exit from olt interface
+                tn.level_exit()
+
+                for onu_sn, onu_mac, new_onu_port_num in fiber_onus:
+                    tn.go_to_onu_interface(*fiber_addr, new_onu_port_num)
+                    tn.apply_conf_to_onu(onu_mac, vlan_id)
+                    tn.level_exit()
+                    results[onu_sn] = registered[onu_sn]
+            except (ZteOltConsoleError, EOFError, OSError) as e:
+                # console state is unknown, so session is not reused and
+                # onus of next fibers are not registered. Onus that are
+                # registered already are returned, their position on OLT
+                # must be saved.
+                tn.close()
+                for _fiber_addr, left_onus in new_onus[fiber_idx:]:
+                    for onu_sn, _onu_mac, _num in left_onus:
+                        if onu_sn not in results:
+                            results[onu_sn] = OnuZteRegisterError(
+                                str(e) or e.__class__.__name__,
+                                onu_position=registered.get(onu_sn)
+                            )
+                return results
+
+        # exit from config
+        tn.level_exit()
+    except (EOFError, OSError):
+        tn.close()
+        raise
+    finally:
+        release_olt_session(olt_ip, login_passwd, tn)
+    return results
 
-    r = tn.go_to_onu_interface(stack_num, rack_num, fiber_num, new_onu_port_num)
-    print(r)
 
-    tn.apply_conf_to_onu(onu_mac, vlan_id)
-    sleep(1)
-    return stack_num, rack_num, fiber_num, new_onu_port_num
+def register_onu_ZTE_F660(olt_ip: str, onu_sn: bytes, login_passwd: Tuple[bytes, bytes], onu_mac: bytes, prompt_title: bytes, vlan_id: int) -> Tuple:
+    res = register_onus_ZTE_F660(
+        olt_ip=olt_ip, onus=((onu_sn, onu_mac),), login_passwd=login_passwd,
+        prompt_title=prompt_title, vlan_id=vlan_id
+    )[onu_sn]
+    if isinstance(res, Exception):
+        raise res
+    return res
 
 
 if __name__ == '__main__':
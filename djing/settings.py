@@ -67,6 +67,8 @@ if DEBUG:
 
 
 MIDDLEWARE = [
+    # first, so queries of other middlewares are counted too
+    'djing.lib.middleware.QueryCountMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.locale.LocaleMiddleware',
@@ -228,6 +230,14 @@ EMAIL_USE_TLS = getattr(local_settings, 'EMAIL_USE_TLS', True)
 
 SERVER_EMAIL = getattr(local_settings, 'SERVER_EMAIL', EMAIL_HOST_USER)
 
+# Cache must be shared by all processes of uwsgi and celery,
+# see CACHES in docs/install.md
+CACHES = getattr(local_settings, 'CACHES', {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'
+    }
+})
+
 # REDIS related settings
 REDIS_HOST = 'localhost'
 REDIS_PORT = '6379'
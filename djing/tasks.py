@@ -1,56 +1,86 @@
 import logging
 from _socket import gaierror
+from hashlib import md5
 from smtplib import SMTPException
 from typing import Iterable
 
 from accounts_app.models import UserProfile
 from django.conf import settings
-from django.core.mail import EmailMultiAlternatives
+from django.core.cache import cache
+from django.core.mail import EmailMultiAlternatives, get_connection
 from django.utils.html import strip_tags
 from celery import shared_task
 
 
+# The same notification for the same recipient is
+# sent only once in this period, in seconds
+EMAIL_NOTIFY_DEDUP_WINDOW = getattr(settings, 'EMAIL_NOTIFY_DEDUP_WINDOW', 60)
+
+
+def _dedup_keys(msg_text: str, account_ids: Iterable) -> dict:
+    text_hash = md5(msg_text.encode()).hexdigest()
+    return {acc_id: 'email_notify_%d_%s' % (acc_id, text_hash) for acc_id in set(account_ids)}
+
+
+def _dedup_recipients(msg_text: str, account_ids: Iterable) -> list:
+    res = []
+    for acc_id, key in _dedup_keys(msg_text, account_ids).items():
+        # cache.add does not overwrite existing key
+        if cache.add(key, 1, EMAIL_NOTIFY_DEDUP_WINDOW):
+            res.append(acc_id)
+    return res
+
+
+def _release_recipients(msg_text: str, account_ids: Iterable) -> None:
+    """Notification was not sent, so it may be sent again"""
+    cache.delete_many(list(_dedup_keys(msg_text, account_ids).values()))
+
+
 @shared_task
 def send_email_notify(msg_text: str, account_id: int):
-    try:
-        account = UserProfile.objects.get(pk=account_id)
-        target_email = account.email
-        text_content = strip_tags(msg_text)
+    multicast_email_notify(msg_text, (account_id,))
+
 
+@shared_task
+def multicast_email_notify(msg_text: str, account_ids: Iterable):
+    """
+    Send notification to many accounts. Recipients are loaded by one query,
+    and all letters are sent through one smtp connection.
+    """
+    account_ids = _dedup_recipients(msg_text, account_ids)
+    if not account_ids:
+        return
+    text_content = strip_tags(msg_text)
+    subject = getattr(settings, 'COMPANY_NAME', 'Djing notify')
+    from_email = getattr(settings, 'DEFAULT_FROM_EMAIL')
+    emails = UserProfile.objects.filter(pk__in=account_ids).exclude(
+        email=''
+    ).values_list('email', flat=True)
+    messages = []
+    for target_email in emails.iterator():
         msg = EmailMultiAlternatives(
-            subject=getattr(settings, 'COMPANY_NAME', 'Djing notify'),
+            subject=subject,
             body=text_content,
-            from_email=getattr(settings, 'DEFAULT_FROM_EMAIL'),
+            from_email=from_email,
             to=(target_email,)
         )
         msg.attach_alternative(msg_text, 'text/html')
-        msg.send()
+        messages.append(msg)
+    if len(messages) < len(account_ids):
+        logging.error('Email not found for %d of %d accounts' % (
+            len(account_ids) - len(messages), len(account_ids)
+        ))
+    if not messages:
+        return
+    sent = False
+    try:
+        with get_connection() as connection:
+            connection.send_messages(messages)
+        sent = True
     except SMTPException as e:
         logging.error('SMTPException: %s' % e)
     except gaierror as e:
         logging.error('Socket error: %s' % e)
-    except UserProfile.DoesNotExist:
-        logging.error('UserProfile with pk=%d not found' % account_id)
-
-
-@shared_task
-def multicast_email_notify(msg_text: str, account_ids: Iterable):
-    text_content = strip_tags(msg_text)
-    for acc_id in account_ids:
-        try:
-            account = UserProfile.objects.get(pk=acc_id)
-            target_email = account.email
-            msg = EmailMultiAlternatives(
-                subject=getattr(settings, 'COMPANY_NAME', 'Djing notify'),
-                body=text_content,
-                from_email=getattr(settings, 'DEFAULT_FROM_EMAIL'),
-                to=(target_email,)
-            )
-            msg.attach_alternative(msg_text, 'text/html')
-            msg.send()
-        except SMTPException as e:
-            logging.error('SMTPException: %s' % e)
-        except gaierror as e:
-            logging.error('Socket error: %s' % e)
-        except UserProfile.DoesNotExist:
-            logging.error('UserProfile with pk=%d not found' % acc_id)
+    finally:
+        if not sent:
+            _release_recipients(msg_text, account_ids)
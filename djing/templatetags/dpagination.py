@@ -26,3 +26,18 @@ def url_order_by(request, **kwargs):
         direction = ''
     dict_['dir'] = direction
     return dict_.urlencode()
+
+
+@register.simple_tag
+def url_page_cursor(request, value, cursor=None, field='page', cursor_field='cursor'):
+    """
+    Like url_page_replace, and sets cursor of keyset pagination,
+    or removes it when page has no cursor
+    """
+    dict_ = request.GET.copy()
+    dict_[field] = str(value)
+    if cursor:
+        dict_[cursor_field] = cursor
+    else:
+        dict_.pop(cursor_field, None)
+    return dict_.urlencode()
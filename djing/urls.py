@@ -18,7 +18,8 @@ urlpatterns = [
     path('dialing/', include('dialing_app.urls', namespace='dialapp')),
     path('groups/', include('group_app.urls', namespace='group_app')),
     path('ip_pool/', include('ip_pool.urls', namespace='ip_pool')),
-    path('gw/', include('gw_app.urls', namespace='gw_app'))
+    path('gw/', include('gw_app.urls', namespace='gw_app')),
+    path('chatbot/', include('chatbot.urls', namespace='chatbot'))
 
     # Switch language
     #path(r'i18n/', include('django.conf.urls.i18n')),
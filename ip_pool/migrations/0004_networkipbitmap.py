@@ -0,0 +1,46 @@
+# Generated by Django 2.1 on 2026-10-19 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gw_app', '0003_nasmodel_enabled'),
+        ('ip_pool', '0003_auto_20181019_1230'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NetworkIpBitmap',
+            fields=[
+                ('id', models.AutoField(
+                    auto_created=True,
+                    primary_key=True,
+                    serialize=False,
+                    verbose_name='ID'
+                )),
+                ('work_range', models.CharField(max_length=80)),
+                ('bits', models.BinaryField()),
+                ('date_built', models.DateTimeField()),
+                ('nas', models.ForeignKey(
+                    blank=True,
+                    null=True,
+                    on_delete=django.db.models.deletion.CASCADE,
+                    to='gw_app.NASModel'
+                )),
+                ('network', models.ForeignKey(
+                    on_delete=django.db.models.deletion.CASCADE,
+                    to='ip_pool.NetworkModel'
+                )),
+            ],
+            options={
+                'db_table': 'ip_pool_network_bitmap',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='networkipbitmap',
+            unique_together={('network', 'nas')},
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 2.1 on 2026-10-19 12:00
+
+from ipaddress import ip_network
+
+from django.db import migrations, models
+
+
+def fill_network_bounds(apps, _):
+    NetworkModel = apps.get_model('ip_pool', 'NetworkModel')
+    for netw in NetworkModel.objects.only('pk', 'network').iterator():
+        net = ip_network(netw.network)
+        NetworkModel.objects.filter(pk=netw.pk).update(
+            ip_version=net.version,
+            net_first=int(net.network_address),
+            net_last=int(net.broadcast_address)
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ip_pool', '0004_networkipbitmap'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='networkmodel',
+            name='ip_version',
+            field=models.PositiveSmallIntegerField(default=4, editable=False),
+        ),
+        migrations.AddField(
+            model_name='networkmodel',
+            name='net_first',
+            field=models.DecimalField(decimal_places=0, default=0, editable=False, max_digits=39),
+        ),
+        migrations.AddField(
+            model_name='networkmodel',
+            name='net_last',
+            field=models.DecimalField(decimal_places=0, default=0, editable=False, max_digits=39),
+        ),
+        migrations.RunPython(fill_network_bounds, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='networkmodel',
+            index=models.Index(fields=['ip_version', 'net_first', 'net_last'], name='ip_pool_network_bounds'),
+        ),
+    ]
@@ -1,17 +1,37 @@
+import logging
+from datetime import timedelta
 from ipaddress import ip_network, ip_address
-from typing import Optional, Generator
+from typing import Optional, Generator, Tuple, List, Iterable
 
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
 from django.db.utils import IntegrityError
 from django.shortcuts import resolve_url
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import models, transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 from djing.fields import MACAddressField
 from djing.lib import DuplicateEntry
+from djing.lib.ip_bitmap import IpBitmap
+from djing.lib.net_index import NetworkIndex
 from ip_pool.fields import GenericIpAddressWithPrefix
 from group_app.models import Group
 
+# Occupancy bitmaps of networks are kept in NetworkIpBitmap, and rebuilt
+# from addresses of subscribers after IP_BITMAP_TTL seconds. Reserved but
+# not used addresses become free again after rebuild.
+IP_BITMAP_CACHE_KEY = 'ip_pool_bitmap_%d_%d_%d_%s'
+IP_BITMAP_TTL = getattr(settings, 'IP_BITMAP_TTL', 300)
+
+# Bitmap covers only first addresses of too big work range,
+# 1 << 22 addresses take 512 KiB
+IP_BITMAP_MAX_SIZE = getattr(settings, 'IP_BITMAP_MAX_SIZE', 1 << 22)
+
 
 class NetworkModel(models.Model):
     _netw_cache = None
@@ -40,6 +60,12 @@ class NetworkModel(models.Model):
     ip_start = models.GenericIPAddressField(_('Start work ip range'))
     ip_end = models.GenericIPAddressField(_('End work ip range'))
 
+    # Bounds of network as integers, for overlap search in db.
+    # Ipv6 addresses do not fit into bigint, so decimal is used.
+    ip_version = models.PositiveSmallIntegerField(default=4, editable=False)
+    net_first = models.DecimalField(max_digits=39, decimal_places=0, default=0, editable=False)
+    net_last = models.DecimalField(max_digits=39, decimal_places=0, default=0, editable=False)
+
     def __str__(self):
         netw = self.get_network()
         return "%s: %s" % (self.description, netw.with_prefixlen)
@@ -54,6 +80,14 @@ class NetworkModel(models.Model):
     def get_absolute_url(self):
         return resolve_url('ip_pool:net_edit', self.pk)
 
+    def save(self, *args, **kwargs):
+        if self.network:
+            net = ip_network(self.network)
+            self.ip_version = net.version
+            self.net_first = int(net.network_address)
+            self.net_last = int(net.broadcast_address)
+        super().save(*args, **kwargs)
+
     def clean(self):
         errs = {}
         if self.network is None:
@@ -90,21 +124,19 @@ class NetworkModel(models.Model):
         if errs:
             raise ValidationError(errs)
 
-        other_nets = NetworkModel.objects.exclude(
-            pk=self.pk
-        ).only('network').order_by('network')
-        if not other_nets.exists():
-            return
-        for onet in other_nets.iterator():
-            onet_netw = onet.get_network()
-            if net.overlaps(onet_netw):
-                errs['network'] = ValidationError(
-                    _('Network is overlaps with %(other_network)s'),
-                    params={
-                        'other_network': str(onet_netw)
-                    }
-                )
-                raise ValidationError(errs)
+        onet = NetworkModel.objects.exclude(pk=self.pk).filter(
+            ip_version=net.version,
+            net_first__lte=int(net.broadcast_address),
+            net_last__gte=int(net.network_address)
+        ).only('network').first()
+        if onet is not None:
+            errs['network'] = ValidationError(
+                _('Network is overlaps with %(other_network)s'),
+                params={
+                    'other_network': str(onet.get_network())
+                }
+            )
+            raise ValidationError(errs)
 
     def get_scope(self) -> str:
         net = self.get_network()
@@ -126,68 +158,220 @@ class NetworkModel(models.Model):
             return _('Unspecified')
         return "I don't know"
 
-    def get_free_ip(self, employed_ips: Optional[Generator]):
+    def get_work_range(self) -> Tuple[int, int]:
+        """
+        Range of host addresses that may be given to subscribers
+        :return: first and last ip as integers
+        """
+        net = self.get_network()
+        first = int(ip_address(self.ip_start))
+        last = int(ip_address(self.ip_end))
+        if net.num_addresses > 2:
+            # network address, and broadcast address for ipv4
+            first = max(first, int(net.network_address) + 1)
+            if net.version == 4:
+                last = min(last, int(net.broadcast_address) - 1)
+        if last - first >= IP_BITMAP_MAX_SIZE:
+            logging.warning('Work range of network %s is more than %d addresses, '
+                            'only first of them are given' % (net, IP_BITMAP_MAX_SIZE))
+            last = first + IP_BITMAP_MAX_SIZE - 1
+        return first, last
+
+    def _int2ip(self, ip: int):
+        return type(self.get_network().network_address)(ip)
+
+    def _employed_ips(self, nas_id: Optional[int]) -> Iterable:
+        Abon = apps.get_model('abonapp', 'Abon')
+        return Abon.objects.filter(nas_id=nas_id).exclude(
+            ip_address=None
+        ).values_list('ip_address', flat=True).iterator()
+
+    def _stored_ip_bitmap(self, nas_id: Optional[int], first: int, last: int):
+        """
+        :return: row of NetworkIpBitmap and bitmap from it, bitmap is None
+                 when it is not stored yet, is expired or range was changed
+        """
+        row = NetworkIpBitmap.objects.filter(network=self, nas_id=nas_id).first()
+        if row is None or row.work_range != '%d-%d' % (first, last):
+            return row, None
+        if row.date_built < timezone.now() - timedelta(seconds=IP_BITMAP_TTL):
+            return row, None
+        try:
+            return row, IpBitmap.from_bytes(first, last, bytes(row.bits))
+        except ValueError:
+            return row, None
+
+    def get_ip_bitmap(self, nas_id: Optional[int] = None) -> IpBitmap:
+        """
+        Occupancy bitmap of work range for subscribers of nas.
+        Ip addresses are unique for nas, so each nas has own bitmap.
+        Bitmap is only read here, cache just saves queries.
+        """
+        first, last = self.get_work_range()
+        key = IP_BITMAP_CACHE_KEY % (self.pk, first, last, nas_id)
+        data = cache.get(key)
+        if data is not None:
+            try:
+                return IpBitmap.from_bytes(first, last, data)
+            except ValueError:
+                pass
+        _row, bm = self._stored_ip_bitmap(nas_id, first, last)
+        if bm is None:
+            bm = IpBitmap(first, last, self._employed_ips(nas_id))
+        cache.set(key, bm.to_bytes(), IP_BITMAP_TTL)
+        return bm
+
+    def allocate_ips(self, count: int = 1, nas_id: Optional[int] = None) -> List:
+        """
+        Reserve free ip addresses in network. Bitmap is read from db
+        and written back under lock of network row, so concurrent calls
+        of any process do not get the same addresses. Reserved address
+        stays busy until it is saved to subscriber, or until bitmap
+        is rebuilt after IP_BITMAP_TTL.
+        :param count: how many addresses are needed
+        :param nas_id: nas of subscribers that will get addresses
+        :return: list of ip addresses, shorter than count
+                 if network has not enough free addresses
+        """
+        first, last = self.get_work_range()
+        if first > last:
+            return []
+        Abon = apps.get_model('abonapp', 'Abon')
+        with transaction.atomic():
+            NetworkModel.objects.select_for_update().filter(pk=self.pk).first()
+            row, bm = self._stored_ip_bitmap(nas_id, first, last)
+            if bm is None:
+                bm = IpBitmap(first, last, self._employed_ips(nas_id))
+                if row is None:
+                    row = NetworkIpBitmap(network=self, nas_id=nas_id)
+                row.work_range = '%d-%d' % (first, last)
+                row.date_built = timezone.now()
+            res = []
+            while len(res) < count:
+                ips = [self._int2ip(ip) for ip in bm.allocate(count - len(res))]
+                if not ips:
+                    break
+                # addresses that were set past allocator are skipped
+                employed = set(Abon.objects.filter(
+                    nas_id=nas_id, ip_address__in=[str(ip) for ip in ips]
+                ).values_list('ip_address', flat=True))
+                res.extend(ip for ip in ips if str(ip) not in employed)
+            row.bits = bm.to_bytes()
+            row.save()
+        cache.set(IP_BITMAP_CACHE_KEY % (self.pk, first, last, nas_id),
+                  row.bits, IP_BITMAP_TTL)
+        return res
+
+    def offer_ip(self, nas_id: Optional[int] = None):
+        """
+        Find free ip in network for subscriber of nas, without reserving
+        it, so it may be offered in form. Two forms may offer the same
+        address, and second of them is refused when saved.
+        :return: ip address, or None if network is full
+        """
+        first, last = self.get_work_range()
+        if first > last:
+            return
+        Abon = apps.get_model('abonapp', 'Abon')
+        bm = self.get_ip_bitmap(nas_id)
+        offset = bm.find_free()
+        while offset is not None:
+            ip = self._int2ip(first + offset)
+            # address may be set past allocator
+            if not Abon.objects.filter(nas_id=nas_id, ip_address=str(ip)).exists():
+                return ip
+            offset = bm.find_free(offset + 1)
+
+    def get_free_ip(self, employed_ips: Optional[Generator] = None):
         """
         Find free ip in network.
-        :param employed_ips: Sorted from less to more
-         ip addresses from current network.
+        :param employed_ips: ip addresses from current network,
+         in any order.
         :return: single finded ip
         """
-        network = self.get_network()
-        work_range_start_ip = ip_address(self.ip_start)
-        work_range_end_ip = ip_address(self.ip_end)
-        if employed_ips is None:
-            for ip in network.hosts():
-                if work_range_start_ip <= ip <= work_range_end_ip:
-                    return ip
+        first, last = self.get_work_range()
+        if first > last:
             return
-        for ip in network.hosts():
-            if ip < work_range_start_ip:
-                continue
-            elif ip > work_range_end_ip:
-                break  # Not found
-            used_ip = next(employed_ips)
-            if used_ip is None:
-                return ip
-            used_ip = ip_address(used_ip)
-            if ip < used_ip:
-                return ip
+        bm = IpBitmap(first, last, employed_ips or ())
+        offset = bm.find_free()
+        if offset is not None:
+            return self._int2ip(first + offset)
 
     class Meta:
         db_table = 'ip_pool_network'
         verbose_name = _('Network')
         verbose_name_plural = _('Networks')
         ordering = ('network',)
+        indexes = (
+            models.Index(fields=('ip_version', 'net_first', 'net_last'), name='ip_pool_network_bounds'),
+        )
+
+
+# Index of networks keeps in each process. Version of index is
+# kept in cache and changed on each save or delete of network.
+NETWORK_INDEX_VERSION_KEY = 'ip_pool_network_index_version'
+_network_index = None
+_network_index_version = None
+
+
+def get_network_index() -> NetworkIndex:
+    """
+    Lookup table from ip address to id of network that contains it
+    :return: instance of djing.lib.net_index.NetworkIndex
+    """
+    global _network_index, _network_index_version
+    version = cache.get(NETWORK_INDEX_VERSION_KEY, 0)
+    if _network_index is None or version != _network_index_version:
+        _network_index = NetworkIndex(
+            NetworkModel.objects.values_list('pk', 'network').iterator()
+        )
+        _network_index_version = version
+    return _network_index
+
+
+def find_network(ip) -> Optional[NetworkModel]:
+    """
+    :param ip: str or ip_address
+    :return: pool that owns ip, or None
+    """
+    net_id = get_network_index().find(ip)
+    if net_id is not None:
+        return NetworkModel.objects.filter(pk=net_id).first()
+
+
+@receiver(post_save, sender=NetworkModel)
+@receiver(post_delete, sender=NetworkModel)
+def network_change_index(sender, **kwargs):
+    global _network_index
+    _network_index = None
+    try:
+        cache.incr(NETWORK_INDEX_VERSION_KEY)
+    except ValueError:
+        cache.set(NETWORK_INDEX_VERSION_KEY, 1, None)
+
+
+class NetworkIpBitmap(models.Model):
+    """
+    Occupancy bitmap of work range of network for subscribers of nas,
+    it is changed only under lock of network row
+    """
+    network = models.ForeignKey(NetworkModel, on_delete=models.CASCADE)
+    nas = models.ForeignKey('gw_app.NASModel', null=True, blank=True, on_delete=models.CASCADE)
+    work_range = models.CharField(max_length=80)
+    bits = models.BinaryField()
+    date_built = models.DateTimeField()
+
+    class Meta:
+        db_table = 'ip_pool_network_bitmap'
+        unique_together = ('network', 'nas')
 
 
 class IpLeaseManager(models.Manager):
 
     def get_free_ip(self, network: NetworkModel):
-        netw = network.get_network()
-        work_range_start_ip = ip_address(network.ip_start)
-        work_range_end_ip = ip_address(network.ip_end)
-        employed_ip_queryset = self.filter(
-            network=network,
-            is_dynamic=False
-        ).order_by('ip').only('ip')
-
-        if employed_ip_queryset.exists():
-            used_ip_gen = employed_ip_queryset.iterator()
-            for net_ip in netw.hosts():
-                if net_ip < work_range_start_ip:
-                    continue
-                elif net_ip > work_range_end_ip:
-                    break
-                used_ip = next(used_ip_gen, None)
-                if used_ip is None:
-                    return net_ip
-                ip = ip_address(used_ip.ip)
-                if net_ip < ip:
-                    return net_ip
-        else:
-            for net in netw.hosts():
-                if work_range_start_ip <= net <= work_range_end_ip:
-                    return net
+        return network.get_free_ip(
+            self.filter(network=network).values_list('ip', flat=True).iterator()
+        )
 
     def create_from_ip(self, ip: str, net: Optional[NetworkModel],
                        mac=None, is_dynamic=True):
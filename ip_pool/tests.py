@@ -1,12 +1,18 @@
 from abc import ABCMeta
+from unittest import mock
 
 from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
 from django.shortcuts import resolve_url
-from django.test import TestCase, override_settings
+from django.test import TestCase, SimpleTestCase, override_settings
 
 from accounts_app.models import UserProfile
 from group_app.models import Group
-from ip_pool.models import NetworkModel
+from abonapp.models import Abon
+from djing.lib.ip_bitmap import IpBitmap
+from djing.lib.net_index import NetworkIndex
+from ip_pool.models import NetworkModel, NetworkIpBitmap, find_network, IP_BITMAP_MAX_SIZE
 
 
 class MyBaseTestCase(metaclass=ABCMeta):
@@ -137,3 +143,155 @@ class NetworksTestCase(MyBaseTestCase, TestCase):
             raise self.failureException('Network must will be deleted')
         except NetworkModel.DoesNotExist:
             pass
+
+    def test_allocate_ips(self):
+        abon = Abon.objects.create_user(
+            telephone='+79781234567',
+            username='abon',
+            password='passw1'
+        )
+        abon.ip_address = '192.168.23.2'
+        abon.save(update_fields=('ip_address',))
+        self.assertEqual(str(self.network.get_free_ip(('192.168.23.2',))), '192.168.23.3')
+        ips = self.network.allocate_ips(2)
+        self.assertEqual([str(ip) for ip in ips], ['192.168.23.3', '192.168.23.4'])
+        # reserved addresses are not given again, even by other process
+        # with own cache
+        cache.clear()
+        ips = self.network.allocate_ips(1)
+        self.assertEqual([str(ip) for ip in ips], ['192.168.23.5'])
+        self.assertEqual(NetworkIpBitmap.objects.filter(network=self.network, nas=None).count(), 1)
+        # address was set past allocator
+        abon.ip_address = '192.168.23.6'
+        abon.save(update_fields=('ip_address',))
+        ips = self.network.allocate_ips(1)
+        self.assertEqual([str(ip) for ip in ips], ['192.168.23.7'])
+
+    def test_offer_ip(self):
+        abon = Abon.objects.create_user(
+            telephone='+79781234567',
+            username='abon',
+            password='passw1'
+        )
+        self.assertEqual(str(self.network.offer_ip()), '192.168.23.2')
+        # offered address is not reserved
+        self.assertEqual(str(self.network.offer_ip()), '192.168.23.2')
+        # address was set past allocator
+        abon.ip_address = '192.168.23.2'
+        abon.save(update_fields=('ip_address',))
+        self.assertEqual(str(self.network.offer_ip()), '192.168.23.3')
+
+    def test_clean_overlaps_ipv6(self):
+        NetworkModel.objects.create(
+            network='fde8:6789:1234:1::/64',
+            kind='inet',
+            description='Ipv6',
+            ip_start='fde8:6789:1234:1::2',
+            ip_end='fde8:6789:1234:1::ff'
+        )
+        netw = NetworkModel(
+            network='fde8:6789:1234::/48',
+            kind='inet',
+            description='Other',
+            ip_start='fde8:6789:1234::2',
+            ip_end='fde8:6789:1234::ff'
+        )
+        with self.assertRaises(ValidationError):
+            netw.clean()
+        # integer bounds are the same as of ipv4 network 192.168.23.0/24,
+        # but networks of different versions do not overlap
+        netw = NetworkModel(
+            network='::/96',
+            kind='inet',
+            description='Other',
+            ip_start='::2',
+            ip_end='::ff'
+        )
+        netw.clean()
+
+    def test_work_range_truncated(self):
+        netw = NetworkModel(
+            network='10.0.0.0/8',
+            ip_start='10.0.0.1',
+            ip_end='10.255.255.254'
+        )
+        with self.assertLogs(level='WARNING'):
+            first, last = netw.get_work_range()
+        self.assertEqual(last - first + 1, IP_BITMAP_MAX_SIZE)
+
+    def test_find_network(self):
+        self.assertEqual(find_network('192.168.23.10'), self.network)
+        self.assertIsNone(find_network('192.168.24.10'))
+        netw = NetworkModel.objects.create(
+            network='192.168.24.0/24',
+            kind='inet',
+            description='Other',
+            ip_start='192.168.24.2',
+            ip_end='192.168.24.254'
+        )
+        # index is changed after save
+        self.assertEqual(find_network('192.168.24.10'), netw)
+        netw.network = '192.168.0.0/16'
+        with self.assertRaises(ValidationError):
+            netw.clean()
+        netw.delete()
+        self.assertIsNone(find_network('192.168.24.10'))
+
+    def test_clean_with_stale_index(self):
+        # index was not refreshed, networks are checked in db anyway
+        with mock.patch('ip_pool.models.get_network_index', return_value=NetworkIndex()):
+            netw = NetworkModel(
+                network='192.168.23.128/25',
+                kind='inet',
+                description='Other',
+                ip_start='192.168.23.130',
+                ip_end='192.168.23.254'
+            )
+            with self.assertRaises(ValidationError):
+                netw.clean()
+
+
+class NetworkIndexTestCase(SimpleTestCase):
+    def test_find(self):
+        idx = NetworkIndex((
+            (1, '10.0.0.0/8'),
+            (2, '10.1.0.0/16'),
+            (3, '192.168.0.0/24'),
+            (4, 'fde8:6789:1234:1::/64')
+        ))
+        self.assertEqual(idx.find('10.1.2.3'), 2)
+        self.assertEqual(idx.find('10.2.2.3'), 1)
+        self.assertEqual(idx.find('192.168.0.255'), 3)
+        self.assertIsNone(idx.find('192.168.1.0'))
+        self.assertEqual(idx.find('fde8:6789:1234:1::5'), 4)
+        self.assertIsNone(idx.find('fde8::1'))
+        self.assertIsNone(idx.find('bad ip'))
+
+    def test_overlaps(self):
+        idx = NetworkIndex(((1, '10.0.0.0/16'), (2, '192.168.0.0/24')))
+        self.assertEqual(idx.overlaps('10.0.5.0/24'), 1)
+        self.assertEqual(idx.overlaps('0.0.0.0/0'), 2)
+        self.assertIsNone(idx.overlaps('10.0.0.0/16', exclude=1))
+        self.assertIsNone(idx.overlaps('192.168.1.0/24'))
+        self.assertIsNone(idx.overlaps('fde8::/16'))
+
+
+class IpBitmapTestCase(SimpleTestCase):
+    def test_find_free(self):
+        bm = IpBitmap(10, 29, used=(9, 10, 11, 13, 30, '0.0.0.14'))
+        self.assertEqual(bm.find_free(), 2)
+        self.assertEqual(bm.find_free(3), 5)
+        self.assertEqual(bm.free_count(), 16)
+        self.assertEqual(bm.allocate(3), [12, 15, 16])
+        self.assertIn(12, bm)
+        bm.set_free(11)
+        self.assertEqual(bm.find_free(), 1)
+        self.assertEqual(len(bm.allocate(100)), 14)
+        self.assertIsNone(bm.find_free())
+
+    def test_serialize(self):
+        bm = IpBitmap(0, 1000, used=range(0, 1000, 2))
+        bm2 = IpBitmap.from_bytes(0, 1000, bm.to_bytes())
+        self.assertEqual(bm2.allocate(2), [1, 3])
+        with self.assertRaises(ValueError):
+            IpBitmap.from_bytes(0, 2000, bm.to_bytes())
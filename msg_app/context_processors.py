@@ -1,9 +1,12 @@
+from djing.lib import LazyValue
 from .models import Conversation
 
 
-def get_new_messages_count(request):
+def _new_messages_count(request):
     if request.user.is_anonymous:
-        count = 0
-    else:
-        count = Conversation.objects.get_new_messages_count(request.user)
-    return {'new_messages_count': count}
+        return 0
+    return Conversation.objects.get_new_messages_count(request.user)
+
+
+def get_new_messages_count(request):
+    return {'new_messages_count': LazyValue(_new_messages_count, request)}
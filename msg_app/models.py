@@ -1,7 +1,13 @@
+from typing import Dict, Callable, Iterable
+
+from django.conf import settings
+from django.core.cache import cache
 from django.db import models
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.utils.translation import gettext_lazy as _
 from accounts_app.models import UserProfile
-from djing.tasks import send_email_notify
+from djing.tasks import multicast_email_notify
 from chatbot.models import ChatException
 
 
@@ -67,15 +73,15 @@ class Message(models.Model):
         return self.text[:9]
 
     def _set_status(self, account, code):
-        try:
-            ms = MessageStatus.objects.get(msg=self, user=account)
-            if ms.status == code:
-                return False
-            ms.status = code
-            ms.save(update_fields=('status',))
-            return True
-        except MessageStatus.DoesNotExist:
+        qs = MessageStatus.objects.filter(msg=self, user=account)
+        was_new = qs.filter(state='new').exists()
+        if not qs.exclude(state=code).update(state=code):
             return False
+        if code == 'new':
+            _add_new_messages_count((account.pk,), self.conversation_id, 1)
+        elif was_new:
+            _add_new_messages_count((account.pk,), self.conversation_id, -1)
+        return True
 
     def set_status_old(self, account):
         return self._set_status(account, 'old')
@@ -132,6 +138,53 @@ def id_to_userprofile(acc):
         raise MessageError(_('Participant profile does not found'))
 
 
+# Count of new messages for each user is cached as dict
+# of conversation id -> count, and updated when statuses changed.
+NEW_MESSAGES_CACHE_KEY = 'msg_app_new_messages_%d'
+NEW_MESSAGES_CACHE_TIMEOUT = getattr(settings, 'NEW_MESSAGES_CACHE_TIMEOUT', 600)
+
+
+def get_new_messages_counts(account_id: int) -> Dict[int, int]:
+    """
+    :param account_id: UserProfile id
+    :return: dict of conversation id -> count of new messages
+    """
+    cache_key = NEW_MESSAGES_CACHE_KEY % account_id
+    counts = cache.get(cache_key)
+    if counts is None:
+        counts = dict(MessageStatus.objects.filter(
+            user_id=account_id, state='new'
+        ).order_by().values_list('msg__conversation').annotate(
+            cnt=models.Count('pk')
+        ))
+        cache.set(cache_key, counts, NEW_MESSAGES_CACHE_TIMEOUT)
+    return counts
+
+
+def _update_new_messages_counts(account_id: int, fn: Callable[[Dict[int, int]], None]) -> None:
+    # counters that is not in cache will be counted when required
+    cache_key = NEW_MESSAGES_CACHE_KEY % account_id
+    counts = cache.get(cache_key)
+    if counts is None:
+        return
+    fn(counts)
+    cache.set(cache_key, counts, NEW_MESSAGES_CACHE_TIMEOUT)
+
+
+def _add_new_messages_count(account_ids: Iterable[int], conversation_id: int, delta: int) -> None:
+    keys = {NEW_MESSAGES_CACHE_KEY % acc_id: acc_id for acc_id in account_ids}
+    cached = cache.get_many(keys)
+    if not cached:
+        return
+    for counts in cached.values():
+        n = counts.get(conversation_id, 0) + delta
+        if n > 0:
+            counts[conversation_id] = n
+        else:
+            counts.pop(conversation_id, None)
+    cache.set_many(cached, NEW_MESSAGES_CACHE_TIMEOUT)
+
+
 class ConversationManager(models.Manager):
     def create_conversation(self, author, other_participants, title=None):
         other_participants = tuple(
@@ -144,23 +197,20 @@ class ConversationManager(models.Manager):
             else:
                 title = ', '.join(usernames)
         conversation = self.create(title=title, author=author)
-        for acc in other_participants:
-            ConversationMembership.objects.create(
-                account=acc, conversation=conversation,
-                status='adm', who_invite_that_user=author
-            )
-
-        ConversationMembership.objects.create(
+        memberships = [ConversationMembership(
+            account=acc, conversation=conversation,
+            status='adm', who_invite_that_user=author
+        ) for acc in other_participants]
+        memberships.append(ConversationMembership(
             account=author, conversation=conversation, status='inv'
-        )
+        ))
+        ConversationMembership.objects.bulk_create(memberships)
         return conversation
 
     @staticmethod
     def get_new_messages_count(account):
         if isinstance(account, UserProfile):
-            return MessageStatus.objects.filter(
-                user=account, state='new'
-            ).count()
+            return sum(get_new_messages_counts(account.pk).values())
         else:
             return 0
 
@@ -168,8 +218,9 @@ class ConversationManager(models.Manager):
         conversations = self.filter(
             models.Q(author=account) | models.Q(participants__in=(account,))
         ).annotate(
-            msg_count=models.Count('message', distinct=True)
-        )
+            msg_count=models.Count('message', distinct=True),
+            participants_count=models.Count('conversationmembership', distinct=True)
+        ).select_related('author')
         return conversations
 
 
@@ -192,15 +243,10 @@ class Conversation(models.Model):
         return Message.objects.filter(conversation=self).order_by('sent_at')
 
     def get_messages_new_count(self, account):
-        msgs = Message.objects.filter(conversation=self)
-        return MessageStatus.objects.filter(
-            user=account, msg__in=msgs, state='new'
-        ).count()
+        return get_new_messages_counts(account.pk).get(self.pk, 0)
 
     def last_message(self):
-        messages = Message.objects.filter(conversation=self)
-        if messages.count() > 0:
-            return messages[0]
+        return Message.objects.filter(conversation=self).first()
 
     def new_message(self, text, attachment, author, with_status=True):
         try:
@@ -209,13 +255,18 @@ class Conversation(models.Model):
                 attachment=attachment, author=author
             )
             if with_status:
-                for participant in self.participants.all():
-                    if participant == author:
-                        continue
-                    MessageStatus.objects.create(msg=msg, user=participant)
-                    send_email_notify.delay(
+                participant_ids = tuple(self.participants.exclude(
+                    pk=author.pk
+                ).values_list('pk', flat=True))
+                MessageStatus.objects.bulk_create([
+                    MessageStatus(msg=msg, user_id=participant_id)
+                    for participant_id in participant_ids
+                ])
+                _add_new_messages_count(participant_ids, self.pk, 1)
+                if participant_ids:
+                    multicast_email_notify.delay(
                         msg_text=text,
-                        account_id=participant.pk
+                        account_ids=participant_ids
                     )
             return msg
         except ChatException as e:
@@ -284,7 +335,13 @@ class Conversation(models.Model):
         ).exclude(state='del')
         if status != 'del':
             qs = qs.exclude(state=status)
-        return qs.update(state=status)
+        changed = qs.update(state=status)
+        if status == 'new':
+            _add_new_messages_count((account.pk,), self.pk, changed)
+        else:
+            # there is no new messages in conversation now
+            _update_new_messages_counts(account.pk, lambda counts: counts.pop(self.pk, None))
+        return changed
 
     def make_messages_status_new(self, account):
         return self._make_messages_status(account, 'new')
@@ -297,3 +354,9 @@ class Conversation(models.Model):
         verbose_name = _("Conversation")
         verbose_name_plural = _("Conversations")
         ordering = ('title',)
+
+
+@receiver(post_delete, sender=MessageStatus)
+def msg_status_post_delete(sender, instance, **kwargs):
+    if instance.state == 'new':
+        cache.delete(NEW_MESSAGES_CACHE_KEY % instance.user_id)
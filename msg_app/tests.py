@@ -1,3 +1,62 @@
+from smtplib import SMTPException
+from time import time
+from unittest import mock
+
+from django.core import mail
+from django.core.cache import cache
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from accounts_app.models import UserProfile
+from djing.tasks import multicast_email_notify
+from msg_app.models import Conversation
+
+
+class ConversationFanOutTest(TestCase):
+    def setUp(self):
+        self.author = UserProfile.objects.create_superuser('+79781234567', 'local_superuser', 'ps')
+        self.users = [UserProfile.objects.create_user(
+            telephone='+7978%07d' % i, username='user%d' % i, password='ps'
+        ) for i in range(200)]
+
+    @mock.patch('msg_app.models.multicast_email_notify')
+    def test_new_message_queries_not_depend_on_participants(self, notify):
+        small_conv = Conversation.objects.create_conversation(self.author, self.users[:2], 'small')
+        big_conv = Conversation.objects.create_conversation(self.author, self.users, 'big')
+        self.assertEqual(big_conv.participants.count(), 201)
+
+        with CaptureQueriesContext(connection) as small_queries:
+            small_conv.new_message('Test', None, self.author)
+        t = time()
+        with CaptureQueriesContext(connection) as big_queries:
+            big_conv.new_message('Test', None, self.author)
+        print('new_message for 200 participants: %.4f sec' % (time() - t))
+        self.assertEqual(len(small_queries), len(big_queries))
+        self.assertEqual(notify.delay.call_count, 2)
+
+        self.assertEqual(Conversation.objects.get_new_messages_count(self.users[0]), 2)
+        self.assertEqual(Conversation.objects.get_new_messages_count(self.users[199]), 1)
+        self.assertEqual(big_conv.make_messages_status_old(self.users[0]), 1)
+        self.assertEqual(Conversation.objects.get_new_messages_count(self.users[0]), 1)
+        self.assertEqual(big_conv.get_messages_new_count(self.users[0]), 0)
+
+
+class EmailNotifyDedupTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = UserProfile.objects.create_user(
+            telephone='+79781234567', username='user', password='ps'
+        )
+        UserProfile.objects.filter(pk=self.user.pk).update(email='user@example.com')
 
-# Create your tests here.
+    def test_retry_after_smtp_failure(self):
+        with mock.patch('djing.tasks.get_connection', side_effect=SMTPException('fail')):
+            multicast_email_notify('Test', (self.user.pk,))
+        self.assertEqual(len(mail.outbox), 0)
+        # failed notification is not marked as sent
+        multicast_email_notify('Test', (self.user.pk,))
+        self.assertEqual(len(mail.outbox), 1)
+        # sent notification is not repeated
+        multicast_email_notify('Test', (self.user.pk,))
+        self.assertEqual(len(mail.outbox), 1)
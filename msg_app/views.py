@@ -13,7 +13,7 @@ from chatbot.models import MessageQueue
 from djing.lib.decorators import only_admins
 from guardian.decorators import permission_required_or_403 as permission_required
 
-from .models import Conversation, MessageError, Message
+from .models import Conversation, MessageError, Message, get_new_messages_counts
 from .forms import ConversationForm, MessageForm
 
 
@@ -27,9 +27,15 @@ class ConversationsListView(ListView):
     template_name = 'msg_app/conversations.html'
 
     def get_queryset(self):
-        # TODO: optimise queries
         return Conversation.objects.fetch(self.request.user)
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        new_counts = get_new_messages_counts(self.request.user.pk)
+        for conv in context[self.context_object_name]:
+            conv.new_count = new_counts.get(conv.pk, 0)
+        return context
+
 
 @login_required
 @only_admins
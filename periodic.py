@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import os
+from datetime import timedelta
 from threading import Thread
 import django
 
@@ -7,8 +8,9 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "djing.settings")
 django.setup()
 from django.utils import timezone
 from django.db import transaction
-from django.db.models import signals, Count
-from abonapp.models import Abon, AbonTariff, abontariff_pre_delete, PeriodicPayForId, AbonLog
+from django.db.models import signals
+from abonapp.models import Abon, AbonTariff, abontariff_pre_delete, PeriodicPayForId, AbonLog, \
+    recount_abon_counters, recount_pay_stats
 from gw_app.nas_managers import NasNetworkError, NasFailedResult
 from gw_app.models import NASModel
 from djing.lib import LogicError
@@ -120,10 +122,16 @@ def main():
     for pay in ppays:
         pay.payment_for_service(now=now)
 
+    # services was deleted by queryset, so counters are fixed here
+    recount_abon_counters()
+
+    # payments changed by queryset are not seen by signals,
+    # stats of current and previous months are fixed here
+    recount_pay_stats(date_from=(now - timedelta(days=31)).date())
+
     # sync subscribers on GW
     threads = tuple(NasSyncThread(nas) for nas in NASModel.objects.
-                    annotate(usercount=Count('abon')).
-                    filter(usercount__gt=0, enabled=True))
+                    filter(abon_counters__total__gt=0, enabled=True))
     for t in threads:
         t.start()
     for t in threads:
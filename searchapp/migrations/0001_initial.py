@@ -0,0 +1,84 @@
+# Generated by Django 2.1 on 2026-10-19 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_search_index(apps, _):
+    from searchapp.models import (
+        KIND_ABON, KIND_DEVICE, abon_index_fields, device_index_fields, gram_weights
+    )
+    SearchEntry = apps.get_model('searchapp', 'SearchEntry')
+    SearchGram = apps.get_model('searchapp', 'SearchGram')
+    Abon = apps.get_model('abonapp', 'Abon')
+    AdditionalTelephone = apps.get_model('abonapp', 'AdditionalTelephone')
+    Device = apps.get_model('devapp', 'Device')
+
+    telephones = {}
+    for abon_id, tel in AdditionalTelephone.objects.values_list('abon_id', 'telephone').iterator():
+        telephones.setdefault(abon_id, []).append(tel)
+
+    def objects_fields():
+        for pk, username, fio, telephone, ip_address in Abon.objects.filter(is_admin=False).values_list(
+                'pk', 'username', 'fio', 'telephone', 'ip_address').iterator():
+            yield KIND_ABON, pk, abon_index_fields(
+                username, fio, telephone, ip_address, telephones.get(pk, ())
+            )
+        for pk, comment, mac_addr, ip_address in Device.objects.values_list(
+                'pk', 'comment', 'mac_addr', 'ip_address').iterator():
+            yield KIND_DEVICE, pk, device_index_fields(comment, mac_addr, ip_address)
+
+    for kind, pk, fields in objects_fields():
+        entry = SearchEntry.objects.create(
+            kind=kind, obj_id=pk, text='\n'.join(text for text, weight in fields)
+        )
+        SearchGram.objects.bulk_create(
+            SearchGram(entry=entry, gram=gram, weight=weight)
+            for gram, weight in gram_weights(fields).items()
+        )
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('abonapp', '0008_auto_20181115_1206'),
+        ('devapp', '0005_device_ip_address_change'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('a', 'Abon'), ('d', 'Device')], max_length=1)),
+                ('obj_id', models.PositiveIntegerField()),
+                ('text', models.TextField()),
+            ],
+            options={
+                'db_table': 'search_entry',
+            },
+        ),
+        migrations.CreateModel(
+            name='SearchGram',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('gram', models.CharField(max_length=3)),
+                ('weight', models.PositiveSmallIntegerField()),
+                ('entry', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='grams', to='searchapp.SearchEntry')),
+            ],
+            options={
+                'db_table': 'search_gram',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='searchentry',
+            unique_together={('kind', 'obj_id')},
+        ),
+        migrations.AlterIndexTogether(
+            name='searchgram',
+            index_together={('gram', 'entry')},
+        ),
+        migrations.RunPython(fill_search_index, migrations.RunPython.noop),
+    ]
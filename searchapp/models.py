@@ -1 +1,248 @@
-# Create your models here.
+import re
+from typing import Iterable, Optional, Tuple, List
+
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import Count, Sum, Value, IntegerField
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from netaddr import EUI, AddrFormatError
+
+from abonapp.models import Abon, AdditionalTelephone
+from devapp.models import Device
+
+KIND_ABON = 'a'
+KIND_DEVICE = 'd'
+
+# Weight of field in rank of found entry
+WEIGHT_USERNAME = 5
+WEIGHT_TELEPHONE = 4
+WEIGHT_IP = 4
+WEIGHT_MAC = 4
+WEIGHT_FIO = 3
+WEIGHT_COMMENT = 2
+
+GRAM_LEN = 3
+
+# Query shorter than gram can not be found by index, and entries are
+# checked by LIKE, so count of them is limited
+SEARCH_SHORT_QUERY_LIMIT = getattr(settings, 'SEARCH_SHORT_QUERY_LIMIT', 100)
+
+_MAC_PART_REGEX = re.compile(r'^[0-9a-f]{1,2}([:-][0-9a-f]{1,2})+$')
+
+# Fields from which index entry is built
+ABON_INDEX_FIELDS = ('username', 'fio', 'telephone', 'ip_address')
+DEVICE_INDEX_FIELDS = ('comment', 'mac_addr', 'ip_address')
+
+
+def normalize(text) -> str:
+    if not text:
+        return ''
+    return str(text).strip().lower().replace('ё', 'е')
+
+
+def normalize_mac(mac) -> str:
+    if not mac:
+        return ''
+    try:
+        return '%012x' % int(EUI(mac))
+    except (AddrFormatError, TypeError, ValueError):
+        return ''
+
+
+def normalize_query(query: str) -> str:
+    q = normalize(query).replace('+', '')
+    if _MAC_PART_REGEX.match(q):
+        # part of mac address, in index macs are kept without separators
+        q = ''.join(p.rjust(2, '0') for p in re.split('[:-]', q))
+    return q
+
+
+def ngrams(text: str, n=GRAM_LEN) -> set:
+    return set(text[i:i + n] for i in range(len(text) - n + 1))
+
+
+def abon_index_fields(username, fio, telephone, ip_address, telephones: Iterable = ()) -> List[Tuple[str, int]]:
+    fields = [
+        (normalize(username), WEIGHT_USERNAME),
+        (normalize(telephone).replace('+', ''), WEIGHT_TELEPHONE),
+        (normalize(ip_address), WEIGHT_IP),
+        (normalize(fio), WEIGHT_FIO)
+    ]
+    fields.extend((normalize(tel).replace('+', ''), WEIGHT_TELEPHONE) for tel in telephones)
+    return [f for f in fields if f[0]]
+
+
+def device_index_fields(comment, mac_addr, ip_address) -> List[Tuple[str, int]]:
+    fields = [
+        (normalize_mac(mac_addr), WEIGHT_MAC),
+        (normalize(ip_address), WEIGHT_IP),
+        (normalize(comment), WEIGHT_COMMENT)
+    ]
+    return [f for f in fields if f[0]]
+
+
+def gram_weights(fields: List[Tuple[str, int]]) -> dict:
+    """
+    :param fields: list of (normalized text, weight) pairs
+    :return: dict gram -> max weight of fields where gram is
+    """
+    res = {}
+    for text, weight in fields:
+        for gram in ngrams(text):
+            if res.get(gram, 0) < weight:
+                res[gram] = weight
+    return res
+
+
+class SearchEntryManager(models.Manager):
+
+    @transaction.atomic
+    def set_entry(self, kind: str, obj_id: int, fields: List[Tuple[str, int]]) -> None:
+        """
+        Replace index of one object
+        :param kind: KIND_ABON or KIND_DEVICE
+        :param obj_id: primary key of object
+        :param fields: list of (normalized text, weight) pairs
+        """
+        entry, created = self.update_or_create(kind=kind, obj_id=obj_id, defaults={
+            # fields are separated, so substring is not found on their junction
+            'text': '\n'.join(text for text, weight in fields)
+        })
+        if not created:
+            SearchGram.objects.filter(entry=entry).delete()
+        SearchGram.objects.bulk_create(
+            SearchGram(entry=entry, gram=gram, weight=weight)
+            for gram, weight in gram_weights(fields).items()
+        )
+
+    def remove_entry(self, kind: str, obj_id: int) -> None:
+        self.filter(kind=kind, obj_id=obj_id).delete()
+
+    def search(self, query: str, kind: Optional[str] = None):
+        """
+        Find entries that contains query string in any indexed field.
+        Entries are found by grams of query from index, and only
+        found entries are checked for whole query string.
+        Query shorter than gram is checked by LIKE in all entries,
+        so only first SEARCH_SHORT_QUERY_LIMIT of them are returned.
+        :param query: search string
+        :param kind: KIND_ABON or KIND_DEVICE, or None for all
+        :return: QuerySet of dicts with kind, obj_id and rank,
+                 ordered by rank
+        """
+        q = normalize_query(query)
+        if not q:
+            return self.none()
+        grams = ngrams(q)
+        qs = self.filter(text__contains=q)
+        if kind is not None:
+            qs = qs.filter(kind=kind)
+        if not grams:
+            # query is shorter than gram, scan of entries stops after limit
+            return qs.annotate(
+                rank=Value(0, output_field=IntegerField())
+            ).values('kind', 'obj_id', 'rank').order_by('kind', 'obj_id')[:SEARCH_SHORT_QUERY_LIMIT]
+        return qs.filter(grams__gram__in=grams).values('kind', 'obj_id').annotate(
+            hits=Count('grams__gram', distinct=True),
+            rank=Sum('grams__weight')
+        ).filter(hits=len(grams)).order_by('-rank', 'kind', 'obj_id')
+
+
+class SearchEntry(models.Model):
+    KIND_CHOICES = (
+        (KIND_ABON, 'Abon'),
+        (KIND_DEVICE, 'Device')
+    )
+    kind = models.CharField(max_length=1, choices=KIND_CHOICES)
+    obj_id = models.PositiveIntegerField()
+    text = models.TextField()
+
+    objects = SearchEntryManager()
+
+    def __str__(self):
+        return "%s%d" % (self.kind, self.obj_id)
+
+    class Meta:
+        db_table = 'search_entry'
+        unique_together = ('kind', 'obj_id')
+
+
+class SearchGram(models.Model):
+    entry = models.ForeignKey(SearchEntry, on_delete=models.CASCADE, related_name='grams')
+    gram = models.CharField(max_length=GRAM_LEN)
+    weight = models.PositiveSmallIntegerField()
+
+    def __str__(self):
+        return self.gram
+
+    class Meta:
+        db_table = 'search_gram'
+        index_together = ('gram', 'entry')
+
+
+def index_abon(abon_id: int) -> None:
+    abon = Abon.objects.filter(pk=abon_id).only(*ABON_INDEX_FIELDS).first()
+    if abon is None:
+        SearchEntry.objects.remove_entry(KIND_ABON, abon_id)
+        return
+    telephones = AdditionalTelephone.objects.filter(abon_id=abon_id).values_list('telephone', flat=True)
+    SearchEntry.objects.set_entry(KIND_ABON, abon_id, abon_index_fields(
+        abon.username, abon.fio, abon.telephone, abon.ip_address, telephones
+    ))
+
+
+def index_device(device: Device) -> None:
+    SearchEntry.objects.set_entry(KIND_DEVICE, device.pk, device_index_fields(
+        device.comment, device.mac_addr, device.ip_address
+    ))
+
+
+def load_found(found, kind):
+    """
+    Load objects for page of found index entries, keeping order of rank
+    :param found: iterable of dicts with kind and obj_id
+    :param kind: KIND_ABON or KIND_DEVICE
+    """
+    ids = [f['obj_id'] for f in found if f['kind'] == kind]
+    if not ids:
+        return []
+    if kind == KIND_ABON:
+        qs = Abon.objects.filter(pk__in=ids).select_related('group')
+    else:
+        qs = Device.objects.filter(pk__in=ids).select_related('group')
+    objs = {o.pk: o for o in qs}
+    return [objs[i] for i in ids if i in objs]
+
+
+def _is_index_changed(update_fields, index_fields) -> bool:
+    return update_fields is None or any(f in index_fields for f in update_fields)
+
+
+@receiver(post_save, sender=Abon)
+def abon_post_save_search(sender, instance, update_fields=None, **kwargs):
+    # balance and other fields are saved often, skip them
+    if _is_index_changed(update_fields, ABON_INDEX_FIELDS):
+        index_abon(instance.pk)
+
+
+@receiver(post_delete, sender=Abon)
+def abon_post_delete_search(sender, instance, **kwargs):
+    SearchEntry.objects.remove_entry(KIND_ABON, instance.pk)
+
+
+@receiver(post_save, sender=AdditionalTelephone)
+@receiver(post_delete, sender=AdditionalTelephone)
+def additional_telephone_search(sender, instance, **kwargs):
+    index_abon(instance.abon_id)
+
+
+@receiver(post_save, sender=Device)
+def device_post_save_search(sender, instance, update_fields=None, **kwargs):
+    if _is_index_changed(update_fields, DEVICE_INDEX_FIELDS):
+        index_device(instance)
+
+
+@receiver(post_delete, sender=Device)
+def device_post_delete_search(sender, instance, **kwargs):
+    SearchEntry.objects.remove_entry(KIND_DEVICE, instance.pk)
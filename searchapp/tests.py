@@ -0,0 +1,82 @@
+from unittest import mock
+
+from django.shortcuts import resolve_url
+from django.test import TestCase
+
+from abonapp.models import Abon, AdditionalTelephone
+from accounts_app.models import UserProfile
+from devapp.models import Device
+from .models import SearchEntry, KIND_ABON, KIND_DEVICE, normalize_query
+
+
+class SearchIndexTest(TestCase):
+    def setUp(self):
+        self.abon = Abon.objects.create_user(
+            telephone='+79781234567',
+            username='ivanov',
+            password='passw1'
+        )
+        self.abon.fio = 'Иванов Пётр'
+        self.abon.save(update_fields=('fio',))
+        self.device = Device.objects.create(
+            ip_address='192.168.0.100',
+            mac_addr='78:81:f2:1f:d2:a9',
+            comment='Switch Ivanovka',
+            devtype='Dl',
+            man_passw='public'
+        )
+
+    def found(self, query, kind=None):
+        return [(f['kind'], f['obj_id']) for f in SearchEntry.objects.search(query, kind)]
+
+    def test_normalize_query(self):
+        self.assertEqual(normalize_query(' +7978 '), '7978')
+        self.assertEqual(normalize_query('F2:1F:D2:A9'), 'f21fd2a9')
+        self.assertEqual(normalize_query('Пётр'), 'петр')
+
+    def test_search(self):
+        self.assertEqual(self.found('петр'), [(KIND_ABON, self.abon.pk)])
+        self.assertEqual(self.found('1234567'), [(KIND_ABON, self.abon.pk)])
+        self.assertEqual(self.found('d2-a9'), [(KIND_DEVICE, self.device.pk)])
+        self.assertEqual(self.found('168.0.1'), [(KIND_DEVICE, self.device.pk)])
+        # username has more weight than device comment
+        self.assertEqual(self.found('IVANOV'), [
+            (KIND_ABON, self.abon.pk), (KIND_DEVICE, self.device.pk)
+        ])
+        self.assertEqual(self.found('ivanov', KIND_DEVICE), [(KIND_DEVICE, self.device.pk)])
+        # letters are in fio, but not as one string
+        self.assertEqual(self.found('иванпетр'), [])
+        # short query
+        self.assertEqual(self.found('ив', KIND_ABON), [(KIND_ABON, self.abon.pk)])
+        with mock.patch('searchapp.models.SEARCH_SHORT_QUERY_LIMIT', 1):
+            self.assertEqual(self.found('iv'), [(KIND_ABON, self.abon.pk)])
+
+    def test_index_sync(self):
+        tel = AdditionalTelephone.objects.create(
+            abon=self.abon, telephone='+79787654321', owner_name='Wife'
+        )
+        self.assertEqual(self.found('7654321'), [(KIND_ABON, self.abon.pk)])
+        tel.delete()
+        self.assertEqual(self.found('7654321'), [])
+
+        self.device.comment = 'Core switch'
+        self.device.save()
+        self.assertEqual(self.found('core'), [(KIND_DEVICE, self.device.pk)])
+        self.device.delete()
+        self.assertEqual(self.found('core'), [])
+
+        abon_pk = self.abon.pk
+        self.abon.delete()
+        self.assertFalse(SearchEntry.objects.filter(kind=KIND_ABON, obj_id=abon_pk).exists())
+
+    def test_search_page(self):
+        UserProfile.objects.create_superuser('+79781234560', 'admin', 'passw')
+        self.client.login(username='admin', password='passw')
+        with self.settings(PAGINATION_ITEMS_PER_PAGE=1):
+            r = self.client.get(resolve_url('searchapp:home'), {'s': 'ivanov'})
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(r.context['page_obj'].paginator.count, 2)
+            self.assertContains(r, '<b>ivanov</b>')
+            self.assertContains(r, 'class="pagination"', count=1)
+            r = self.client.get(resolve_url('searchapp:home'), {'s': 'ivanov', 'page': 3})
+            self.assertEqual(r.status_code, 404)
@@ -1,49 +1,57 @@
 import re
-from django.db.models import Q
+from django.conf import settings
+from django.core.paginator import Paginator, InvalidPage
+from django.http import Http404
 from django.shortcuts import render
 from django.utils.html import escape
-from abonapp.models import Abon
-from devapp.models import Device
-from djing import MAC_ADDR_REGEX
 from django.contrib.auth.decorators import login_required
 from djing.lib.decorators import only_admins
+from .models import SearchEntry, KIND_ABON, KIND_DEVICE, load_found
 
 
-def replace_without_case(orig, old, new):
-    return re.sub(old, new, orig, flags=re.IGNORECASE)
+def highlight(text, pattern) -> str:
+    """
+    Escape text and wrap all found substrings into <b>
+    :param pattern: compiled case-insensitive regex of search string
+    """
+    return pattern.sub(lambda m: '<b>%s</b>' % m.group(0), escape(text or ''))
 
 
 @login_required
 @only_admins
 def home(request):
-    s = request.GET.get('s')
-    s = s.replace('+', '')
+    s = request.GET.get('s') or ''
+    s = s.replace('+', '').strip()
 
+    abons = devices = ()
+    paginator = page_obj = None
     if s:
-        abons = Abon.objects.filter(
-            Q(fio__icontains=s) | Q(username__icontains=s) | Q(telephone__icontains=s) |
-            Q(additional_telephones__telephone__icontains=s) | Q(ip_address__icontains=s)
+        paginator = Paginator(
+            SearchEntry.objects.search(s),
+            getattr(settings, 'PAGINATION_ITEMS_PER_PAGE', 10)
         )
+        try:
+            page_obj = paginator.page(request.GET.get('page') or 1)
+        except InvalidPage as e:
+            raise Http404(e)
 
-        if re.match(MAC_ADDR_REGEX, s):
-            devices = Device.objects.filter(mac_addr=s)
-        else:
-            devices = Device.objects.filter(Q(comment__icontains=s) | Q(ip_address__icontains=s))
+        found = tuple(page_obj.object_list)
+        abons = load_found(found, KIND_ABON)
+        devices = load_found(found, KIND_DEVICE)
 
-    else:
-        abons = ()
-        devices = ()
+        pattern = re.compile(re.escape(escape(s)), flags=re.IGNORECASE)
+        for abn in abons:
+            abn.fio = highlight(abn.fio, pattern)
+            abn.username_display = highlight(abn.username, pattern)
+            abn.telephone = highlight(abn.telephone, pattern)
 
-    for abn in abons:
-        abn.fio = replace_without_case(escape(abn.fio), s, "<b>%s</b>" % s)
-        abn.username_display = replace_without_case(escape(abn.username), s, "<b>%s</b>" % s)
-        abn.telephone = replace_without_case(escape(abn.telephone), s, "<b>%s</b>" % s)
-
-    for dev in devices:
-        dev.comment = replace_without_case(escape(dev.comment), s, "<b>%s</b>" % s)
+        for dev in devices:
+            dev.comment = highlight(dev.comment, pattern)
 
     return render(request, 'searchapp/index.html', {
         'abons': abons,
         'devices': devices,
-        's': s
+        's': s,
+        'paginator': paginator,
+        'page_obj': page_obj
     })
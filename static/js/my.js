@@ -283,14 +283,20 @@ $(document).ready(function () {
         self.removeClass('btn-success');
 		self.addClass('btn-info');
 		self.html('<span class="glyphicon glyphicon-refresh"></span> Подождите...');
-		$.getJSON(this.href, {cmd_param: cmd_param}, function(r){
+		var on_done = function(r){
             self.removeClass('btn-info');
 			if(r.status == 0)
 				self.addClass('btn-success');
 			else
                 self.addClass('btn-danger');
             self.html(r.dat);
-		});
+		};
+		// commands that change something are sent by POST with csrf token
+		var csrf = self.attr('data-csrf');
+		if(csrf)
+			$.post(this.href, {cmd_param: cmd_param, csrfmiddlewaretoken: csrf}, on_done, 'json');
+		else
+			$.getJSON(this.href, {cmd_param: cmd_param}, on_done);
 		return false;
 	});
 
@@ -1,11 +1,15 @@
-from taskapp.models import Task
+from djing.lib import LazyValue
+from taskapp.models import get_active_tasks_count as _tasks_count
 from accounts_app.models import UserProfile
 
 
-def get_active_tasks_count(request):
-    tasks_count = 0
+def _active_tasks_count(request):
     if isinstance(request.user, UserProfile):
-        tasks_count = Task.objects.filter(recipients__in=[request.user], state='S').count()
+        return _tasks_count(request.user.pk)
+    return 0
+
+
+def get_active_tasks_count(request):
     return {
-        'tasks_count': tasks_count
+        'tasks_count': LazyValue(_active_tasks_count, request)
     }
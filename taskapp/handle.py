@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 from django.template.loader import render_to_string
 from django.utils.translation import gettext as _
-from djing.tasks import send_email_notify
+from djing.tasks import multicast_email_notify
 from chatbot.models import ChatException
 from djing.lib import MultipleException
 
@@ -11,29 +11,24 @@ class TaskException(Exception):
 
 
 def handle(task, author, recipients):
-    errors = []
-    for recipient in recipients:
-        try:
-            task_status = _('Task')
-            # If signal to myself then quietly
-            if author == recipient:
-                return
-            # If task completed or failed
-            elif task.state == 'F' or task.state == 'C':
-                task_status = _('Task completed')
+    # If signal to myself then quietly
+    recipient_ids = [recipient.pk for recipient in recipients if recipient != author]
+    if not recipient_ids:
+        return
 
-            fulltext = render_to_string('taskapp/notification.html', {
-                'task': task,
-                'abon': task.abon,
-                'task_status': task_status
-            })
+    task_status = _('Task')
+    # If task completed or failed
+    if task.state == 'F' or task.state == 'C':
+        task_status = _('Task completed')
+        # If task completed or failed than send one message to author
+        recipient_ids = (author.pk,)
 
-            if task.state == 'F' or task.state == 'C':
-                # If task completed or failed than send one message to author
-                send_email_notify.delay(fulltext, author.pk)
-            else:
-                send_email_notify.delay(fulltext, recipient.pk)
-        except ChatException as e:
-            errors.append(e)
-    if len(errors) > 0:
-        raise MultipleException(errors)
+    fulltext = render_to_string('taskapp/notification.html', {
+        'task': task,
+        'abon': task.abon,
+        'task_status': task_status
+    })
+    try:
+        multicast_email_notify.delay(fulltext, recipient_ids)
+    except ChatException as e:
+        raise MultipleException((e,))
@@ -3,6 +3,9 @@ from datetime import timedelta
 import os
 from django.db import models
 from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_save, pre_delete, m2m_changed
+from django.dispatch import receiver
 from django.shortcuts import resolve_url
 from django.utils import timezone
 from django.utils.translation import ugettext as _
@@ -130,3 +133,46 @@ class ExtraComment(models.Model):
         verbose_name = _('Extra comment')
         verbose_name_plural = _('Extra comments')
         ordering = ('-date_create',)
+
+
+# Count of new tasks of each recipient, it is shown on every page
+ACTIVE_TASKS_CACHE_KEY = 'taskapp_active_tasks_%d'
+ACTIVE_TASKS_CACHE_TIMEOUT = getattr(settings, 'ACTIVE_TASKS_CACHE_TIMEOUT', 60)
+
+
+def get_active_tasks_count(account_id: int) -> int:
+    cache_key = ACTIVE_TASKS_CACHE_KEY % account_id
+    count = cache.get(cache_key)
+    if count is None:
+        count = Task.objects.filter(recipients__id=account_id, state='S').count()
+        cache.set(cache_key, count, ACTIVE_TASKS_CACHE_TIMEOUT)
+    return count
+
+
+def _drop_active_tasks_count(account_ids) -> None:
+    cache.delete_many([ACTIVE_TASKS_CACHE_KEY % pk for pk in account_ids])
+
+
+@receiver(post_save, sender=Task)
+def task_post_save(sender, instance, created, **kwargs):
+    # new task has no recipients yet, they are counted by m2m_changed
+    if not created:
+        _drop_active_tasks_count(instance.recipients.values_list('pk', flat=True))
+
+
+@receiver(pre_delete, sender=Task)
+def task_pre_delete(sender, instance, **kwargs):
+    _drop_active_tasks_count(instance.recipients.values_list('pk', flat=True))
+
+
+@receiver(m2m_changed, sender=Task.recipients.through)
+def task_recipients_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if reverse:
+        # instance is account
+        _drop_active_tasks_count((instance.pk,))
+    elif action == 'pre_clear':
+        _drop_active_tasks_count(instance.recipients.values_list('pk', flat=True))
+    else:
+        _drop_active_tasks_count(pk_set)
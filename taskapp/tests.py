@@ -0,0 +1,41 @@
+from django.core.cache import cache
+from django.template import Context, Template
+from django.test import TestCase, RequestFactory
+
+from accounts_app.models import UserProfile
+from taskapp.context_proc import get_active_tasks_count
+from taskapp.models import Task
+
+
+class ActiveTasksCountTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = UserProfile.objects.create_superuser('+79781234567', 'local_superuser', 'ps')
+        self.task = Task.objects.create(descr='Test', author=self.user)
+        self.task.recipients.add(self.user)
+
+    def _render(self):
+        request = RequestFactory().get('/')
+        request.user = self.user
+        return Template('{% if tasks_count > 0 %}{{ tasks_count }}{% endif %}').render(
+            Context(get_active_tasks_count(request)))
+
+    def test_count_is_lazy_and_cached(self):
+        request = RequestFactory().get('/')
+        request.user = self.user
+        # page that does not show count makes no queries
+        with self.assertNumQueries(0):
+            get_active_tasks_count(request)
+        self.assertEqual(self._render(), '1')
+        with self.assertNumQueries(0):
+            self.assertEqual(self._render(), '1')
+
+    def test_count_invalidation(self):
+        self.assertEqual(self._render(), '1')
+        self.task.finish(self.user)
+        self.assertEqual(self._render(), '')
+        task = Task.objects.create(descr='Test 2', author=self.user)
+        task.recipients.add(self.user)
+        self.assertEqual(self._render(), '1')
+        task.recipients.clear()
+        self.assertEqual(self._render(), '')
@@ -1,6 +1,7 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 import os
+from threading import Thread
 from pid.decorator import pidfile
 import django
 from telepot import DelegatorBot
@@ -13,6 +14,8 @@ def main():
     os.environ.setdefault("DJANGO_SETTINGS_MODULE", "djing.settings")
     django.setup()
     from chatbot.telebot import token, DjingTelebot
+    from chatbot.delivery import TelegramDeliveryWorker
+    Thread(target=TelegramDeliveryWorker(token).run_forever, daemon=True).start()
     while True:
         try:
             bot = DelegatorBot(token, [